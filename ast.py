@@ -2,98 +2,121 @@
 
 
 class AST(object):
-    
+    # Every node declares __slots__, so nodes carry no per-instance __dict__.
+    # Commands and function declarations also have a line slot, the source
+    # line they start on, or None when it isn't known. The slots set by
+    # resolver.resolve() (slot, target, global_name, varnames) are None
+    # until it runs.
+    __slots__ = ()
+
     def __init__(self):
         pass
 
 
 class Program(AST):
+    __slots__ = ('command', 'varnames')
 
     def __init__(self, command):
         self.command = command
+        self.varnames = None
 
     def __str__(self):
         return 'Program(%s)' % (str(self.command))
 
 
 class Command(AST):
-    pass
+    __slots__ = ()
 
 
 class AssignCommand(Command):
+    __slots__ = ('variable', 'expression', 'line')
 
-    def __init__(self, variable, expression):
+    def __init__(self, variable, expression, line=None):
         self.variable = variable
         self.expression = expression
+        self.line = line
 
     def __str__(self):
         return 'AssignCommand(%s,%s)' % (str(self.variable), str(self.expression))
 
 
 class CallCommand(Command):
+    __slots__ = ('identifier', 'expression', 'line', 'target')
 
-    def __init__(self, identifier, expression):
+    def __init__(self, identifier, expression, line=None):
         self.identifier = identifier
         self.expression = expression
+        self.line = line
+        self.target = None
 
     def __str__(self):
         return 'CallCommand(%s,%s)' % (str(self.identifier), str(self.expression))
 
 
-class SequentialCommand(Command):
+class CommandList(Command):
+    __slots__ = ('commands',)
 
-    def __init__(self, command1, command2):
-        self.command1 = command1
-        self.command2 = command2
+    def __init__(self, commands):
+        self.commands = commands
 
     def __str__(self):
-        return 'SequentialCommand(%s,%s)' % (str(self.command1), str(self.command2))
+        return 'CommandList(%s)' % (','.join([str(c) for c in self.commands]))
 
 
 class IfCommand(Command):
+    __slots__ = ('expression', 'command1', 'command2', 'line')
 
-    def __init__(self, expression, command1, command2):
+    def __init__(self, expression, command1, command2, line=None):
         self.expression = expression
         self.command1 = command1
         self.command2 = command2
+        self.line = line
 
     def __str__(self):
         return 'IfCommand(%s,%s,%s)' % (str(self.expression), str(self.command1), str(self.command2))
 
 
 class WhileCommand(Command):
+    __slots__ = ('expression', 'command', 'line')
 
-    def __init__(self, expression, command):
+    def __init__(self, expression, command, line=None):
         self.expression = expression
         self.command = command
+        self.line = line
 
     def __str__(self):
         return 'WhileCommand(%s,%s)' % (str(self.expression), str(self.command))
 
 
 class LetCommand(Command):
+    __slots__ = ('declaration', 'command', 'line')
 
-    def __init__(self, declaration, command):
+    def __init__(self, declaration, command, line=None):
         self.declaration = declaration
         self.command = command
+        self.line = line
 
     def __str__(self):
         return 'LetCommand(%s,%s)' % (str(self.declaration), str(self.command))
 
 
 class ReturnCommand(Command):
-    def __init__(self, expression):
+    __slots__ = ('expression', 'line')
+
+    def __init__(self, expression, line=None):
         self.expression = expression
+        self.line = line
 
     def __str__(self):
         return 'ReturnCommand(%s)' % (str(self.expression))
 
 
 class Expression(AST):
-    pass
+    __slots__ = ()
 
 
 class IntegerExpression(Expression):
+    __slots__ = ('value',)
 
     def __init__(self, value):
         self.value = value
@@ -103,6 +126,7 @@ class IntegerExpression(Expression):
 
 
 class VnameExpression(Expression):
+    __slots__ = ('variable',)
 
     def __init__(self, variable):
         self.variable = variable
@@ -112,6 +136,7 @@ class VnameExpression(Expression):
 
 
 class UnaryExpression(Expression):
+    __slots__ = ('operator', 'expression')
 
     def __init__(self, operator, expression):
         self.operator = operator
@@ -122,6 +147,7 @@ class UnaryExpression(Expression):
 
 
 class BinaryExpression(Expression):
+    __slots__ = ('expr1', 'oper', 'expr2')
 
     def __init__(self, expr1, oper, expr2):
         self.expr1 = expr1
@@ -133,44 +159,55 @@ class BinaryExpression(Expression):
 
 
 class Vname(AST):
+    __slots__ = ('identifier', 'slot')
 
     def __init__(self, identifier):
         self.identifier = identifier
+        self.slot = None
 
     def __str__(self):
         return 'Vname(%s)' % (str(self.identifier))
 
 
 class Declaration(AST):
-    pass
+    __slots__ = ()
 
 
 class ConstDeclaration(Declaration):
+    __slots__ = ('identifier', 'expression', 'slot')
 
     def __init__(self, identifier, expression):
         self.identifier = identifier
         self.expression = expression
+        self.slot = None
 
     def __str__(self):
         return 'ConstDeclaration(%s,%s)' % (str(self.identifier), str(self.expression))
 
 
 class VarDeclaration(Declaration):
+    __slots__ = ('identifier', 'type_denoter', 'slot')
 
     def __init__(self, identifier, type_denoter):
         self.identifier = identifier
         self.type_denoter = type_denoter
+        self.slot = None
 
     def __str__(self):
         return 'VarDeclaration(%s,%s)' % (str(self.identifier), str(self.type_denoter))
 
 class FunctionDeclaration(Declaration):
+    __slots__ = ('name', 'param', 'return_type_denoter', 'command', 'line',
+                 'global_name', 'varnames')
 
-    def __init__(self, name, param, return_type_denoter, command):
+    def __init__(self, name, param, return_type_denoter, command, line=None):
         self.name = name
         self.param = param
         self.return_type_denoter = return_type_denoter
         self.command = command
+        self.line = line
+        self.global_name = None
+        self.varnames = None
 
     def __str__(self):
         return 'FunctionDeclaration(%s,%s,%s,%s)' % (str(self.name),
@@ -180,6 +217,7 @@ class FunctionDeclaration(Declaration):
 
 
 class Parameter(Declaration):
+    __slots__ = ('argname', 'arg_type_denoter')
 
     def __init__(self, argname, arg_type_denoter):
         self.argname = argname
@@ -190,27 +228,28 @@ class Parameter(Declaration):
                                      str(self.arg_type_denoter))
 
 
-class SequentialParameter(Declaration):
+class ParameterList(Declaration):
+    __slots__ = ('params',)
 
-    def __init__(self, param1, param2):
-        self.param1 = param1
-        self.param2 = param2
+    def __init__(self, params):
+        self.params = params
 
     def __str__(self):
-        return 'SequentialParameter(%s,%s)' % (str(self.param1), str(self.param2))
+        return 'ParameterList(%s)' % (','.join([str(p) for p in self.params]))
 
 
-class SequentialDeclaration(Declaration):
+class DeclarationList(Declaration):
+    __slots__ = ('declarations',)
 
-    def __init__(self, decl1, decl2):
-        self.decl1 = decl1
-        self.decl2 = decl2
+    def __init__(self, declarations):
+        self.declarations = declarations
 
     def __str__(self):
-        return 'SequentialDeclaration(%s,%s)' % (str(self.decl1), str(self.decl2))
+        return 'DeclarationList(%s)' % (','.join([str(d) for d in self.declarations]))
 
 
 class TypeDenoter(AST):
+    __slots__ = ('identifier',)
 
     def __init__(self, identifier):
         self.identifier = identifier
@@ -219,6 +258,21 @@ class TypeDenoter(AST):
         return 'TypeDonoter(%s)' % (str(self.identifier))
 
 
+def iter_nodes(tree):
+    """ yield every AST node in tree, parents before children.
+    Uses an explicit stack, so arbitrarily deep trees are fine.
+    """
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, AST):
+            yield node
+            for name in reversed(type(node).__slots__):
+                stack.append(getattr(node, name))
+        elif isinstance(node, list):
+            stack.extend(reversed(node))
+
+
 if __name__ == '__main__':
     pass
     
\ No newline at end of file
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# Batch compilation of many mini triangle sources over a process pool
+
+import glob
+import multiprocessing
+import os
+import sys
+
+import codegen
+import parser
+import resolver
+import scanner
+
+# the CompileCache of the current worker process, set up by init_worker
+_worker_cache = None
+
+
+def find_sources(args, manifest=None):
+    """ expand args into a sorted list of .mt files.
+
+    each arg is a source file, a directory searched recursively for .mt
+    files, or a glob pattern. manifest names a file listing more args, one
+    per line, blank lines and lines starting with # are skipped.
+    """
+    args = list(args)
+    if manifest is not None:
+        with open(manifest, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    args.append(line)
+
+    sources = set()
+    for arg in args:
+        if os.path.isdir(arg):
+            for dirpath, dirnames, filenames in os.walk(arg):
+                for name in filenames:
+                    if name.endswith('.mt'):
+                        sources.add(os.path.join(dirpath, name))
+        elif os.path.isfile(arg):
+            sources.add(arg)
+        else:
+            matches = glob.glob(arg)
+            if not matches:
+                raise IOError('no such file, directory or pattern: %s' % arg)
+            for path in matches:
+                if os.path.isfile(path) and path.endswith('.mt'):
+                    sources.add(path)
+    return sorted(sources)
+
+
+def init_worker(options):
+    global _worker_cache
+    _worker_cache = codegen.open_cache(options)
+
+
+def compile_one(job):
+    """ compile one source in a worker. returns (source, error, stats lines),
+    error is None on success. never raises, so one bad file can't stop the
+    batch.
+    """
+    f, options = job
+    try:
+        lines = codegen.compile_file(f, options, _worker_cache)
+    except (scanner.ScannerError, parser.ParserError, resolver.ResolveError,
+            codegen.CodeGenError) as e:
+        return f, str(e), []
+    except (IOError, OSError) as e:
+        return f, str(e), []
+    except Exception as e:
+        return f, '%s: %s' % (type(e).__name__, e), []
+    return f, None, lines
+
+
+def compile_batch(sources, options, jobs=0, output=sys.stdout):
+    """ compile sources over a pool of jobs processes, 0 means one per cpu.
+
+    the stats lines of each file and a summary of the failed files are
+    written to output. returns the list of (source, error) failures.
+    """
+    if jobs <= 0:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(sources)) or 1
+    work = [(f, options) for f in sources]
+    # a few chunks per worker keeps them all busy without paying for a
+    # round trip per file
+    chunksize = max(1, len(work) // (jobs * 4))
+
+    if jobs == 1:
+        init_worker(options)
+        results = map(compile_one, work)
+    else:
+        pool = multiprocessing.Pool(jobs, init_worker, (options,))
+        try:
+            results = pool.map(compile_one, work, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+
+    failures = []
+    for f, error, lines in results:
+        if error is not None:
+            failures.append((f, error))
+        elif lines:
+            output.write('%s:\n' % f)
+            for line in lines:
+                output.write('  %s\n' % line)
+
+    output.write('compiled %d of %d files\n' %
+                 (len(sources) - len(failures), len(sources)))
+    for f, error in failures:
+        output.write('%s: %s\n' % (f, error))
+    return failures
+
+
+if __name__ == '__main__':
+    pass
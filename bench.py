@@ -0,0 +1,604 @@
+#!/usr/bin/env python
+#
+# Benchmarks for the mini triangle compiler
+
+import cStringIO
+import glob
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import ast
+import batch
+import cache
+import codegen
+import deadcode
+import optimizer
+import parser
+import peephole
+import profiler
+import progen
+import runtime
+import scanner
+
+# Parser stress budget: microseconds of parse time allowed per statement or
+# declaration. Parsing is linear, so this holds from 10^3 up to 10^6 lines.
+PARSE_BUDGET_US = 100
+# Parses of each size timed, the best one is checked against the budget.
+STRESS_REPEAT = 3
+
+# Inputs of the test programs that can't take the default one. memo.mt's fib
+# and paths take exponential time without their memo tables, builtins.mt
+# reads two numbers.
+CODE_PASS_INPUTS = {'memo.mt': (15,), 'builtins.mt': (97, 97)}
+
+
+def best_of(func, repeat=3):
+    """ return the best wall time in seconds of `repeat` calls to func """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_scanner(lines):
+    """ compare scanning throughput of CharScanner and Scanner """
+    prog = progen.gen_program(lines)
+    size = len(prog)
+    print 'scanner: %d lines, %d bytes' % (lines, size)
+    for cls in [scanner.CharScanner, scanner.Scanner]:
+        elapsed = best_of(lambda: cls(prog).scan())
+        print '  %-12s %8.3fs %10.1f KB/s' % (cls.__name__, elapsed,
+                                               size / 1024.0 / elapsed)
+
+
+def bench_codegen(lines):
+    """ time CodeGen.generate per AST node for growing program sizes """
+    size = 1000
+    while size <= lines:
+        tree = parser.Parser(scanner.Scanner(progen.gen_program(size)).scan()).parse()
+        nodes = sum(1 for node in ast.iter_nodes(tree))
+        elapsed = best_of(lambda: codegen.CodeGen(tree).generate())
+        print 'codegen %8d lines %9d nodes %8.3fs %6.2f us/node' % (
+            size, nodes, elapsed, elapsed / nodes * 1e6)
+        size *= 10
+
+
+def static_count(code):
+    """ number of instructions in code and the functions defined in it,
+    not counting embedded runtime functions
+    """
+    count = len(profiler.decode(code))
+    for const in code.co_consts:
+        if isinstance(const, type(code)) and not runtime.is_runtime(const):
+            count += static_count(const)
+    return count
+
+
+def bench_code_passes(inputs=(97,)):
+    """ static and dynamic instruction counts of the test programs with and
+    without the dead code and peephole passes, run on inputs unless
+    CODE_PASS_INPUTS has others for them
+    """
+    print 'code passes: instructions (static/dynamic), input %s' % list(inputs)
+    deadcode_obj = deadcode.DeadCodeEliminator()
+    peephole_obj = peephole.Peephole()
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(__file__) or '.',
+                                              'testFiles', '*.mt'))):
+        with open(path) as f:
+            prog = f.read()
+        name = os.path.basename(path)
+        program_inputs = CODE_PASS_INPUTS.get(name, inputs)
+        results = []
+        for code_passes in [[], [deadcode_obj, peephole_obj]]:
+            tree = parser.Parser(scanner.Scanner(prog).scan()).parse()
+            tree = optimizer.fold_constants(tree)
+            code = codegen.CodeGen(tree, code_passes).generate().func_code
+            output, count = profiler.run_counted(code, list(program_inputs))
+            results.append((static_count(code), count, output))
+        assert results[0][2] == results[1][2], path
+        line = '  %-16s %5d/%-7d -> %5d/%-7d' % (
+            name, results[0][0], results[0][1], results[1][0], results[1][1])
+        if name in CODE_PASS_INPUTS:
+            line += ' input %s' % list(program_inputs)
+        print line
+    saved = sum(before - after for name, before, after, folded in deadcode_obj.savings)
+    print '  dead code: %d bytes saved' % saved
+    print '  peephole rule hits: ' + ', '.join(
+        '%s=%d' % (name, peephole_obj.hits[name]) for name in peephole.RULE_NAMES)
+
+
+def run_timed(code, inputs=()):
+    """ run the generated code object, return its output and wall time """
+    stdout = sys.stdout
+    sys.stdout = cStringIO.StringIO()
+    start = time.time()
+    try:
+        exec code in {'input': profiler.Inputs(inputs)}
+    finally:
+        elapsed = time.time() - start
+        output = sys.stdout.getvalue()
+        sys.stdout = stdout
+    return output, elapsed
+
+
+def compare_options(prog, variants):
+    """ compile prog once per (label, option values) variant and run it,
+    printing the static and executed instruction counts and the best wall
+    time of each. every variant must print the same output.
+    """
+    outputs = []
+    for label, values in variants:
+        options = codegen.option_parser().get_default_values()
+        for name, value in values.items():
+            setattr(options, name, value)
+        code = codegen.compile_source(prog, options)
+        output, count = profiler.run_counted(code, [])
+        best = None
+        for i in range(3):
+            timed_output, elapsed = run_timed(code)
+            assert timed_output == output
+            if best is None or elapsed < best:
+                best = elapsed
+        outputs.append(output)
+        print '  %-16s %6d instructions %10d executed %8.3fs' % (
+            label, static_count(code), count, best)
+    assert len(set(outputs)) == 1
+
+
+def bench_inline(iterations, calls=40):
+    """ run a call heavy program compiled with and without inlining """
+    print 'inline: %d calls per iteration, %d iterations' % (calls, iterations)
+    size = codegen.option_parser().get_default_values().inline_size
+    compare_options(progen.gen_calls(calls, iterations),
+                    [('inline size 0', {'inline_size': 0}),
+                     ('inline size %d' % size, {'inline_size': size})])
+
+
+def bench_licm(iterations, lines=20):
+    """ run a loop heavy program compiled with and without loop invariant
+    code motion
+    """
+    print 'licm: %d statements per inner iteration, %d x %d iterations' % (
+        lines, iterations, iterations / 10)
+    compare_options(progen.gen_loops(lines, iterations),
+                    [('no licm', {'licm': False}), ('licm', {'licm': True})])
+
+
+SIMPLIFY_LEAVES = ['a', 'b', 'c', '0', '1', '2', '3', '4', '8', '16']
+SIMPLIFY_OPERATORS = ['+', '-', '*', '/', '\\', '<', '>', '=']
+
+
+def random_expression(rng, depth):
+    """ mini triangle source of a random expression over a, b and c """
+    if depth == 0 or rng.random() < 0.2:
+        return rng.choice(SIMPLIFY_LEAVES)
+    if rng.random() < 0.1:
+        return '-(%s)' % random_expression(rng, depth - 1)
+    if rng.random() < 0.2:
+        # the same operand on both sides, for x - x
+        operand = random_expression(rng, depth - 1)
+        return '(%s %s %s)' % (operand, rng.choice(SIMPLIFY_OPERATORS), operand)
+    return '(%s %s %s)' % (random_expression(rng, depth - 1),
+                           rng.choice(SIMPLIFY_OPERATORS),
+                           random_expression(rng, depth - 1))
+
+
+def run_checked(code, inputs):
+    """ output of the generated code, or the name of the exception it raised """
+    try:
+        return run_timed(code, inputs)[0]
+    except Exception, e:
+        return type(e).__name__
+
+
+def check_simplify(programs, seed=1):
+    """ compile random expressions with and without the simplify rules and
+    check both give the same output, or raise the same exception, for
+    inputs around zero. half the programs store a comparison in c, so
+    variables may hold bools. returns the number of mismatches.
+    """
+    rng = random.Random(seed)
+    inputs = [(-7, 3), (-1, -1), (0, 5), (5, 0), (37, -16), (-64, 8)]
+    plain = codegen.option_parser().get_default_values()
+    plain.simplify = ''
+    simplified = codegen.option_parser().get_default_values()
+    failures = 0
+    for i in range(programs):
+        store = rng.choice(['a < b', 'a - b'])
+        # identities at the top change what putint prints if they drop
+        # the conversion of a bool
+        expression = rng.choice(['%s', '(%s + 0)', '(%s * 1)']) % (
+            random_expression(rng, 4))
+        prog = ('let var a: Integer; var b: Integer; var c: Integer;\n'
+                'in begin getint(a); getint(b); c := %s; putint(%s); end\n'
+                % (store, expression))
+        codes = [codegen.compile_source(prog, plain),
+                 codegen.compile_source(prog, simplified)]
+        for values in inputs:
+            outputs = [run_checked(code, values) for code in codes]
+            if outputs[0] != outputs[1]:
+                failures += 1
+                print '  mismatch for %s, inputs %s: %r != %r' % (
+                    expression, values, outputs[0], outputs[1])
+                break
+    print 'simplify: %d random programs, %d mismatches' % (programs, failures)
+    return failures
+
+
+def stress_parser(max_lines):
+    """ parse long statement and declaration sequences of 10^3 up to
+    max_lines, checking that the best of STRESS_REPEAT parses of each
+    stays within PARSE_BUDGET_US per line. return True if all sizes passed.
+    """
+    # warm up, so the first size isn't timed cold
+    parser.Parser(scanner.Scanner(progen.gen_program(1000)).scan_compact()).parse()
+    ok = True
+    lines = 1000
+    while lines <= max_lines:
+        for shape, prog in [('statements', progen.gen_program(lines)),
+                            ('declarations', progen.gen_program(1, lines))]:
+            tokens = scanner.Scanner(prog).scan_compact()
+            del prog
+            elapsed = best_of(lambda: parser.Parser(tokens).parse(),
+                              STRESS_REPEAT)
+            per_line = elapsed / lines * 1e6
+            status = 'ok'
+            if per_line > PARSE_BUDGET_US:
+                status = 'OVER BUDGET'
+                ok = False
+            print 'parse %8d %-12s %8.3fs %6.1f us/line %s' % (
+                lines, shape, elapsed, per_line, status)
+        lines *= 10
+    return ok
+
+
+def peak_rss_kb():
+    """ peak resident set size of this process in KB (linux units) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def anon_rss_kb():
+    """ resident memory of this process not backed by a file, in KB, 0 if
+    /proc doesn't say. pages of a mapped source are file backed.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+
+def token_memory_child(kind, path):
+    """ run in a fresh process: scan into `kind` storage, print peak rss """
+    if kind == 'mapped':
+        prog = codegen.map_prog_from_file(path)
+        tokens = scanner.Scanner(prog).scan_compact()
+    elif kind != 'none':
+        with open(path) as f:
+            prog = f.read()
+    if kind == 'list':
+        tokens = scanner.Scanner(prog).scan()
+    elif kind == 'compact':
+        tokens = scanner.Scanner(prog).scan_compact()
+    print peak_rss_kb(), anon_rss_kb()
+
+
+def bench_token_memory(lines):
+    """ compare peak rss of a list of Tokens against a TokenStore, scanning
+    the source read into a string or mapped in place
+    """
+    fd, path = tempfile.mkstemp(suffix='.mt')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(progen.gen_program(lines))
+        print 'token memory: %d lines, %d KB source' % (
+            lines, os.path.getsize(path) / 1024)
+        results = {}
+        for kind in ['none', 'list', 'compact', 'mapped']:
+            out = subprocess.check_output([sys.executable, __file__,
+                                           '--token-memory', kind, path])
+            results[kind] = [int(kb) for kb in out.split()]
+    finally:
+        os.remove(path)
+    for kind in ['list', 'compact', 'mapped']:
+        peak, anon = results[kind]
+        print '  %-12s %8d KB peak rss, %8d KB over baseline, %8d KB not file backed' % (
+            kind, peak, peak - results['none'][0], anon - results['none'][1])
+
+
+
+def bench_batch(files, lines=200):
+    """ time batch compiles of a synthetic corpus of `files` programs with
+    1, 2, 4, ... worker processes, up to the cpu count
+    """
+    cpus = multiprocessing.cpu_count()
+    print 'batch: %d files of %d lines, %d cpus' % (files, lines, cpus)
+    directory = tempfile.mkdtemp()
+    try:
+        for i in range(files):
+            with open(os.path.join(directory, 'prog%d.mt' % i), 'w') as f:
+                f.write(progen.gen_program(lines + i % 10))
+        sources = batch.find_sources([directory])
+        options = codegen.option_parser().get_default_values()
+        options.cache = False
+        jobs = 1
+        base = None
+        while True:
+            output = cStringIO.StringIO()
+            elapsed = best_of(lambda: batch.compile_batch(sources, options,
+                                                          jobs, output))
+            if base is None:
+                base = elapsed
+            print '  %3d jobs %8.3fs %8.1f files/s %5.2fx' % (
+                jobs, elapsed, files / elapsed, base / elapsed)
+            if jobs >= cpus:
+                break
+            jobs = min(jobs * 2, cpus)
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+
+def bench_parallel(lines, levels=(0, 1)):
+    """ time compiling one program of `lines` lines of small functions with
+    its functions parsed and generated in 1, 2, 4, ... processes, up to the
+    cpu count, against compiling it in one
+    """
+    cpus = multiprocessing.cpu_count()
+    print 'parallel functions: %d lines, %d cpus' % (lines, cpus)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'functions.mt')
+    try:
+        with open(path, 'w') as f:
+            f.write(progen.gen_functions(lines))
+        for level in levels:
+            options = codegen.option_parser().get_default_values()
+            options.opt_level = level
+            base = best_of(lambda: codegen.compile_file(path, options))
+            print '  -O%d  sequential %8.3fs' % (level, base)
+            jobs = 1
+            while True:
+                options.function_jobs = jobs
+                elapsed = best_of(lambda: codegen.compile_file(path, options))
+                print '  -O%d %3d jobs    %8.3fs %5.2fx' % (level, jobs, elapsed,
+                                                         base / elapsed)
+                if jobs >= cpus:
+                    break
+                jobs = min(jobs * 2, cpus)
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+def bench_ast_cache(lines, shapes=progen.SHAPE_NAMES):
+    """ time scanning and parsing each program shape against loading its
+    tree from the ast cache, validation hash included
+    """
+    print 'ast cache: %d lines' % lines
+    directory = tempfile.mkdtemp()
+    try:
+        for shape in shapes:
+            path = os.path.join(directory, shape + '.mt')
+            prog = progen.generate(shape, lines)
+            with open(path, 'w') as f:
+                f.write(prog)
+            ast_cache = cache.AstCache()
+            parse = best_of(lambda: codegen.parse_source(prog))
+            codegen.parse_source(prog, ast_cache=ast_cache, path=path)
+            load = best_of(lambda: ast_cache.load_tree(path, prog))
+            assert ast_cache.hits == 3
+            print '  %-12s parse %8.3fs  load %8.3fs %6.1fx  %8d KB cached' % (
+                shape, parse, load, parse / load,
+                os.path.getsize(ast_cache.path(path)) / 1024)
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+# reads a count and that many ints, printing each one doubled
+ECHO_PROGRAM = """let
+    var n: Integer;
+    var i: Integer;
+    var x: Integer;
+in
+    begin
+        getint(n);
+        i := 0;
+        while i < n do
+            begin
+                getint(x);
+                putint(x * 2);
+                i := i + 1;
+            end
+    end
+"""
+
+
+def bench_io(count):
+    """ pipe count ints through a compiled program, with print and input()
+    and with the buffered runtime, in ints per second. both must print the
+    same.
+    """
+    print 'io: %d ints in and out' % count
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, 'echo.mt')
+    data = os.path.join(directory, 'input.txt')
+    try:
+        with open(source, 'w') as f:
+            f.write(ECHO_PROGRAM)
+        with open(data, 'w') as f:
+            f.write('%d\n' % count)
+            for i in range(count):
+                f.write('%d\n' % (i * 7919 % 100003 - 50000))
+        outputs = []
+        for label, buffered in [('input/print', False), ('buffered', True)]:
+            options = codegen.option_parser().get_default_values()
+            options.buffered_io = buffered
+            codegen.compile_file(source, options)
+            with open(data) as stdin:
+                start = time.time()
+                output = subprocess.check_output(
+                    [sys.executable, os.path.splitext(source)[0] + '.pyc'],
+                    stdin=stdin)
+                elapsed = time.time() - start
+            outputs.append(output)
+            print '  %-12s %8.3fs %10.0f ints/s' % (label, elapsed,
+                                                    count / elapsed)
+        assert outputs[0] == outputs[1]
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+def phase_child(shape, lines):
+    """ run in a fresh process: time Scanner.scan, Parser.parse and
+    CodeGen.generate on a generated program, print one json object per phase
+    """
+    prog = progen.generate(shape, lines)
+    # best of three for small programs, a single run for the big ones
+    repeat = 3 if lines <= 10000 else 1
+    result = {'shape': shape, 'lines': lines, 'bytes': len(prog)}
+
+    tokens = []
+    def scan():
+        tokens[:] = scanner.Scanner(prog).scan()
+    scan_time = best_of(scan, repeat)
+    result['tokens'] = len(tokens)
+
+    trees = []
+    def parse():
+        trees[:] = [parser.Parser(tokens).parse()]
+    parse_time = best_of(parse, repeat)
+    del tokens[:]
+    tree = trees[0]
+    result['nodes'] = sum(1 for node in ast.iter_nodes(tree))
+
+    gen_time = best_of(lambda: codegen.CodeGen(tree).generate(), repeat)
+
+    for phase, elapsed in [('scan', scan_time), ('parse', parse_time),
+                           ('codegen', gen_time)]:
+        record = dict(result, phase=phase, seconds=elapsed,
+                      us_per_line=elapsed / lines * 1e6)
+        print json.dumps(record, sort_keys=True)
+
+
+def bench_phases(max_lines, shapes=progen.SHAPE_NAMES, output=sys.stdout):
+    """ time each compiler phase on every program shape from 10^3 up to
+    max_lines lines. each size runs in its own process, so one size can't
+    skew the memory or garbage collector state of the next. writes one json
+    object per shape, size and phase to output, or one with an "error"
+    when the child process fails.
+    """
+    for shape in shapes:
+        lines = 1000
+        while lines <= max_lines:
+            child = subprocess.Popen([sys.executable, __file__, '--phase-child',
+                                      shape, str(lines)],
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+            out, err = child.communicate()
+            if child.returncode == 0:
+                output.write(out)
+            else:
+                error = (err.strip().splitlines() or ['exit status %d' %
+                                                      child.returncode])[-1]
+                output.write(json.dumps({'shape': shape, 'lines': lines,
+                                         'error': error}, sort_keys=True))
+                output.write('\n')
+            output.flush()
+            lines *= 10
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--token-memory':
+        token_memory_child(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+    if len(sys.argv) == 4 and sys.argv[1] == '--phase-child':
+        phase_child(sys.argv[2], int(sys.argv[3]))
+        sys.exit(0)
+    if len(sys.argv) >= 2 and sys.argv[1] == '--phases':
+        max_lines = 1000000
+        if len(sys.argv) > 2:
+            max_lines = int(sys.argv[2])
+        shapes = progen.SHAPE_NAMES
+        if len(sys.argv) > 3:
+            shapes = sys.argv[3].split(',')
+            for shape in shapes:
+                if shape not in progen.SHAPES:
+                    print 'unknown program shape %s' % shape
+                    sys.exit(1)
+        bench_phases(max_lines, shapes)
+        sys.exit(0)
+    if len(sys.argv) >= 2 and sys.argv[1] == '--stress':
+        max_lines = 1000000
+        if len(sys.argv) > 2:
+            max_lines = int(sys.argv[2])
+        sys.exit(not stress_parser(max_lines))
+    if len(sys.argv) >= 2 and sys.argv[1] == '--inline':
+        iterations = 10000
+        if len(sys.argv) > 2:
+            iterations = int(sys.argv[2])
+        bench_inline(iterations)
+        sys.exit(0)
+    if len(sys.argv) >= 2 and sys.argv[1] == '--licm':
+        iterations = 400
+        if len(sys.argv) > 2:
+            iterations = int(sys.argv[2])
+        bench_licm(iterations)
+        sys.exit(0)
+    if len(sys.argv) >= 2 and sys.argv[1] == '--check-simplify':
+        programs = 500
+        if len(sys.argv) > 2:
+            programs = int(sys.argv[2])
+        sys.exit(check_simplify(programs) != 0)
+    if len(sys.argv) >= 2 and sys.argv[1] == '--io':
+        count = 1000000
+        if len(sys.argv) > 2:
+            count = int(sys.argv[2])
+        bench_io(count)
+        sys.exit(0)
+    if len(sys.argv) >= 2 and sys.argv[1] == '--ast-cache':
+        lines = 10000
+        if len(sys.argv) > 2:
+            lines = int(sys.argv[2])
+        bench_ast_cache(lines)
+        sys.exit(0)
+    if len(sys.argv) >= 2 and sys.argv[1] == '--parallel':
+        lines = 30000
+        if len(sys.argv) > 2:
+            lines = int(sys.argv[2])
+        bench_parallel(lines)
+        sys.exit(0)
+    if len(sys.argv) >= 2 and sys.argv[1] == '--batch':
+        files = 1000
+        if len(sys.argv) > 2:
+            files = int(sys.argv[2])
+        bench_batch(files)
+        sys.exit(0)
+
+    lines = 10000
+    if len(sys.argv) > 1:
+        lines = int(sys.argv[1])
+    bench_scanner(lines)
+    bench_token_memory(lines)
+    bench_codegen(lines)
+    bench_code_passes()
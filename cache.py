@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+#
+# On disk cache of compiled mini triangle programs
+
+import hashlib
+import imp
+import marshal
+import os
+import sys
+import tempfile
+
+import ast
+import serialize
+
+# Bump when the output of the compiler changes in a way the sources of the
+# modules in COMPILER_MODULES don't show (e.g. a byteplay upgrade).
+CACHE_VERSION = 1
+
+COMPILER_MODULES = ['scanner.py', 'parser.py', 'ast.py', 'serialize.py',
+                    'optimizer.py', 'simplify.py', 'tailcall.py', 'inliner.py',
+                    'licm.py', 'resolver.py', 'memo.py', 'runtime.py',
+                    'deadcode.py', 'peephole.py', 'parallel.py', 'codegen.py']
+
+DEFAULT_CACHE_DIR = os.environ.get('MT_CACHE_DIR',
+                                   os.path.join('~', '.cache', 'minitriangle'))
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# the modules whose source decides the tokens and the tree of a program
+FRONTEND_MODULES = ['scanner.py', 'parser.py', 'ast.py', 'serialize.py']
+
+# extension of the ast cache file written next to each source
+AST_SUFFIX = '.ast'
+
+_fingerprints = {}
+
+
+def fingerprint(modules):
+    """ hash identifying the given compiler modules: the python bytecode
+    magic, the cache version and the source of each module
+    """
+    key = tuple(modules)
+    if key not in _fingerprints:
+        h = hashlib.sha1()
+        h.update(imp.get_magic())
+        h.update(str(CACHE_VERSION))
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for name in modules:
+            with open(os.path.join(directory, name), 'rb') as f:
+                h.update(f.read())
+        _fingerprints[key] = h.hexdigest()
+    return _fingerprints[key]
+
+
+def warn(message):
+    """ report a cache problem on stderr. the compile goes on without the
+    cache, so it's never an error
+    """
+    sys.stderr.write('warning: %s\n' % message)
+
+
+def compiler_fingerprint():
+    """ hash identifying this compiler """
+    return fingerprint(COMPILER_MODULES)
+
+
+def remove_quietly(path):
+    """ remove the file at path if there is one, ignoring errors """
+    if path is None:
+        return
+    try:
+        os.remove(path)
+    except EnvironmentError:
+        pass
+
+
+class CompileCache(object):
+    """ Marshalled code objects stored one per file, named by the hash of
+        the source text, the compiler fingerprint and the optimization flags.
+
+        The least recently used entries are evicted once the entries take
+        more than max_bytes. A hit refreshes the entry's mtime, which is
+        what the eviction order is based on. A cache that can't be read is
+        a miss and one that can't be written skips the store, with a
+        warning on stderr, so the compile still writes its pyc.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, source, flags):
+        """ cache key for source compiled with the given flags string """
+        h = hashlib.sha1()
+        h.update(compiler_fingerprint())
+        h.update('\0')
+        h.update(flags)
+        h.update('\0')
+        h.update(source)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.code')
+
+    def get(self, key):
+        """ return the marshalled code stored under key, or None """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except EnvironmentError as e:
+            if os.path.exists(path):
+                warn('compile cache not read: %s' % e)
+            self.misses += 1
+            return None
+        try:
+            os.utime(path, None)
+        except EnvironmentError:
+            # a read only cache still works, it just isn't reordered
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """ store marshalled code under key, then evict down to max_bytes """
+        tmp_path = None
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # write to a temporary file and rename it, so concurrent
+            # compiles never see a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, self.path(key))
+        except EnvironmentError as e:
+            warn('compile cache not written: %s' % e)
+            remove_quietly(tmp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        """ remove least recently used entries until under max_bytes """
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self.directory)
+        except EnvironmentError as e:
+            warn('compile cache not evicted: %s' % e)
+            return
+        for name in names:
+            if not name.endswith('.code'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class AstCache(object):
+    """ The tokens and tree of a source file, serialized next to it.
+
+        Stored in a file named like the source with AST_SUFFIX, starting
+        with a hash of the source text and the front end modules. An entry
+        whose hash doesn't match, because the source or the scanner or
+        parser changed, or that doesn't decode, is a miss and gets
+        overwritten. A file that can't be written, in a read only
+        directory say, is skipped with a warning.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, source_path):
+        return os.path.splitext(source_path)[0] + AST_SUFFIX
+
+    def key(self, source):
+        """ validation hash of source text """
+        h = hashlib.sha1()
+        h.update(fingerprint(FRONTEND_MODULES))
+        h.update('\0')
+        h.update(source)
+        return h.hexdigest()
+
+    def read(self, source_path, source):
+        """ the (tokens, tree) data stored for the source text of
+        source_path, or None
+        """
+        try:
+            with open(self.path(source_path), 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        key = self.key(source)
+        if not data.startswith(key + '\n'):
+            return None
+        try:
+            tokens, tree = marshal.loads(data[len(key) + 1:])
+        except serialize.DECODE_ERRORS:
+            return None
+        return tokens, tree
+
+    def load(self, source_path, source, part, decode):
+        """ part 0 (tokens) or 1 (tree) of the entry for the source text of
+        source_path decoded with decode, or None
+        """
+        entry = self.read(source_path, source)
+        value = None
+        if entry is not None:
+            try:
+                value = decode(entry[part])
+            except serialize.DECODE_ERRORS:
+                pass
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def load_tree(self, source_path, source):
+        """ the ast tree stored for the source text of source_path, or None """
+        tree = self.load(source_path, source, 1, serialize.load_tree)
+        if tree is not None and not isinstance(tree, ast.Program):
+            self.hits -= 1
+            self.misses += 1
+            return None
+        return tree
+
+    def load_tokens(self, source_path, source):
+        """ the TokenStore stored for the source text of source_path, or None """
+        return self.load(source_path, source, 0, serialize.load_tokens)
+
+    def store(self, source_path, source, tokens, tree):
+        """ store the tokens and the freshly parsed tree of source text """
+        data = marshal.dumps((serialize.dump_tokens(tokens),
+                              serialize.dump_tree(tree)))
+        path = self.path(source_path)
+        tmp_path = None
+        try:
+            # written whole and renamed, like CompileCache.put
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                            suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.key(source) + '\n')
+                f.write(data)
+            os.rename(tmp_path, path)
+        except EnvironmentError as e:
+            warn('ast cache not written: %s' % e)
+            remove_quietly(tmp_path)
+
+
+if __name__ == '__main__':
+    pass
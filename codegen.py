@@ -1,17 +1,70 @@
 import imp
+import json
 import marshal
+import mmap
+import optparse
 import os
 import pprint
 import struct
 import sys
-import time
 import types
 
 from byteplay import *
 
 import ast
+import batch
+import cache
+import deadcode
+import inliner
+import licm
+import instrument
+import memo
+import optimizer
+import parallel
 import parser
+import peephole
+import resolver
+import runtime
 import scanner
+import simplify
+import tailcall
+
+
+# bytecode for each binary operator
+BINARY_OPS = {'+':  (BINARY_ADD, None),
+              '-':  (BINARY_SUBTRACT, None),
+              '*':  (BINARY_MULTIPLY, None),
+              '/':  (BINARY_DIVIDE, None),
+              '>':  (COMPARE_OP, '>'),
+              '<':  (COMPARE_OP, '<'),
+              '=':  (COMPARE_OP, '=='),
+              '\\': (BINARY_MODULO, 0),
+              # not in the source language, made by simplify.py
+              '<<': (BINARY_LSHIFT, None),
+              '>>': (BINARY_RSHIFT, None),
+              '&':  (BINARY_AND, None)}
+
+
+# global the embedded runtime.memo_table is bound to
+MEMO_TABLE = 'runtime.memo_table'
+
+# globals the functions runtime.buffered_io returns are bound to
+IO_GLOBALS = ['runtime.getint', 'runtime.write', 'runtime.flush']
+
+
+def increasing_lines(code):
+    """ drop the SetLineno entries that don't move to a later line. the line
+    number table can only step forwards.
+    """
+    out = []
+    last = 0
+    for op, arg in code:
+        if op is SetLineno:
+            if arg <= last:
+                continue
+            last = arg
+        out.append((op, arg))
+    return out
 
 
 class CodeGenError(Exception):
@@ -25,13 +78,58 @@ class CodeGenError(Exception):
 
 
 class CodeGen(object):
-    """ CodeGen """
-    def __init__(self, tree):
+    """ CodeGen
+
+        code_passes: optimizers applied in order to each code list before
+                     it is turned into a Code object. Each has an
+                     optimize(code, name) method returning the new list.
+        stats: instrument.CompileStats recording the code pass and assembly
+               phases and the instructions of each function.
+        filename: source file name recorded in the code objects.
+        memo: memo.Memoizer choosing the functions whose results are kept
+              in a memo table, None to memoize nothing.
+        buffered_io: do getint and putint through runtime.buffered_io
+                     rather than input() and print.
+        compiled: FunctionDeclaration -> the python code object generated
+                  for it elsewhere, see parallel.py, which is bound rather
+                  than generated again.
+    """
+    def __init__(self, tree, code_passes=None, stats=None, filename='',
+                 memo=None, buffered_io=False):
         self.tree = tree
+        self.filename = filename
+        self.memo = memo
+        self.buffered_io = buffered_io
+        self.code_passes = code_passes or []
+        self.stats = stats or instrument.NULL_STATS
+        self.compiled = {}
+        self.resolved = False
         self.code = []
-       # self.env  = {}
-        self.env  = []
-        self.scope_count = 0
+        # slot names of the code objects being generated, innermost last
+        self.varnames = []
+        # (memo table global, key slot name) of the code objects being
+        # generated, None for the ones not memoized
+        self.memo_tables = []
+        # ast node type -> method returning the work items for that node
+        self.generators = {
+            ast.AssignCommand:       self.gen_assign_command,
+            ast.CallCommand:         self.gen_call_command,
+            ast.CommandList:         self.gen_seq_command,
+            ast.IfCommand:           self.gen_if_command,
+            ast.WhileCommand:        self.gen_while_command,
+            ast.LetCommand:          self.gen_let_command,
+            ast.ReturnCommand:       self.gen_return_command,
+            ast.VarDeclaration:      self.gen_var_declaration,
+            ast.ConstDeclaration:    self.gen_const_declaration,
+            ast.DeclarationList:     self.gen_seq_declaration,
+            ast.FunctionDeclaration: self.gen_func_declaration,
+            ast.IntegerExpression:   self.gen_integer_expression,
+            ast.VnameExpression:     self.gen_vname_expression,
+            ast.UnaryExpression:     self.gen_unary_expression,
+            ast.BinaryExpression:    self.gen_binary_expression,
+            ast.Parameter:           self.gen_param,
+            ast.ParameterList:       self.gen_param,
+        }
 
     def generate(self):
         """ start of appending bytecode. turns bytecode into callable func """
@@ -39,220 +137,350 @@ class CodeGen(object):
             raise CodeGenError(self.tree, ast.Program)
         if type(self.tree.command) is not ast.LetCommand:
             raise CodeGenError(self.tree.command, ast.LetCommand)
-        
+
+        self.resolve()
         self.push_stack()
-        self.push_env()
-        
+        self.varnames.append(self.tree.varnames)
+        self.memo_tables.append(None)
+
+        if self.memo is not None and any(self.memo.is_memoized(decl)
+                                         for decl in self.memo.functions):
+            self.append_code((LOAD_CONST, runtime.embedded(runtime.memo_table)))
+            self.append_code((MAKE_FUNCTION, 0))
+            self.append_code((STORE_GLOBAL, MEMO_TABLE))
+
+        if self.buffered_io:
+            self.buffered_io = any(type(node) is ast.CallCommand and
+                                   node.identifier in ('putint', 'getint')
+                                   for node in ast.iter_nodes(self.tree))
+        if self.buffered_io:
+            self.append_code((LOAD_CONST, runtime.embedded(runtime.buffered_io)))
+            self.append_code((MAKE_FUNCTION, 0))
+            self.append_code((CALL_FUNCTION, 0))
+            self.append_code((UNPACK_SEQUENCE, len(IO_GLOBALS)))
+            for name in IO_GLOBALS:
+                self.append_code((STORE_GLOBAL, name))
+
         self.gen_command(self.tree.command)
 
+        if self.buffered_io:
+            self.append_code((LOAD_GLOBAL, 'runtime.flush'))
+            self.append_code((CALL_FUNCTION, 0))
+            self.append_code((POP_TOP, None))
         self.append_code((LOAD_CONST, None))
         self.append_code((RETURN_VALUE, None))
         
-        func_code = self.pop_stack()
-        self.pop_env()
+        func_code = self.optimize_code(self.pop_stack(), 'gencode')
+        self.varnames.pop()
+        self.memo_tables.pop()
         
-        code_obj = Code(func_code, [], [], False, False, False, 'gencode', '', 0, '')
-        code = code_obj.to_code()
-        func = types.FunctionType(code, globals(), 'gencode')
+        code_obj = Code(func_code, [], [], False, False, False, 'gencode',
+                        self.filename, self.tree.command.line or 0, '')
+        with self.stats.phase('assemble'):
+            code = code_obj.to_code()
+            func = types.FunctionType(code, globals(), 'gencode')
         
         return func
         
+    def resolve(self):
+        """ resolve the names of the tree and choose the memoized functions,
+        once, before any code is generated
+        """
+        if self.resolved:
+            return
+        with self.stats.phase('resolve'):
+            resolver.resolve(self.tree)
+            if self.memo is not None:
+                self.memo.analyze(self.tree)
+        self.resolved = True
+
+    def function_code(self, tree):
+        """ the python code object of FunctionDeclaration tree of the
+        resolved tree, generated on its own
+        """
+        self.push_stack()
+        self.walk(tree)
+        # the binding starts by loading the Code object
+        op, code_obj = self.pop_stack()[0]
+        with self.stats.phase('assemble'):
+            return code_obj.to_code()
+
     def gen_command(self, tree):
-        """ given a general command and propagate to appropriate command func """
-        if type(tree) is ast.AssignCommand:
-            return self.gen_assign_command(tree)
-        elif type(tree) is ast.CallCommand:
-            return self.gen_call_command(tree)
-        elif type(tree) is ast.SequentialCommand:
-            return self.gen_seq_command(tree)
-        elif type(tree) is ast.IfCommand:
-            return self.gen_if_command(tree)
-        elif type(tree) is ast.WhileCommand:
-            return self.gen_while_command(tree)
-        elif type(tree) is ast.LetCommand:
-            return self.gen_let_command(tree)
-        elif type(tree) is ast.ReturnCommand:
-            return self.gen_return_command(tree)
-        else:
-            raise CodeGenError(tree, ast.Command)
+        """ generate bytecode for a general command """
+        self.walk(tree)
+
+    def gen_declaration(self, tree):
+        """ generate bytecode for a general decl """
+        self.walk(tree)
+
+    def gen_expression(self, tree):
+        """ generate bytecode for a general expr """
+        self.walk(tree)
+
+    def walk(self, tree):
+        """ generate bytecode for tree using an explicit work stack.
+
+        Items are popped in program order. An (opcode, arg) tuple is
+        appended to the current code stack, an ast node is replaced by the
+        work items its gen_* method returns, and any other item is a
+        callable run at that point (used for env and code stack changes).
+        No python recursion happens, so deep trees can't overflow the stack.
+        """
+        work = [tree]
+        pop = work.pop
+        extend = work.extend
+        generators = self.generators
+        while work:
+            item = pop()
+            if type(item) is tuple:
+                self.append_code(item)
+            elif isinstance(item, ast.AST):
+                gen = generators.get(type(item))
+                if gen is None:
+                    raise CodeGenError(item, ast.AST)
+                items = gen(item)
+                items.reverse()
+                extend(items)
+            else:
+                item()
+
+    def at_line(self, tree, items):
+        """ start items with a SetLineno for the source line of tree """
+        if tree.line is not None:
+            items.insert(0, (SetLineno, tree.line))
+        return items
 
     def gen_return_command(self, tree):
         """ generate bytecode fo a return command """
-        expr = self.gen_expression(tree.expression)
-        self.append_code((RETURN_VALUE, None))
+        if self.memo_tables[-1] is not None:
+            # store the result under the arguments, store() returns it
+            table, key = self.memo_tables[-1]
+            return self.at_line(tree, [tree.expression,
+                                       (LOAD_GLOBAL, table),
+                                       (LOAD_ATTR, 'store'),
+                                       (ROT_TWO, None),
+                                       (LOAD_FAST, key),
+                                       (CALL_FUNCTION, 2),
+                                       (RETURN_VALUE, None)])
+        return self.at_line(tree, [tree.expression, (RETURN_VALUE, None)])
+
+    def gen_var_declaration(self, tree):
+        """ given an ast.VarDeclaration node, initialise the var to None """
+        return [(LOAD_CONST, None), (STORE_FAST, self.local(tree.slot))]
+
+    def gen_const_declaration(self, tree):
+        """ given an ast.ConstDeclaration node, store its value """
+        return [tree.expression, (STORE_FAST, self.local(tree.slot))]
+
+    def gen_seq_declaration(self, tree):
+        """ given an ast.DeclarationList node, generate declarations. the
+        functions are bound first, so a const's value can call one that
+        calls a function declared after the const. function bodies can't
+        see the variables around them, so the order doesn't matter to them.
+        """
+        functions = [decl for decl in tree.declarations
+                     if type(decl) is ast.FunctionDeclaration]
+        return functions + [decl for decl in tree.declarations
+                            if type(decl) is not ast.FunctionDeclaration]
+
+    def gen_func_declaration(self, tree):
+        """ given an ast.FunctionDeclaration node, build a code object for
+        the function body and bind it to the function name
+        """
+        table = None
+        if self.memo is not None and self.memo.is_memoized(tree):
+            table = tree.global_name + '.memo'
+        if tree in self.compiled:
+            return self.bind_function(tree, self.compiled[tree], table)
 
-    def gen_declaration(self, tree):
-        """ given a general decl and propagate to appropriate decl func """
-        if type(tree) is ast.VarDeclaration:
-            curr_ident = self.add_to_env(tree.identifier)
-            self.append_code((LOAD_CONST, None))
-            self.append_code((STORE_FAST, curr_ident))
-        elif type(tree) is ast.ConstDeclaration:
-            curr_ident = self.add_to_env(tree.identifier)
-            self.gen_expression(tree.expression)
-            self.append_code((STORE_FAST, curr_ident))
-        elif type(tree) is ast.SequentialDeclaration:
-            self.gen_declaration(tree.decl1)
-            self.gen_declaration(tree.decl2)
-        elif type(tree) is ast.FunctionDeclaration:
-            self.push_stack()
-            self.push_env()
-            func_ident = tree.name
-
-            param = self.populate_param_list(tree.param)
-
-            # load params into current environment
-            for p in param:
-                self.add_to_env(p)
-
-            self.gen_command(tree.command)
-
-            func_code = self.pop_stack()
-            self.pop_env()
-            
-            code_obj = Code(func_code, [], param, False, False, False, 'gencode', '', 0, '')
-            self.append_code((LOAD_CONST, code_obj))
-            self.append_code((MAKE_FUNCTION, 0))
-            self.append_code((STORE_FAST, func_ident))
+        self.push_stack()
+        self.varnames.append(tree.varnames)
+        func_ident = tree.name
 
-    def populate_param_list(self, tree):
-        """ recursively go through param/SequentialParameter to build list of param names """
-        param_list = []
-        self.populate_param_list_recur(tree, param_list)
-        return param_list
+        # the parameters are the first slots
+        param = tree.varnames[:len(self.populate_param_list(tree.param))]
+
+        items = [tree.command, None]
+        if table is not None:
+            items[:0] = self.memo_lookup(tree, table)
+        self.memo_tables.append(table and (table, tree.varnames[-1]))
+
+        def finish_function():
+            func_code = self.optimize_code(self.pop_stack(), func_ident)
+            self.varnames.pop()
+            self.memo_tables.pop()
+
+            code_obj = Code(func_code, [], param, False, False, False,
+                            func_ident, self.filename, tree.line or 0, '')
+            for item in self.bind_function(tree, code_obj, table):
+                self.append_code(item)
 
-    def populate_param_list_recur(self, tree, param_list):
-        """ helper method for populate_param_list """
+        items[-1] = finish_function
+        return items
+
+    def bind_function(self, tree, code_obj, table):
+        """ the code binding the function of FunctionDeclaration tree, made
+        from Code or code object code_obj, and its memo table if it has one
+        """
+        # functions are globals, so other functions can call them
+        items = [(LOAD_CONST, code_obj),
+                 (MAKE_FUNCTION, 0),
+                 (STORE_GLOBAL, tree.global_name)]
+        if table is not None:
+            items.append((LOAD_GLOBAL, MEMO_TABLE))
+            for arg in (tree.name, self.memo.size, self.memo.policy,
+                        self.memo.typed, self.memo.report_counts):
+                items.append((LOAD_CONST, arg))
+            items.extend([(CALL_FUNCTION, 5), (STORE_GLOBAL, table)])
+        return items
+
+    def memo_lookup(self, tree, table):
+        """ the start of memoized function tree: return the result stored
+        in table for the arguments if there is one. the arguments are kept
+        in a new last slot, the body may assign the parameters.
+        """
+        params = len(self.populate_param_list(tree.param))
+        tree.varnames.append('memo.key')
+        key = tree.varnames[-1]
+        miss = Label()
+        return ([(LOAD_FAST, name) for name in tree.varnames[:params]] +
+                [(BUILD_TUPLE, params),
+                 (STORE_FAST, key),
+                 (LOAD_GLOBAL, table),
+                 (LOAD_ATTR, 'lookup'),
+                 (LOAD_FAST, key),
+                 (CALL_FUNCTION, 1),
+                 # lookup() returns the table itself when it has no result
+                 (DUP_TOP, None),
+                 (LOAD_GLOBAL, table),
+                 (COMPARE_OP, 'is'),
+                 (POP_JUMP_IF_TRUE, miss),
+                 (RETURN_VALUE, None),
+                 (miss, None),
+                 (POP_TOP, None)])
+
+    def populate_param_list(self, tree):
+        """ go through param/ParameterList to build list of param names """
         if type(tree) == ast.Parameter:
-            param_list.append(tree.argname)
-        elif type(tree) == ast.SequentialParameter:
-            self.populate_param_list_recur(tree.param1, param_list)
-            self.populate_param_list_recur(tree.param2, param_list)
+            return [tree.argname]
+        elif type(tree) == ast.ParameterList:
+            return [param.argname for param in tree.params]
         else:
-            raise CodeGenError(tree, [ast.Parameter, ast.SequentialParameter])
-
-    def gen_expression(self, tree):
-        """ given a general expr and propagate to appropriate expr func """
-        if type(tree) is ast.IntegerExpression:
-            self.append_code((LOAD_CONST, tree.value))
-        elif type(tree) is ast.VnameExpression:
-            curr_ident = self.get_from_env(tree.variable.identifier)
-            self.append_code((LOAD_FAST, curr_ident))
-        elif type(tree) is ast.UnaryExpression:
-            if tree.operator == '-':
-                return -(self.gen_expression(tree.expression))
-            elif tree.operator == '+':
-                return self.gen_expression(tree.expression)
-            else:
-                raise CodeGenError(tree, ['-', '+'])
-        elif type(tree) is ast.BinaryExpression:  
-            self.gen_expression(tree.expr1)
-            self.gen_expression(tree.expr2)
-
-            op = tree.oper
-            if op == '+':
-                self.append_code((BINARY_ADD, None))
-            elif op == '-':
-                self.append_code((BINARY_SUBTRACT, None))
-            elif op == '*':
-                self.append_code((BINARY_MULTIPLY, None))
-            elif op == '/':
-                self.append_code((BINARY_DIVIDE, None))
-            elif op == '>':
-                self.append_code((COMPARE_OP, '>'))
-            elif op == '<':
-                self.append_code((COMPARE_OP, '<'))
-            elif op == '=':
-                self.append_code((COMPARE_OP, '=='))
-            elif op == '\\':
-                self.append_code((BINARY_MODULO, 0))
-        elif type(tree) is ast.CallCommand:
-            self.gen_call_command(tree)
-        elif type(tree) is ast.SequentialParameter:
-            self.gen_param(tree)
+            raise CodeGenError(tree, [ast.Parameter, ast.ParameterList])
+
+    def gen_integer_expression(self, tree):
+        """ given an ast.IntegerExpression node, load the constant """
+        return [(LOAD_CONST, tree.value)]
+
+    def gen_vname_expression(self, tree):
+        """ given an ast.VnameExpression node, load the variable """
+        return [(LOAD_FAST, self.local(tree.variable.slot))]
+
+    def gen_unary_expression(self, tree):
+        """ given an ast.UnaryExpression node, apply operator to the operand """
+        if tree.operator == '+':
+            return [tree.expression]
+        elif tree.operator == '-':
+            return [tree.expression, (UNARY_NEGATIVE, None)]
         else:
-            raise CodeGenError(tree, ast.Expression)
+            raise CodeGenError(tree, ['-', '+'])
+
+    def gen_binary_expression(self, tree):
+        """ given an ast.BinaryExpression node, apply oper to both operands """
+        if tree.oper not in BINARY_OPS:
+            raise CodeGenError(tree, BINARY_OPS.keys())
+        return [tree.expr1, tree.expr2, BINARY_OPS[tree.oper]]
 
     def gen_assign_command(self, tree):
         """ given an ast.AssignCommand node, assign expr to ident """
-        curr_ident = self.get_from_env(tree.variable.identifier)
-        self.gen_expression(tree.expression)
-        self.append_code((STORE_FAST, curr_ident))
+        return self.at_line(tree, [tree.expression,
+                                   (STORE_FAST, self.local(tree.variable.slot))])
 
     def gen_call_command(self, tree):
         """ given an ast.CallCommand node, call function """
         func = tree.identifier
         if func == 'putint':
-            self.gen_expression(tree.expression.argname)
-            self.append_code((PRINT_ITEM, None))
-            self.append_code((PRINT_NEWLINE, None))
+            arg = tree.expression.params[0].argname
+            if self.buffered_io:
+                # the line print would write, '%s' formats like str()
+                return self.at_line(tree, [(LOAD_GLOBAL, 'runtime.write'),
+                                           (LOAD_CONST, '%s\n'),
+                                           arg,
+                                           (BINARY_MODULO, None),
+                                           (CALL_FUNCTION, 1),
+                                           (POP_TOP, None)])
+            return self.at_line(tree, [arg, (PRINT_ITEM, None),
+                                       (PRINT_NEWLINE, None)])
         elif func == 'getint': # and type(tree.expression) is ast.VnameExpression:
-            self.gen_expression(tree.expression.argname)
-            curr_ident = self.get_from_env(tree.expression.argname.variable.identifier)
-            self.append_code((LOAD_GLOBAL, 'input'))
-            self.append_code((CALL_FUNCTION, 0))
-            self.append_code((STORE_FAST, curr_ident))
+            arg = tree.expression.params[0].argname
+            curr_ident = self.local(arg.variable.slot)
+            read = 'runtime.getint' if self.buffered_io else 'input'
+            return self.at_line(tree, [(LOAD_GLOBAL, read),
+                                       (CALL_FUNCTION, 0),
+                                       (STORE_FAST, curr_ident)])
         else:
-            self.append_code((LOAD_FAST, func))
-            num_params = self.gen_param(tree.expression)
-            self.append_code((CALL_FUNCTION, num_params))
+            num_params = len(self.populate_param_list(tree.expression))
+            return self.at_line(tree, [(LOAD_GLOBAL, tree.target),
+                                       tree.expression,
+                                       (CALL_FUNCTION, num_params)])
 
     def gen_param(self, tree):
-        """ recursively walk through params to get count """
-        num_params = 0
+        """ given an ast.Parameter/ParameterList node, push the args """
         if type(tree) == ast.Parameter:
-            p1 = self.gen_expression(tree.argname)
-            num_params = num_params + 1
-        elif type(tree) == ast.SequentialParameter:
-            tmp_count_1 = self.gen_param(tree.param1)
-            tmp_count_2 = self.gen_param(tree.param2)
-            num_params = num_params + tmp_count_1 + tmp_count_2
+            return [tree.argname]
+        elif type(tree) == ast.ParameterList:
+            return [param.argname for param in tree.params]
         else:
-            raise CodeGenError(tree, [ast.Parameter, ast.SequentialParameter])
-    
-        return num_params
+            raise CodeGenError(tree, [ast.Parameter, ast.ParameterList])
 
     def gen_seq_command(self, tree):
-        """ given an ast.SequentialCommand node, generate commands """
-        self.gen_command(tree.command1)
-        self.gen_command(tree.command2)
+        """ given an ast.CommandList node, generate commands """
+        return list(tree.commands)
 
     def gen_if_command(self, tree):
         """ append appropriate bytecode for ast.IfCommand """
         else_command = Label()
         exit_command = Label()
-        # if expression
-        self.gen_expression(tree.expression)
-        self.append_code((POP_JUMP_IF_FALSE, else_command))
-        # then command1
-        self.gen_command(tree.command1)
-        self.append_code((JUMP_FORWARD, exit_command))
-        # else command2
-        self.append_code((else_command, None))
-        self.gen_command(tree.command2)
-        self.append_code((exit_command, None))
+        return self.at_line(tree, [
+            # if expression
+            tree.expression,
+            (POP_JUMP_IF_FALSE, else_command),
+            # then command1
+            tree.command1,
+            (JUMP_FORWARD, exit_command),
+            # else command2
+            (else_command, None),
+            tree.command2,
+            (exit_command, None)])
 
     def gen_while_command(self, tree):
         """ append appropriate bytecode for ast.WhileCommand """
         start_while_loop = Label()
         exit_while_loop  = Label()
-     
-        # top of while loop
-        self.append_code((start_while_loop, None))
-        # check condition
-        self.gen_expression(tree.expression)
-        self.append_code((POP_JUMP_IF_FALSE, exit_while_loop))
-        # if condition is true, continue to body of while
-        self.gen_command(tree.command)
-        self.append_code((JUMP_ABSOLUTE, start_while_loop))
-        # if condition is false, exit while loop
-        self.append_code((exit_while_loop, None))
+        return self.at_line(tree, [
+            # top of while loop
+            (start_while_loop, None),
+            # check condition
+            tree.expression,
+            (POP_JUMP_IF_FALSE, exit_while_loop),
+            # if condition is true, continue to body of while
+            tree.command,
+            (JUMP_ABSOLUTE, start_while_loop),
+            # if condition is false, exit while loop
+            (exit_while_loop, None)])
 
     def gen_let_command(self, tree):
         """ append appropriate bytecode for ast.LetCommand """
-        self.gen_declaration(tree.declaration)
-        self.gen_command(tree.command)
-        self.clean_up_env()
+        return self.at_line(tree, [tree.declaration, tree.command])
+
+    def optimize_code(self, code, name):
+        """ run the code passes over the finished code list of function name """
+        code = increasing_lines(code)
+        with self.stats.phase('code_passes'):
+            for code_pass in self.code_passes:
+                code = code_pass.optimize(code, name)
+        self.stats.count_instructions(name, code)
+        return code
 
     def push_stack(self):
         """ push a stack (list) onto self.code """
@@ -269,55 +497,9 @@ class CodeGen(object):
         index = len(self.code) - 1
         self.code[index].append(bytecode)
 
-    def push_env(self):
-        """ push an env (let and func decl pushes an env) """
-        self.env.append({})
-
-    def pop_env(self):
-        """ when done with env, pop env """
-        return self.env.pop()
-
-    def add_to_env(self, ident):
-        """ given an ident, modify ident if already exists. 
-        return ident added to env
-        """
-        index = len(self.env) - 1
-        curr_env = self.env[index]
-
-        if ident in curr_env:
-            # rename ident to identSCOPE_COUNT
-            self.scope_count = self.scope_count + 1
-            new_ident = ident + str(self.scope_count)
-            curr_env[ident].append(new_ident)
-            return new_ident
-        else:
-            curr_env[ident] = [ident]
-            return ident
-
-    def get_from_env(self, ident):
-        """ self.env = {ident:[ident,ident1,...,identSCOPE_COUNT]}
-        given an ident, return the last item is the list it maps to
-        """
-        index = len(self.env) - 1
-        curr_env = self.env[index]
-        
-        if curr_env.has_key(ident):
-            index = len(curr_env[ident]) - 1
-            return curr_env[ident][index] 
-        else:   
-            pass # variable doesn't exist
-
-    def clean_up_env(self):
-        """ we know current scope, remove last elems that end w/ curr scope """
-        index = len(self.env) - 1
-        curr_env = self.env[index]
-        
-        for item in curr_env:
-            curr_scope = curr_env[item]
-            last_i = len(curr_scope)-1
-            if curr_scope[last_i].endswith(str(self.scope_count)):
-                curr_scope.pop()
-        self.scope_count = self.scope_count-1
+    def local(self, slot):
+        """ name of local slot of the code object being generated """
+        return self.varnames[-1][slot]
 
 
 def get_prog_from_file(input_file):
@@ -326,43 +508,351 @@ def get_prog_from_file(input_file):
         content = f.read()
     return content
 
+def map_prog_from_file(input_file):
+    """ map the file read only and return the mmap, which the scanner
+    scans in place, so the source isn't copied into memory. the caller
+    closes it, which also closes the mmap's own file descriptor. files
+    that can't be mapped, empty ones or pipes, are read into a string.
+    """
+    with open(input_file, 'r') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            return f.read()
+
+def option_parser():
+    """ the command line options of the compiler """
+    usage = ("Usage: codegen.py [options] <mini_triangle_source.mt>\n"
+             "       codegen.py [options] -j N <file|directory|glob>... "
+             "[--manifest FILE]")
+    opts = optparse.OptionParser(usage=usage)
+    opts.add_option('--stream', action='store_true', default=False,
+                    help='parse tokens as the source is read')
+    opts.add_option('-O', dest='opt_level', type='int', default=1,
+                    help='0 disables all optimizations (default 1)')
+    opts.add_option('--peephole', default=','.join(peephole.RULE_NAMES),
+                    help='comma separated peephole rules to enable, '
+                         'from: %s' % ', '.join(peephole.RULE_NAMES))
+    opts.add_option('--peephole-stats', action='store_true', default=False,
+                    help='print how often each peephole rule fired')
+    opts.add_option('--deadcode-stats', action='store_true', default=False,
+                    help='print the bytecode size dead code elimination '
+                         'saved per function')
+    opts.add_option('--inline-size', type='int',
+                    default=inliner.DEFAULT_MAX_SIZE,
+                    help='inline functions whose body has at most this many '
+                         'ast nodes, 0 disables inlining (default %default)')
+    opts.add_option('--inline-stats', action='store_true', default=False,
+                    help='print the call sites each function was inlined at')
+    opts.add_option('--tailcall-stats', action='store_true', default=False,
+                    help='print the functions whose tail calls became loops')
+    opts.add_option('--simplify', default=','.join(simplify.RULE_NAMES),
+                    help='comma separated algebraic simplification rules to '
+                         'enable, from: %s' % ', '.join(simplify.RULE_NAMES))
+    opts.add_option('--simplify-stats', action='store_true', default=False,
+                    help='print how often each simplification rule fired')
+    opts.add_option('--no-licm', dest='licm', action='store_false',
+                    default=True,
+                    help='keep loop invariant expressions inside loops')
+    opts.add_option('--licm-stats', action='store_true', default=False,
+                    help='print the expressions moved out of each loop')
+    opts.add_option('--memo-size', type='int', default=memo.DEFAULT_SIZE,
+                    help='results kept per memoized pure function, 0 '
+                         'disables memoization (default %default)')
+    opts.add_option('--memo-policy', default='lru', choices=memo.POLICIES,
+                    help='result a full memo table drops: lru or fifo '
+                         '(default %default)')
+    opts.add_option('--memo-stats', action='store_true', default=False,
+                    help='print the functions memoized, or why not')
+    opts.add_option('--memo-report', action='store_true', default=False,
+                    help='make the program print the hits and misses of '
+                         'each memo table to stderr at exit')
+    opts.add_option('--no-buffered-io', dest='buffered_io',
+                    action='store_false', default=True,
+                    help='compile getint to input() and putint to print, '
+                         'instead of the buffered runtime functions')
+    opts.add_option('--stats', action='store_true', default=False,
+                    help='print the time and memory of each compiler phase, '
+                         'token and ast node counts and instructions per '
+                         'function as json')
+    opts.add_option('--ast-cache', action='store_true', default=False,
+                    help='keep the tokens and ast of each source in a %s '
+                         'file next to it, and load the ast from there while '
+                         'the source is unchanged' % cache.AST_SUFFIX)
+    opts.add_option('--no-cache', dest='cache', action='store_false',
+                    default=True, help='always compile, bypassing the cache')
+    opts.add_option('--cache-dir', default=cache.DEFAULT_CACHE_DIR,
+                    help='compile cache directory (default %default)')
+    opts.add_option('--cache-size', type='int',
+                    default=cache.DEFAULT_MAX_BYTES / (1024 * 1024),
+                    help='compile cache size limit in MB (default %default)')
+    opts.add_option('-j', '--jobs', type='int', default=0,
+                    help='worker processes for batch compiles '
+                         '(default one per cpu)')
+    opts.add_option('--function-jobs', type='int', default=0,
+                    help='worker processes parsing and generating the top '
+                         'level functions of a single source, 0 compiles '
+                         'it in one process (default %default)')
+    opts.add_option('--manifest',
+                    help='file listing sources to compile, one per line')
+    return opts
+
 def check_args():
-    """ checks to make sure correct num args and file format are provided"""
-    if (len(sys.argv) != 2 or not sys.argv[1].endswith(".mt")):
-        print "Usage: codegen.py <mini_triangle_source.mt>"
+    """ checks to make sure correct num args and file format are provided.
+    returns the source files to compile and the parsed options. options.batch
+    is set when the arguments name more than a single .mt file.
+    """
+    opts = option_parser()
+    options, args = opts.parse_args()
+    for rule in options.peephole.split(','):
+        if rule and rule not in peephole.RULE_NAMES:
+            opts.error('unknown peephole rule %s' % rule)
+    for rule in options.simplify.split(','):
+        if rule and rule not in simplify.RULE_NAMES:
+            opts.error('unknown simplify rule %s' % rule)
+    options.batch = (options.manifest is not None or len(args) != 1 or
+                     not (args[0].endswith(".mt") and os.path.isfile(args[0])))
+    if not options.batch:
+        return args, options
+    if not args and options.manifest is None:
+        print opts.get_usage()
         exit(0)
-
-def write_pyc_file(code, f):
-    """ writes a pyc file. format: magic number, timestamp, compiled bytecode """
+    try:
+        sources = batch.find_sources(args, options.manifest)
+    except IOError as e:
+        opts.error(str(e))
+    if not sources:
+        opts.error('no .mt files found')
+    return sources, options
+
+def option_flags(options):
+    """ string of the options that change the generated code """
+    if options.opt_level <= 0:
+        return 'O0 io=%d' % options.buffered_io
+    rules = options.peephole.split(',')
+    rules = [rule for rule in peephole.RULE_NAMES if rule in rules]
+    simplify_rules = options.simplify.split(',')
+    simplify_rules = [rule for rule in simplify.RULE_NAMES if rule in simplify_rules]
+    return ('O%d peephole=%s simplify=%s inline=%d licm=%d memo=%d,%s,%d io=%d' % (
+        options.opt_level, ','.join(rules), ','.join(simplify_rules),
+        max(options.inline_size, 0), options.licm, max(options.memo_size, 0),
+        options.memo_policy, options.memo_report, options.buffered_io))
+
+def source_timestamp(f):
+    """ timestamp for the pyc header: SOURCE_DATE_EPOCH if set, otherwise
+    the source file's mtime, so the same source gives the same pyc
+    """
+    if 'SOURCE_DATE_EPOCH' in os.environ:
+        return int(os.environ['SOURCE_DATE_EPOCH'])
+    return int(os.stat(f).st_mtime)
+
+def write_pyc_data(data, f):
+    """ writes a pyc file from already marshalled code.
+    format: magic number, timestamp, compiled bytecode
+    """
     pyc_file = os.path.splitext(f)[0] + '.pyc'
     with open(pyc_file, 'wb') as pyc_f:
         magic = int(imp.get_magic().encode('hex'), 16)        
         pyc_f.write(struct.pack(">L", magic))
-        pyc_f.write(struct.pack(">L", time.time()))
-        marshal.dump(code.func_code, pyc_f)
+        pyc_f.write(struct.pack(">L", source_timestamp(f) & 0xffffffff))
+        pyc_f.write(data)
+
+def write_pyc_file(code, f):
+    """ writes a pyc file. format: magic number, timestamp, compiled bytecode """
+    write_pyc_data(marshal.dumps(code.func_code), f)
+
+
+def parse_source(prog, stats=instrument.NULL_STATS, ast_cache=None,
+                 path=None, jobs=0):
+    """ scan and parse a whole program. with a cache.AstCache, the tree is
+    loaded from the cache file of source file path when it matches prog,
+    and stored there when it doesn't. jobs > 0 parses the top level
+    declarations over that many processes.
+    """
+    if ast_cache is not None:
+        with stats.phase('load_ast'):
+            tree = ast_cache.load_tree(path, prog)
+        if tree is not None:
+            stats.count_nodes(tree)
+            return tree
+    with stats.phase('scan'):
+        tokens = scanner.Scanner(prog).scan()
+        line_map = scanner.LineMap(prog)
+    stats.tokens = len(tokens)
+    with stats.phase('parse'):
+        tree = None
+        if jobs > 0:
+            tree = parallel.parse_tokens(tokens, line_map, jobs)
+        if tree is None:
+            tree = parser.Parser(tokens, line_map).parse()
+    if ast_cache is not None:
+        with stats.phase('store_ast'):
+            ast_cache.store(path, prog, tokens, tree)
+    stats.count_nodes(tree)
+    return tree
+
+
+def parse_stream(input_file, stats=instrument.NULL_STATS):
+    """ scan and parse input_file together, tokens are parsed as they are
+    read. works on pipes as well as regular files.
+    """
+    with stats.phase('scan_parse'):
+        with open(input_file, 'r') as f:
+            stream = scanner.StreamScanner(f)
+            tree = parser.Parser(stream.iter_tokens(), stream.line_map).parse()
+    stats.count_nodes(tree)
+    return tree
+
+
+def make_code_passes(options):
+    """ new code passes for the optimization options """
+    rules = [r for r in options.peephole.split(',') if r]
+    return [deadcode.DeadCodeEliminator(), peephole.Peephole(rules)]
+
+
+def compile_tree(tree, options, stats=instrument.NULL_STATS, filename=''):
+    """ run the optimization passes the options ask for and generate code
+    for tree. returns the code object and the stats lines the options
+    asked for. filename is recorded in the code objects.
+    """
+    code_passes = []
+    memo_obj = None
+    if options.opt_level > 0:
+        with stats.phase('optimize'):
+            tailcall_obj = tailcall.TailCalls()
+            tree = tailcall_obj.eliminate(tree)
+            # inline before folding, so constant arguments fold into the copies
+            inliner_obj = inliner.Inliner(options.inline_size)
+            tree = inliner_obj.inline(tree)
+            tree = optimizer.fold_constants(tree)
+            simplify_obj = simplify.Simplifier(
+                [r for r in options.simplify.split(',') if r])
+            tree = simplify_obj.simplify(tree)
+            # after folding, so folded constants aren't moved into consts
+            licm_obj = licm.LoopInvariants()
+            if options.licm:
+                tree = licm_obj.hoist(tree)
+        code_passes = make_code_passes(options)
+        deadcode_obj, peephole_obj = code_passes
+        memo_obj = memo.Memoizer(options.memo_size, options.memo_policy,
+                                 options.memo_report)
+
+    with stats.phase('codegen'):
+        c = CodeGen(tree, code_passes, stats, filename, memo_obj,
+                    options.buffered_io)
+        if options.function_jobs > 0:
+            parallel.generate_functions(
+                c, lambda: make_code_passes(options) if code_passes else [],
+                options.function_jobs)
+        code = c.generate().func_code
+
+    lines = []
+    if options.opt_level > 0:
+        if options.tailcall_stats:
+            lines.extend(tailcall_obj.report())
+        if options.inline_stats:
+            lines.extend(inliner_obj.report())
+        if options.simplify_stats:
+            lines.extend(simplify_obj.report())
+        if options.licm_stats:
+            lines.extend(licm_obj.report())
+        if options.memo_stats:
+            lines.extend(memo_obj.report())
+        if options.deadcode_stats:
+            lines.extend(deadcode_obj.report())
+        if options.peephole_stats:
+            lines.extend(peephole_obj.report())
+    return code, lines
+
+
+def compile_source(text, options=None, stats=instrument.NULL_STATS,
+                   filename='<string>'):
+    """ compile mini triangle source text to a python code object, without
+    touching the disk. options defaults to the command line defaults, pass
+    an instrument.CompileStats as stats to measure the compile. filename
+    is what tracebacks and profilers show as the source file.
+    scanner, parser and resolver errors are raised to the caller.
+    """
+    if options is None:
+        options = option_parser().get_default_values()
+    code, lines = compile_tree(parse_source(text, stats), options, stats,
+                               filename)
+    return code
+
+
+def compile_file(f, options, compile_cache=None):
+    """ compile the source file f to its pyc file.
+    returns the stats lines the options asked for, --stats adds a line of
+    json. scanner, parser and resolver errors are raised to the caller.
+    """
+    stats = instrument.NULL_STATS
+    if options.stats:
+        stats = instrument.CompileStats()
+    data = None
+    key = None
+    if options.stream:
+        tree = parse_stream(f, stats)
+    else:
+        with stats.phase('read'):
+            prog = map_prog_from_file(f)
+        try:
+            if compile_cache is not None:
+                # the file name is part of the code, so part of the key
+                key = compile_cache.key(prog, '%s file=%s' % (option_flags(options), f))
+                # stats need a real compile, so only store in that case
+                if not (options.deadcode_stats or options.peephole_stats or
+                        options.inline_stats or options.tailcall_stats or
+                        options.simplify_stats or options.licm_stats or
+                        options.memo_stats or options.stats):
+                    data = compile_cache.get(key)
+            if data is None:
+                ast_cache = None
+                if options.ast_cache:
+                    ast_cache = cache.AstCache()
+                tree = parse_source(prog, stats, ast_cache, f,
+                                    options.function_jobs)
+        finally:
+            # the tree holds copies of the source text, not the mapping
+            if isinstance(prog, mmap.mmap):
+                prog.close()
+
+    lines = []
+    if data is None:
+        code, lines = compile_tree(tree, options, stats, f)
+        with stats.phase('marshal'):
+            data = marshal.dumps(code)
+        if key is not None:
+            compile_cache.put(key, data)
+
+    with stats.phase('write'):
+        write_pyc_data(data, f)
+    if options.stats:
+        lines.append(json.dumps(stats.as_dict(), sort_keys=True))
+    return lines
+
+
+def open_cache(options):
+    """ the CompileCache the options ask for, or None """
+    # The cache is keyed on the whole source text, so it isn't used when
+    # streaming.
+    if options.cache and not options.stream:
+        return cache.CompileCache(options.cache_dir,
+                                  options.cache_size * 1024 * 1024)
+    return None
 
 
 if __name__ == '__main__':
-    check_args()
-    f = sys.argv[1]
-    prog = get_prog_from_file(f)
-    
-    scanner_obj = scanner.Scanner(prog)
-        
-    try:
-        tokens = scanner_obj.scan()
-    except scanner.ScannerError as e:
-        print e
-        sys.exit(0)
+    sources, options = check_args()
 
-    parser_obj = parser.Parser(tokens)
+    if options.batch:
+        failures = batch.compile_batch(sources, options, options.jobs)
+        sys.exit(1 if failures else 0)
 
     try:
-        tree = parser_obj.parse()
-    except parser.ParserError as e:
+        lines = compile_file(sources[0], options, open_cache(options))
+    except (scanner.ScannerError, parser.ParserError,
+            resolver.ResolveError) as e:
         print e
         sys.exit(0)
-
-    c = CodeGen(tree)
-    bytecode = c.generate()
-    write_pyc_file(bytecode, f)
\ No newline at end of file
+    if lines:
+        print '\n'.join(lines)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# Control flow aware dead code elimination for the (opcode, arg) lists built
+# by CodeGen
+
+import opcode
+
+from byteplay import *
+
+import peephole
+
+
+def code_size(code):
+    """ size in bytes of the bytecode code assembles to """
+    size = 0
+    for op, arg in code:
+        if not peephole.is_pseudo(op):
+            if op >= opcode.HAVE_ARGUMENT:
+                size += 3
+            else:
+                size += 1
+    return size
+
+
+def build_blocks(code):
+    """ split code into basic blocks.
+
+    A block starts at a label and ends after a jump or return. Returns the
+    list of blocks (each a list of (op, arg)) and a map from each label to
+    the index of the block it starts.
+    """
+    blocks = [[]]
+    block_of = {}
+    started = False     # does the current block hold an instruction yet?
+    for op, arg in code:
+        if peephole.is_label(op):
+            if started:
+                blocks.append([])
+                started = False
+            block_of[op] = len(blocks) - 1
+        elif op is not SetLineno:
+            started = True
+        blocks[-1].append((op, arg))
+        if op in peephole.JUMPS or op == RETURN_VALUE:
+            blocks.append([])
+            started = False
+    return blocks, block_of
+
+
+def successors(blocks, block_of, i):
+    """ indexes of the blocks control can pass to from the end of block i """
+    last = None
+    for op, arg in blocks[i]:
+        if not peephole.is_pseudo(op):
+            last = (op, arg)
+    if last is not None:
+        op, arg = last
+        if op == RETURN_VALUE:
+            return []
+        if op in peephole.UNCONDITIONAL_JUMPS:
+            return [block_of[arg]]
+        if op in peephole.CONDITIONAL_JUMPS:
+            return [block_of[arg], i + 1]
+    if i + 1 < len(blocks):
+        return [i + 1]
+    return []
+
+
+def fold_branches(code):
+    """ LOAD_CONST c; POP_JUMP_IF_FALSE/TRUE L becomes JUMP_ABSOLUTE L when
+    the jump is always taken, and disappears when it never is.
+    return the new code and the number of branches folded.
+    """
+    out = []
+    folded = 0
+    i = 0
+    while i < len(code):
+        op, arg = code[i]
+        if (op == LOAD_CONST and i + 1 < len(code) and
+                code[i + 1][0] in peephole.CONDITIONAL_JUMPS):
+            jump, target = code[i + 1]
+            taken = bool(arg) == (jump == POP_JUMP_IF_TRUE)
+            if taken:
+                out.append((JUMP_ABSOLUTE, target))
+            folded += 1
+            i += 2
+            continue
+        out.append((op, arg))
+        i += 1
+    return out, folded
+
+
+def remove_unreachable(code):
+    """ drop every basic block that can't be reached from the entry """
+    blocks, block_of = build_blocks(code)
+    reachable = set([0])
+    work = [0]
+    while work:
+        i = work.pop()
+        for j in successors(blocks, block_of, i):
+            if j not in reachable:
+                reachable.add(j)
+                work.append(j)
+    out = []
+    for i, block in enumerate(blocks):
+        if i in reachable:
+            out.extend(block)
+    return out
+
+
+class DeadCodeEliminator(object):
+    """ Fold constant conditional branches and remove unreachable blocks.
+
+        savings: one (function name, size before, size after, branches
+                 folded) entry per code list optimized, sizes in bytes.
+    """
+
+    def __init__(self):
+        self.savings = []
+
+    def optimize(self, code, name=None):
+        """ return code without dead branches and unreachable blocks """
+        before = code_size(code)
+        code, folded = fold_branches(code)
+        code = remove_unreachable(code)
+        self.savings.append((name, before, code_size(code), folded))
+        return code
+
+    def merge(self, other):
+        """ add the savings of other, which optimized the code lists after
+        this one's
+        """
+        self.savings.extend(other.savings)
+
+    def report(self):
+        """ return the bytecode size saved per function as printable lines """
+        lines = []
+        for name, before, after, folded in self.savings:
+            lines.append('%-14s %5d -> %5d bytes, %d saved, %d branches folded' %
+                         (name, before, after, before - after, folded))
+        return lines
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+#
+# Function inlining pass for the mini triangle language. Replaces calls to
+# small, non recursive functions with a copy of the function body, saving
+# the call and the new frame.
+
+import ast
+import optimizer
+
+# largest function body, in AST nodes, that is inlined
+DEFAULT_MAX_SIZE = 24
+
+
+def tree_size(tree):
+    """ number of ast nodes in tree """
+    return sum(1 for node in ast.iter_nodes(tree))
+
+
+def is_user_call(tree):
+    """ True if tree is a call of a user function, not putint or getint """
+    return (type(tree) is ast.CallCommand and
+            tree.identifier not in ('putint', 'getint'))
+
+
+def param_names(tree):
+    """ the parameter names of the FunctionDeclaration tree """
+    if type(tree.param) is ast.ParameterList:
+        return [param.argname for param in tree.param.params]
+    return [tree.param.argname]
+
+
+def putint_command(expression):
+    """ a call of putint printing expression """
+    return ast.CallCommand('putint',
+                           ast.ParameterList([ast.Parameter(expression, None)]))
+
+
+def returns_in_tail(tree):
+    """ True if every path through command tree ends in a return, and no
+    return appears anywhere else, so each return can be replaced by the
+    command using its value.
+    """
+    kind = type(tree)
+    if kind is ast.ReturnCommand:
+        return True
+    elif kind is ast.CommandList:
+        if not tree.commands:
+            return False
+        for command in tree.commands[:-1]:
+            for node in ast.iter_nodes(command):
+                if type(node) is ast.ReturnCommand:
+                    return False
+        return returns_in_tail(tree.commands[-1])
+    elif kind is ast.IfCommand:
+        return returns_in_tail(tree.command1) and returns_in_tail(tree.command2)
+    elif kind is ast.LetCommand:
+        return returns_in_tail(tree.command)
+    return False
+
+
+def copy_tree(tree, prefix):
+    """ copy of tree with every variable identifier prefixed by prefix.
+    call identifiers are kept, they name functions. command lines are
+    dropped, so the copy runs under the line of the call it replaces.
+    """
+    # only used on bodies of at most max_size nodes, so recursion is fine
+    if isinstance(tree, list):
+        return [copy_tree(item, prefix) for item in tree]
+    if not isinstance(tree, ast.AST):
+        return tree
+    kind = type(tree)
+    node = kind.__new__(kind)
+    for name in kind.__slots__:
+        setattr(node, name, copy_tree(getattr(tree, name), prefix))
+    if kind is ast.Vname or kind is ast.VarDeclaration or kind is ast.ConstDeclaration:
+        node.identifier = prefix + tree.identifier
+    if 'line' in kind.__slots__:
+        node.line = None
+    return node
+
+
+def replace_returns(tree, make):
+    """ replace each return in tail position of command tree by the command
+    make(expression) builds. returns the new command.
+    """
+    kind = type(tree)
+    if kind is ast.ReturnCommand:
+        return make(tree.expression)
+    elif kind is ast.CommandList:
+        tree.commands[-1] = replace_returns(tree.commands[-1], make)
+    elif kind is ast.IfCommand:
+        tree.command1 = replace_returns(tree.command1, make)
+        tree.command2 = replace_returns(tree.command2, make)
+    elif kind is ast.LetCommand:
+        tree.command = replace_returns(tree.command, make)
+    return tree
+
+
+class FunctionInfo(object):
+    """ What the Inliner knows about one FunctionDeclaration.
+
+        calls: (identifier, FunctionDeclaration) of every call left in the
+               body, the function each name has to mean at a call site
+        reason: why the function isn't inlined, None if it is
+        sites: lines of the call sites it was inlined at
+    """
+
+    def __init__(self, decl, calls):
+        self.decl = decl
+        self.calls = calls
+        self.reason = None
+        self.sites = []
+
+
+class Inliner(optimizer.Rewriter):
+    """ Inline calls to small non recursive functions.
+
+        A call is inlined where it is the whole expression of an assignment,
+        a return or a putint. The call becomes a let binding a fresh const
+        to each argument, around a copy of the body in which every return
+        is replaced by the command using the returned value:
+
+            x := f(a, b)   =>   let const f.1.p ~ a; const f.1.q ~ b
+                                in <body, return e replaced by x := e>
+
+        Parameters and locals of the copy get the unique prefix 'f.N.',
+        which no source identifier can have, so they can't capture or
+        shadow the caller's names. A function is inlined if its body has at
+        most max_size nodes, declares no functions, only returns in tail
+        position and can't reach itself through calls. The functions its
+        body calls must mean the same at the call site. The declaration is
+        kept, calls that aren't inlined still use it.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        # each scope maps an identifier to its FunctionDeclaration, or to
+        # None when it is a variable. functions are visible across function
+        # bodies, so lookups go through every scope.
+        self.scopes = [{}]
+        # calls made by the functions being rewritten, innermost last. the
+        # program body is the first entry.
+        self.calls = [set()]
+        self.info = {}
+        self.functions = []
+        self.count = 0
+
+    def inline(self, tree):
+        if self.max_size <= 0:
+            return tree
+        return self.rewrite(tree)
+
+    def lookup(self, ident):
+        """ the FunctionDeclaration ident means here, None for a variable """
+        for names in reversed(self.scopes):
+            if ident in names:
+                return names[ident]
+        return None
+
+    def enter(self, node):
+        kind = type(node)
+        if kind is ast.LetCommand:
+            self.scopes.append({})
+        elif kind is ast.DeclarationList:
+            # bound before any body, so functions can call each other
+            for decl in node.declarations:
+                if type(decl) is ast.FunctionDeclaration:
+                    self.scopes[-1][decl.name] = decl
+        elif kind is ast.FunctionDeclaration:
+            # bound again, past a var or const of the same name
+            self.scopes[-1][node.name] = node
+            self.scopes.append(dict.fromkeys(param_names(node)))
+            self.calls.append(set())
+
+    def leave(self, node):
+        kind = type(node)
+        if kind is ast.LetCommand:
+            self.scopes.pop()
+        elif kind is ast.FunctionDeclaration:
+            self.scopes.pop()
+            self.finish_function(node, self.calls.pop())
+        elif kind is ast.VarDeclaration or kind is ast.ConstDeclaration:
+            self.scopes[-1][node.identifier] = None
+        elif kind is ast.CallCommand:
+            if is_user_call(node):
+                decl = self.lookup(node.identifier)
+                if decl is not None:
+                    self.calls[-1].add((node.identifier, decl))
+            elif (node.identifier == 'putint' and
+                  is_user_call(node.expression.params[0].argname)):
+                return self.inline_call(node, node.expression.params[0].argname,
+                                        putint_command)
+        elif kind is ast.AssignCommand:
+            if is_user_call(node.expression):
+                ident = node.variable.identifier
+                return self.inline_call(node, node.expression,
+                                        lambda e: ast.AssignCommand(ast.Vname(ident), e))
+        elif kind is ast.ReturnCommand:
+            if is_user_call(node.expression):
+                return self.inline_call(node, node.expression, ast.ReturnCommand)
+        return node
+
+    def finish_function(self, decl, calls):
+        info = FunctionInfo(decl, calls)
+        self.info[decl] = info
+        self.functions.append(info)
+        size = tree_size(decl.command)
+        if any(type(node) is ast.FunctionDeclaration
+               for node in ast.iter_nodes(decl.command)):
+            info.reason = 'declares functions'
+        elif self.is_recursive(decl):
+            info.reason = 'recursive'
+        elif not returns_in_tail(decl.command):
+            info.reason = 'return not in tail position'
+        elif size > self.max_size:
+            info.reason = 'too large (%d nodes)' % size
+
+    def is_recursive(self, decl):
+        """ True if decl can reach itself through the calls of its body.
+        a call of a function whose declaration isn't finished, one the
+        body is nested in, might lead back, so it counts as recursion.
+        """
+        seen = set()
+        work = [callee for ident, callee in self.info[decl].calls]
+        while work:
+            callee = work.pop()
+            if callee is decl or callee not in self.info:
+                return True
+            if callee not in seen:
+                seen.add(callee)
+                work.extend(c for ident, c in self.info[callee].calls)
+        return False
+
+    def inline_call(self, site, call, make):
+        """ the command replacing site, which uses the value of call through
+        the command make(expression) builds, or site if call can't be
+        inlined here
+        """
+        decl = self.lookup(call.identifier)
+        info = self.info.get(decl)
+        if info is None or info.reason is not None:
+            return site
+        params = param_names(decl)
+        args = [param.argname for param in call.expression.params]
+        if len(args) != len(params):
+            return site
+        for ident, callee in info.calls:
+            if self.lookup(ident) is not callee:
+                return site
+
+        self.count += 1
+        prefix = '%s.%d.' % (decl.name, self.count)
+        declarations = [ast.ConstDeclaration(prefix + param, arg)
+                        for param, arg in zip(params, args)]
+        body = replace_returns(copy_tree(decl.command, prefix), make)
+        info.sites.append(site.line)
+        self.calls[-1].update(info.calls)
+        return ast.LetCommand(ast.DeclarationList(declarations), body, site.line)
+
+    def report(self):
+        """ return the inlined call sites of each function as printable lines """
+        lines = []
+        for info in self.functions:
+            if info.sites:
+                sites = ', '.join('line %s' % line for line in info.sites)
+                lines.append('%-14s inlined at %s' % (info.decl.name, sites))
+            elif info.reason is not None:
+                lines.append('%-14s not inlined, %s' % (info.decl.name, info.reason))
+            else:
+                lines.append('%-14s no call site inlined' % info.decl.name)
+        return lines
+
+
+def inline_functions(tree, max_size=DEFAULT_MAX_SIZE):
+    """ run the Inliner pass over tree """
+    return Inliner(max_size).inline(tree)
+
+
+if __name__ == '__main__':
+    pass
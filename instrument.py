@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# Per phase instrumentation of a compile: wall time, memory, token and AST
+# node counts and instructions emitted per function.
+
+import collections
+import cProfile
+import pstats
+import resource
+import time
+
+import ast
+import peephole
+
+
+def peak_rss_kb():
+    """ peak resident set size of this process in KB (linux units) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Phase(object):
+    """ Context manager timing one phase of a CompileStats """
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats.start_phase(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.end_phase(self.name)
+        return False
+
+
+class CompileStats(object):
+    """ Measurements of one compile.
+
+        phases: phase name -> {'seconds', 'peak_rss_kb', 'rss_growth_kb'},
+                in the order the phases first ran. Phases can nest, a
+                phase's seconds exclude the phases run inside it.
+        tokens: number of tokens scanned, None when streaming
+        nodes: ast class name -> number of nodes in the parsed tree
+        functions: (name, instructions) for each code list generated
+        hooks: callables run as hook(event, phase_name, stats) with event
+               'start' or 'end', to attach profilers to phases.
+    """
+
+    def __init__(self, hooks=None):
+        self.hooks = list(hooks or [])
+        self.phases = collections.OrderedDict()
+        self.tokens = None
+        self.nodes = {}
+        self.functions = []
+        self.running = []
+
+    def phase(self, name):
+        """ context manager recording the phase called name """
+        return Phase(self, name)
+
+    def start_phase(self, name):
+        for hook in self.hooks:
+            hook('start', name, self)
+        # [name, start time, rss at start, seconds spent in nested phases]
+        self.running.append([name, time.time(), peak_rss_kb(), 0.0])
+
+    def end_phase(self, name):
+        end = time.time()
+        rss = peak_rss_kb()
+        name, start, start_rss, nested = self.running.pop()
+        elapsed = end - start
+        if self.running:
+            self.running[-1][3] += elapsed
+        record = self.phases.setdefault(name, {'seconds': 0.0,
+                                               'peak_rss_kb': 0,
+                                               'rss_growth_kb': 0})
+        record['seconds'] += elapsed - nested
+        record['peak_rss_kb'] = max(record['peak_rss_kb'], rss)
+        record['rss_growth_kb'] += rss - start_rss
+        for hook in self.hooks:
+            hook('end', name, self)
+
+    def count_nodes(self, tree):
+        """ record the number of nodes of each ast class in tree """
+        nodes = collections.defaultdict(int)
+        for node in ast.iter_nodes(tree):
+            nodes[type(node).__name__] += 1
+        self.nodes = dict(nodes)
+
+    def count_instructions(self, name, code):
+        """ record the number of instructions in the code list of function
+        name, labels and SetLineno entries aren't counted
+        """
+        count = 0
+        for op, arg in code:
+            if not peephole.is_pseudo(op):
+                count += 1
+        self.functions.append((name, count))
+
+    def as_dict(self):
+        """ the measurements as a dict of plain types, ready for json """
+        phases = []
+        for name, record in self.phases.items():
+            record = dict(record, name=name)
+            phases.append(record)
+        return {'phases': phases,
+                'total_seconds': sum(r['seconds'] for r in self.phases.values()),
+                'peak_rss_kb': peak_rss_kb(),
+                'tokens': self.tokens,
+                'nodes': self.nodes,
+                'node_count': sum(self.nodes.values()),
+                'functions': [{'name': name, 'instructions': count}
+                              for name, count in self.functions]}
+
+
+class NullStats(object):
+    """ Stand in for CompileStats when nothing is measured """
+
+    tokens = None
+
+    class NullPhase(object):
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            return False
+
+    null_phase = NullPhase()
+
+    def phase(self, name):
+        return self.null_phase
+
+    def count_nodes(self, tree):
+        pass
+
+    def count_instructions(self, name, code):
+        pass
+
+
+NULL_STATS = NullStats()
+
+
+class ProfileHook(object):
+    """ Hook running cProfile over the named phases, or every phase.
+
+        stats = CompileStats([ProfileHook(['codegen'])])
+        ...
+        hook.print_stats()
+    """
+
+    def __init__(self, phases=None):
+        self.phases = phases
+        self.profile = cProfile.Profile()
+        self.depth = 0
+
+    def __call__(self, event, name, stats):
+        if self.phases is not None and name not in self.phases:
+            return
+        if event == 'start':
+            if self.depth == 0:
+                self.profile.enable()
+            self.depth += 1
+        else:
+            self.depth -= 1
+            if self.depth == 0:
+                self.profile.disable()
+
+    def print_stats(self, sort='cumulative', limit=20):
+        pstats.Stats(self.profile).sort_stats(sort).print_stats(limit)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#
+# Loop invariant code motion for the mini triangle language. Expressions
+# in a while loop that read no variable the loop changes are computed once,
+# into a fresh const declared around the loop.
+
+import ast
+import optimizer
+
+# nodes an expression may consist of to be moved out of a loop, calls are
+# never moved
+PURE_EXPRESSIONS = (ast.IntegerExpression, ast.VnameExpression, ast.Vname,
+                    ast.UnaryExpression, ast.BinaryExpression)
+
+
+def has_value(expression, assigned):
+    """ True if expression can't evaluate to None, given the set of
+    variables assigned a value. arithmetic on None raises, so once it has
+    run its result is an int, and comparisons give a bool. a variable
+    copied with + and a call's result can still be None.
+    """
+    while type(expression) is ast.UnaryExpression and expression.operator == '+':
+        expression = expression.expression
+    kind = type(expression)
+    if kind is ast.VnameExpression:
+        return expression.variable.identifier in assigned
+    return kind is not ast.CallCommand
+
+
+class AssignedAtLoops(object):
+    """ Find the variables that have a value where each while loop starts.
+
+        A declared variable holds None until it is assigned, and so may a
+        parameter, since the caller may pass such a variable. Follows the
+        program in order: an assignment, getint or const declaration gives
+        its variable a value, an if keeps the variables both branches give
+        one. A loop starts with the variables that have a value both when
+        it is reached and at the end of its body, which comes back to the
+        start, so its body is visited again until that set stops shrinking.
+        Inner loops are visited again with it, and the loop ends with the
+        set it starts with. A function body starts with none.
+
+        assigned: WhileCommand -> frozenset of identifiers with a value
+                  every time the loop starts
+    """
+
+    def __init__(self):
+        self.assigned = {}
+        self.current = set()
+        self.work = []
+        self.handlers = {
+            ast.Program:             self.visit_program,
+            ast.LetCommand:          self.visit_let_command,
+            ast.CommandList:         self.visit_command_list,
+            ast.AssignCommand:       self.visit_assign_command,
+            ast.CallCommand:         self.visit_call_command,
+            ast.IfCommand:           self.visit_if_command,
+            ast.WhileCommand:        self.visit_while_command,
+            ast.DeclarationList:     self.visit_declaration_list,
+            ast.VarDeclaration:      self.visit_var_declaration,
+            ast.ConstDeclaration:    self.visit_const_declaration,
+            ast.FunctionDeclaration: self.visit_func_declaration,
+        }
+
+    def analyze(self, tree):
+        """ fill in assigned for the loops of tree. uses an explicit work
+        stack like resolver.Resolver, items are visited in program order.
+        """
+        work = self.work = [tree]
+        while work:
+            item = work.pop()
+            if isinstance(item, ast.AST):
+                handler = self.handlers.get(type(item))
+                if handler is not None:
+                    items = handler(item)
+                    items.reverse()
+                    work.extend(items)
+            else:
+                item()
+        return self.assigned
+
+    def restore(self, saved):
+        def restore():
+            self.current = saved
+        return restore
+
+    def visit_program(self, tree):
+        return [tree.command]
+
+    def visit_let_command(self, tree):
+        # the names the let declares get their outer state back after it
+        names = set(decl.identifier for decl in tree.declaration.declarations
+                    if type(decl) is not ast.FunctionDeclaration)
+        before = self.current & names
+        def finish():
+            self.current = (self.current - names) | before
+        return [tree.declaration, tree.command, finish]
+
+    def visit_command_list(self, tree):
+        return list(tree.commands)
+
+    def visit_assign_command(self, tree):
+        if has_value(tree.expression, self.current):
+            self.current.add(tree.variable.identifier)
+        else:
+            self.current.discard(tree.variable.identifier)
+        return []
+
+    def visit_call_command(self, tree):
+        if tree.identifier == 'getint':
+            arg = tree.expression.params[0].argname
+            if type(arg) is ast.VnameExpression:
+                self.current.add(arg.variable.identifier)
+        return []
+
+    def visit_if_command(self, tree):
+        before = set(self.current)
+        branch = []
+        def between():
+            branch.append(self.current)
+            self.current = before
+        def finish():
+            self.current = self.current & branch[0]
+        return [tree.command1, between, tree.command2, finish]
+
+    def visit_while_command(self, tree):
+        def start(state):
+            self.assigned[tree] = state
+            self.current = set(state)
+            return [tree.command, back]
+        def back():
+            state = self.assigned[tree] & self.current
+            if state == self.assigned[tree]:
+                self.current = set(state)
+            else:
+                items = start(state)
+                items.reverse()
+                self.work.extend(items)
+        return start(frozenset(self.current))
+
+    def visit_declaration_list(self, tree):
+        return list(tree.declarations)
+
+    def visit_var_declaration(self, tree):
+        self.current.discard(tree.identifier)
+        return []
+
+    def visit_const_declaration(self, tree):
+        if has_value(tree.expression, self.current):
+            self.current.add(tree.identifier)
+        else:
+            self.current.discard(tree.identifier)
+        return []
+
+    def visit_func_declaration(self, tree):
+        saved = self.current
+        self.current = set()
+        return [tree.command, self.restore(saved)]
+
+
+class LoopInvariants(optimizer.Rewriter):
+    """ Move loop invariant expressions out of while loops.
+
+        The variables a loop changes are the ones assigned (:= or getint)
+        or declared anywhere in its condition and body. Calls can't change
+        the caller's variables, a function body only sees its own, so a
+        call adds nothing, but calls are never moved since they can print.
+        Every largest subexpression of an operator that reads none of
+        those variables is replaced by a const declared in a let around
+        the loop:
+
+            while i < n do x := x + n * 2      =>
+            let const inv.1 ~ n * 2 in while i < n do x := x + inv.1
+
+        Equal expressions in one loop share their const. Moving an
+        expression runs it before the loop even if the loop body never
+        would, so it must not raise: only division and modulo by a non
+        zero literal are moved, and only expressions whose variables all
+        have a value when the loop starts (see AssignedAtLoops), since
+        arithmetic on an unassigned variable fails. Inner loops are done first. Their consts are declared in the
+        outer body, where they can move again.
+
+        hoisted: (loop line, [expression source]) for each loop changed
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.hoisted = []
+        # WhileCommand -> the variables it changes, for enclosing loops
+        self.changed = {}
+        # WhileCommand -> the variables with a value where it starts
+        self.assigned = {}
+
+    def hoist(self, tree):
+        self.assigned = AssignedAtLoops().analyze(tree)
+        return self.rewrite(tree)
+
+    def leave(self, node):
+        if type(node) is ast.WhileCommand:
+            return self.hoist_loop(node)
+        return node
+
+    def hoist_loop(self, loop):
+        changed = set()
+        # (node, slot) of each expression the loop evaluates, outside of
+        # inner loops, which were already done
+        slots = [(loop, 'expression')]
+        work = [loop.command]
+        while work:
+            node = work.pop()
+            if isinstance(node, list):
+                work.extend(node)
+                continue
+            kind = type(node)
+            if kind is ast.WhileCommand:
+                changed |= self.changed[node]
+                continue
+            if kind is ast.FunctionDeclaration:
+                continue
+            if kind is ast.AssignCommand:
+                changed.add(node.variable.identifier)
+            elif kind is ast.VarDeclaration or kind is ast.ConstDeclaration:
+                changed.add(node.identifier)
+            elif kind is ast.CallCommand and node.identifier == 'getint':
+                arg = node.expression.params[0].argname
+                if type(arg) is ast.VnameExpression:
+                    changed.add(arg.variable.identifier)
+            for name in kind.__slots__:
+                value = getattr(node, name)
+                if isinstance(value, ast.Expression):
+                    slots.append((node, name))
+                elif isinstance(value, (ast.AST, list)):
+                    work.append(value)
+        self.changed[loop] = changed
+        assigned = self.assigned.get(loop, frozenset())
+
+        temps = {}
+        declarations = []
+        while slots:
+            node, name = slots.pop()
+            expression = getattr(node, name)
+            if type(expression) in (ast.UnaryExpression, ast.BinaryExpression):
+                if self.is_invariant(expression, changed, assigned):
+                    key = optimizer.unparse(expression)
+                    if key not in temps:
+                        self.count += 1
+                        temps[key] = 'inv.%d' % self.count
+                        declarations.append(ast.ConstDeclaration(temps[key], expression))
+                    setattr(node, name, ast.VnameExpression(ast.Vname(temps[key])))
+                elif type(expression) is ast.UnaryExpression:
+                    slots.append((expression, 'expression'))
+                else:
+                    slots.extend([(expression, 'expr2'), (expression, 'expr1')])
+
+        if not declarations:
+            return loop
+        self.hoisted.append((loop.line, sorted(temps)))
+        return ast.LetCommand(ast.DeclarationList(declarations), loop, loop.line)
+
+    def is_invariant(self, expression, changed, assigned):
+        for node in ast.iter_nodes(expression):
+            if not isinstance(node, PURE_EXPRESSIONS):
+                return False
+            if type(node) is ast.Vname and (node.identifier in changed or
+                                            node.identifier not in assigned):
+                return False
+        return optimizer.can_reorder(expression)
+
+    def report(self):
+        """ return the expressions moved out of each loop as printable lines """
+        return ['line %-9s %s' % (line, ', '.join(expressions))
+                for line, expressions in self.hoisted]
+
+
+def hoist_invariants(tree):
+    """ run the LoopInvariants pass over tree """
+    return LoopInvariants().hoist(tree)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+# Purity analysis for the mini triangle language, finding the functions
+# whose calls CodeGen can answer from a memo table of earlier results.
+
+import ast
+import optimizer
+
+DEFAULT_SIZE = 1024
+POLICIES = ['lru', 'fifo']
+
+
+def impurity(decl):
+    """ why the body of FunctionDeclaration decl has side effects, or None.
+    calls of user functions are left to Memoizer.analyze.
+    """
+    for node in ast.iter_nodes(decl.command):
+        kind = type(node)
+        if kind is ast.CallCommand and node.identifier in ('putint', 'getint'):
+            return 'calls %s' % node.identifier
+        if kind is ast.FunctionDeclaration:
+            # binds a global each time it runs
+            return 'declares functions'
+    return None
+
+
+def is_costly(decl):
+    """ True if the body of decl calls or loops, so looking its result up
+    can be cheaper than running it
+    """
+    return any(type(node) is ast.WhileCommand or
+               (type(node) is ast.CallCommand and
+                node.identifier not in ('putint', 'getint'))
+               for node in ast.iter_nodes(decl.command))
+
+
+class Memoizer(object):
+    """ Decide which functions are memoized.
+
+        Runs on the resolved tree, where each call knows the global name of
+        the function it calls. A function is pure when its body prints and
+        reads nothing, declares no functions and only calls pure functions.
+        Variables are local to a call, so a pure function's result depends
+        on its arguments alone. A pure function is memoized when it is
+        declared in the program's outermost let, so its declaration runs
+        once, and its body calls or loops. The other pure functions are
+        cheaper to run than to look up.
+
+        size: results kept per function, 0 disables memoization
+        policy: 'lru' or 'fifo', which result a full table drops
+        report: if set, the program prints the hits and misses of each
+                table at exit
+        typed: True if a comparison can reach a parameter, so the table
+               keys tell True from 1
+        reasons: FunctionDeclaration -> why it isn't memoized, None if it is
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, policy='lru', report=False):
+        self.size = size
+        self.policy = policy
+        self.report_counts = report
+        self.typed = False
+        self.reasons = {}
+        self.functions = []
+
+    def analyze(self, tree):
+        """ fill in reasons for every function of the resolved Program tree """
+        if self.size <= 0:
+            return
+        self.typed = optimizer.stores_bools(tree)
+        by_name = {}
+        calls = {}
+        for node in ast.iter_nodes(tree):
+            if type(node) is ast.FunctionDeclaration:
+                self.functions.append(node)
+                by_name[node.global_name] = node
+                self.reasons[node] = impurity(node)
+                calls[node] = set(call.target for call in ast.iter_nodes(node.command)
+                                  if type(call) is ast.CallCommand and
+                                  call.identifier not in ('putint', 'getint'))
+
+        # impurity spreads to callers until nothing changes
+        changed = True
+        while changed:
+            changed = False
+            for decl in self.functions:
+                if self.reasons[decl] is not None:
+                    continue
+                for target in calls[decl]:
+                    if self.reasons[by_name[target]] is not None:
+                        self.reasons[decl] = 'calls %s' % by_name[target].name
+                        changed = True
+                        break
+
+        outermost = set(tree.command.declaration.declarations)
+        for decl in self.functions:
+            if self.reasons[decl] is not None:
+                continue
+            if decl not in outermost:
+                self.reasons[decl] = 'pure, not declared in the outermost let'
+            elif not is_costly(decl):
+                self.reasons[decl] = 'pure, no calls or loops'
+
+    def is_memoized(self, decl):
+        return decl in self.reasons and self.reasons[decl] is None
+
+    def report(self):
+        """ return the memoized functions, and why the others aren't, as
+        printable lines
+        """
+        lines = []
+        for decl in self.functions:
+            if self.reasons[decl] is None:
+                lines.append('%-14s memoized, %s of %d' % (decl.name, self.policy,
+                                                          self.size))
+            else:
+                lines.append('%-14s not memoized, %s' % (decl.name,
+                                                         self.reasons[decl]))
+        return lines
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+#
+# AST optimization passes for the mini triangle language. Each pass takes
+# the ast.Program from Parser.parse() and returns the tree CodeGen.generate()
+# should compile. The questions about the tree the passes share are
+# answered here too.
+
+import ast
+
+
+class Rewriter(object):
+    """ Base class for passes that rebuild the tree bottom up.
+
+        Children are rewritten before their parent. enter(node) runs before
+        a node's children are visited, leave(node) after, and the node is
+        replaced by whatever leave returns. Uses an explicit stack, so deep
+        trees can't overflow the python stack.
+    """
+
+    def rewrite(self, tree):
+        values = []
+        work = [(tree, False)]
+        while work:
+            node, visited = work.pop()
+            if isinstance(node, ast.AST):
+                slots = type(node).__slots__
+                if visited:
+                    if slots:
+                        fields = values[-len(slots):]
+                        del values[-len(slots):]
+                        for name, value in zip(slots, fields):
+                            setattr(node, name, value)
+                    values.append(self.leave(node))
+                else:
+                    self.enter(node)
+                    work.append((node, True))
+                    for name in reversed(slots):
+                        work.append((getattr(node, name), False))
+            elif isinstance(node, list):
+                if visited:
+                    if node:
+                        node[:] = values[-len(node):]
+                        del values[-len(node):]
+                    values.append(node)
+                else:
+                    work.append((node, True))
+                    for item in reversed(node):
+                        work.append((item, False))
+            else:
+                values.append(node)
+        return values[0]
+
+    def enter(self, node):
+        pass
+
+    def leave(self, node):
+        return node
+
+
+def assigned_names(tree):
+    """ return the set of identifiers assigned to (:= or getint) in tree """
+    names = set()
+    for node in ast.iter_nodes(tree):
+        if type(node) is ast.AssignCommand:
+            names.add(node.variable.identifier)
+        elif type(node) is ast.CallCommand and node.identifier == 'getint':
+            arg = node.expression.params[0].argname
+            if type(arg) is ast.VnameExpression:
+                names.add(arg.variable.identifier)
+    return names
+
+
+# the operators giving a bool
+COMPARISONS = ('<', '>', '=')
+
+
+def literal(tree):
+    """ the int value of an integer literal, None for anything else """
+    if type(tree) is ast.IntegerExpression and type(tree.value) in (int, long):
+        return tree.value
+    return None
+
+
+def can_reorder(tree):
+    """ True if evaluating expression tree earlier can't fail where it
+    didn't before. only division and modulo by a variable can raise.
+    """
+    for node in ast.iter_nodes(tree):
+        if type(node) is ast.BinaryExpression and node.oper in ('/', '\\'):
+            if type(node.expr2) is not ast.IntegerExpression or not node.expr2.value:
+                return False
+    return True
+
+
+def uses(tree, ident):
+    """ True if expression tree reads the variable ident """
+    return any(type(node) is ast.Vname and node.identifier == ident
+               for node in ast.iter_nodes(tree))
+
+
+def calls(tree):
+    """ True if expression tree calls a function """
+    return any(type(node) is ast.CallCommand for node in ast.iter_nodes(tree))
+
+
+def unparse(tree):
+    """ mini triangle source text of expression tree """
+    out = []
+    work = [tree]
+    while work:
+        item = work.pop()
+        kind = type(item)
+        if kind is ast.IntegerExpression:
+            out.append(str(item.value))
+        elif kind is ast.VnameExpression:
+            out.append(item.variable.identifier)
+        elif kind is ast.UnaryExpression:
+            out.append(item.operator)
+            work.append(item.expression)
+        elif kind is ast.BinaryExpression:
+            work.extend([')', item.expr2, ' %s ' % item.oper, item.expr1, '('])
+        elif kind is ast.CallCommand:
+            parts = [item.identifier + '(']
+            for param in item.expression.params:
+                if len(parts) > 1:
+                    parts.append(', ')
+                parts.append(param.argname)
+            parts.append(')')
+            work.extend(reversed(parts))
+        else:
+            out.append(item)
+    return ''.join(out)
+
+
+def may_be_bool(tree):
+    """ True if expression tree can have a bool value: a comparison, or a
+    literal folded from one
+    """
+    while type(tree) is ast.UnaryExpression and tree.operator == '+':
+        tree = tree.expression
+    if type(tree) is ast.BinaryExpression:
+        return tree.oper in COMPARISONS
+    return type(tree) is ast.IntegerExpression and type(tree.value) is bool
+
+
+def is_int(tree, ints_only):
+    """ True if expression tree always has an int value: arithmetic, an int
+    literal, or a variable when ints_only, when the program can't store a
+    comparison result (see stores_bools)
+    """
+    while type(tree) is ast.UnaryExpression and tree.operator == '+':
+        tree = tree.expression
+    kind = type(tree)
+    if kind is ast.BinaryExpression:
+        return tree.oper not in COMPARISONS
+    if kind is ast.UnaryExpression:
+        return True
+    if kind is ast.IntegerExpression:
+        return literal(tree) is not None
+    if kind is ast.VnameExpression:
+        return ints_only
+    return False
+
+
+def stores_bools(tree):
+    """ True if the program can store a comparison result, in a variable,
+    a parameter or a function result. if it can't, every variable holds an
+    int (getint reads integers).
+    """
+    for node in ast.iter_nodes(tree):
+        kind = type(node)
+        if kind in (ast.AssignCommand, ast.ConstDeclaration, ast.ReturnCommand):
+            if may_be_bool(node.expression):
+                return True
+        elif kind is ast.Parameter and isinstance(node.argname, ast.AST):
+            if may_be_bool(node.argname):
+                return True
+    return False
+
+
+def fold_binary(oper, value1, value2):
+    """ evaluate oper on two constants the way the generated bytecode would.
+    return None when the operation must be left to run time.
+    """
+    if oper == '+':
+        return value1 + value2
+    elif oper == '-':
+        return value1 - value2
+    elif oper == '*':
+        return value1 * value2
+    elif oper == '/' and value2 != 0:
+        return value1 / value2
+    elif oper == '\\' and value2 != 0:
+        return value1 % value2
+    elif oper == '<':
+        return value1 < value2
+    elif oper == '>':
+        return value1 > value2
+    elif oper == '=':
+        return value1 == value2
+    return None
+
+
+class ConstantFolder(Rewriter):
+    """ Fold operators applied to literals and propagate constants.
+
+        A const whose value folds to a literal, and which is never assigned
+        in its let body, is substituted at each use and its declaration is
+        dropped. Scopes follow CodeGen: a let adds to the enclosing scope,
+        a function body only sees its own parameters and declarations.
+    """
+
+    def __init__(self):
+        # each scope is [names, is_function], names maps an identifier to
+        # its constant value, or to None when it is a variable.
+        self.scopes = [[{}, True]]
+        self.propagated = set()
+        self.assigned = []
+
+    def fold(self, tree):
+        return self.rewrite(tree)
+
+    def lookup(self, ident):
+        for names, is_function in reversed(self.scopes):
+            if ident in names:
+                return names[ident]
+            if is_function:
+                break
+        return None
+
+    def enter(self, node):
+        if type(node) is ast.LetCommand:
+            self.scopes.append([{}, False])
+            self.assigned.append(assigned_names(node.command))
+        elif type(node) is ast.FunctionDeclaration:
+            names = {}
+            params = node.param.params if type(node.param) is ast.ParameterList else [node.param]
+            for param in params:
+                names[param.argname] = None
+            self.scopes.append([names, True])
+
+    def leave(self, node):
+        kind = type(node)
+        if kind is ast.LetCommand or kind is ast.FunctionDeclaration:
+            self.scopes.pop()
+            if kind is ast.LetCommand:
+                self.assigned.pop()
+        elif kind is ast.VarDeclaration:
+            self.scopes[-1][0][node.identifier] = None
+        elif kind is ast.ConstDeclaration:
+            names = self.scopes[-1][0]
+            if (type(node.expression) is ast.IntegerExpression and self.assigned
+                    and node.identifier not in self.assigned[-1]):
+                names[node.identifier] = node.expression.value
+                self.propagated.add(node)
+            else:
+                names[node.identifier] = None
+        elif kind is ast.DeclarationList:
+            node.declarations = [decl for decl in node.declarations
+                                 if decl not in self.propagated]
+        elif kind is ast.VnameExpression:
+            value = self.lookup(node.variable.identifier)
+            if value is not None:
+                return ast.IntegerExpression(value)
+        elif kind is ast.UnaryExpression:
+            if node.operator == '+':
+                return node.expression
+            if type(node.expression) is ast.IntegerExpression:
+                return ast.IntegerExpression(-node.expression.value)
+        elif kind is ast.BinaryExpression:
+            if (type(node.expr1) is ast.IntegerExpression and
+                    type(node.expr2) is ast.IntegerExpression):
+                value = fold_binary(node.oper, node.expr1.value, node.expr2.value)
+                if value is not None:
+                    return ast.IntegerExpression(value)
+        return node
+
+
+def fold_constants(tree):
+    """ run the ConstantFolder pass over tree """
+    return ConstantFolder().fold(tree)
+
+
+if __name__ == '__main__':
+    pass
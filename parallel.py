@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#
+# Parallel parsing and code generation of the top level functions of one
+# large mini triangle program, over a process pool.
+#
+# A program is a let whose declarations are mostly functions. Each function
+# compiles to its own code object, so the tokens are split at the top level
+# declarations, worker processes parse them in groups, and after the whole
+# program passes (optimization, resolution, memo analysis) have run on the
+# stitched tree in the parent, workers generate the code object of each
+# top level function. The parent binds them in gencode as CodeGen would.
+#
+# Workers get their input by fork: each pool is started after the parent
+# has what the workers read (the tokens, the resolved tree) in module
+# globals, so only token index ranges and declaration indices are sent to
+# them. They send back serialized trees and marshalled code objects.
+
+import marshal
+import multiprocessing
+
+import ast
+import instrument
+import parser
+import scanner
+import serialize
+
+# work for the pool being started, read by the workers after the fork
+_tokens = None
+_line_map = None
+_codegen = None
+_make_passes = None
+
+DECLARATION_TOKENS = (scanner.TK_VAR, scanner.TK_CONST, scanner.TK_FUNC)
+
+
+def split_declarations(tokens):
+    """ split the tokens of a program `let D; D; ... in C` at its top level
+    declarations. returns the (start, end) token index range of each
+    declaration and the index of the first token of C, or None if the
+    program doesn't start that way.
+
+    A func body is a single command, which can't contain var, const, func
+    or in outside a let of its own, so the next one of those outside any
+    let ends the declaration. Ranges that aren't a declaration fail to
+    parse in the worker.
+    """
+    if not tokens or tokens[0].type != scanner.TK_LET:
+        return None
+    spans = []
+    start = 1
+    depth = 0
+    for i in xrange(1, len(tokens)):
+        kind = tokens[i].type
+        if kind == scanner.TK_LET:
+            depth += 1
+        elif kind == scanner.TK_IN:
+            if depth:
+                depth -= 1
+                continue
+            if i > start:
+                spans.append((start, i))
+            return (spans, i + 1) if spans else None
+        elif kind in DECLARATION_TOKENS and depth == 0 and i > start:
+            spans.append((start, i))
+            start = i
+    return None
+
+
+def group_spans(spans, groups):
+    """ split spans, in order, into about `groups` lists of similar token
+    counts
+    """
+    size = max(1, (spans[-1][1] - spans[0][0]) // groups)
+    result = [[]]
+    count = 0
+    for span in spans:
+        if count >= size:
+            result.append([])
+            count = 0
+        result[-1].append(span)
+        count += span[1] - span[0]
+    return result
+
+
+def run(func, work, jobs, background=None):
+    """ map func over work in a pool of jobs processes, forked now. runs
+    background in this process while the pool works and returns its result
+    and the list of results.
+    """
+    if jobs == 1:
+        results = map(func, work)
+        return background and background(), results
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # work comes in a few groups per worker, one round trip each
+        pending = pool.map_async(func, work, 1)
+        done = background and background()
+        return done, pending.get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+def parse_group(spans):
+    """ parse the declarations in token ranges spans in a worker. returns
+    the serialized DeclarationList, None on an error, which the parent
+    gets again from the sequential parse.
+    """
+    start, end = spans[0][0], spans[-1][1]
+    tokens = _tokens[start:end]
+    tokens.append(scanner.Token(scanner.TK_EOT, 0, _tokens[end].pos))
+    try:
+        p = parser.Parser(tokens, _line_map)
+        declarations = p.parse_declaration()
+        if p.token_current().type != scanner.TK_EOT:
+            return None
+    except (parser.ParserError, scanner.ScannerError):
+        return None
+    return serialize.dump_tree(declarations)
+
+
+def parse_tokens(tokens, line_map, jobs):
+    """ parse a program, the list tokens, with its top level declarations
+    split over jobs processes. returns the ast.Program, or None if the
+    program doesn't split or a part doesn't parse, so the caller parses it
+    in sequence and gets the error of the first bad token.
+    """
+    global _tokens, _line_map
+    split = split_declarations(tokens)
+    if split is None or jobs < 1:
+        return None
+    spans, body = split
+
+    def parse_body():
+        p = parser.Parser(tokens[body:], line_map)
+        try:
+            return p.parse_singlecommand()
+        except (parser.ParserError, scanner.ScannerError):
+            return None
+
+    _tokens, _line_map = tokens, line_map
+    try:
+        command, groups = run(parse_group, group_spans(spans, jobs * 4), jobs,
+                              parse_body)
+    finally:
+        _tokens = _line_map = None
+    if command is None or None in groups:
+        return None
+    declarations = []
+    for data in groups:
+        declarations.extend(serialize.load_tree(data).declarations)
+    line = line_map.line(tokens[0].pos) if line_map is not None else None
+    return ast.Program(ast.LetCommand(ast.DeclarationList(declarations),
+                                      command, line))
+
+
+def generate_group(indices):
+    """ generate the code objects of the top level functions at indices in
+    a worker. returns their marshalled code objects, None for each that
+    failed, the code passes used and the instruction counts.
+    """
+    codegen = _codegen
+    declarations = codegen.tree.command.declaration.declarations
+    # the parent's own, when the group runs in the parent
+    passes, stats = codegen.code_passes, codegen.stats
+    codegen.code_passes = _make_passes()
+    if isinstance(stats, instrument.CompileStats):
+        codegen.stats = instrument.CompileStats()
+    codes = []
+    try:
+        for index in indices:
+            try:
+                codes.append(marshal.dumps(codegen.function_code(declarations[index])))
+            except Exception:
+                codes.append(None)
+        return codes, codegen.code_passes, getattr(codegen.stats, 'functions', [])
+    finally:
+        codegen.code_passes, codegen.stats = passes, stats
+
+
+def generate_functions(codegen, make_passes, jobs):
+    """ generate the top level functions of the program of CodeGen codegen
+    over jobs processes, for codegen.generate to bind. make_passes returns
+    new code passes like codegen.code_passes, a set for each group of
+    functions, which are merged into codegen's after. a function that
+    fails is left to codegen.generate, which raises its error.
+    """
+    global _codegen, _make_passes
+    tree = codegen.tree
+    if (type(tree) is not ast.Program or
+            type(tree.command) is not ast.LetCommand or jobs < 1):
+        return
+    codegen.resolve()
+    declarations = tree.command.declaration.declarations
+    functions = [i for i, decl in enumerate(declarations)
+                 if type(decl) is ast.FunctionDeclaration]
+    if not functions:
+        return
+    size = max(1, len(functions) // (jobs * 4))
+    work = [functions[i:i + size] for i in range(0, len(functions), size)]
+
+    _codegen, _make_passes = codegen, make_passes
+    try:
+        ignored, results = run(generate_group, work, jobs)
+    finally:
+        _codegen = _make_passes = None
+    for indices, (codes, passes, counts) in zip(work, results):
+        for index, data in zip(indices, codes):
+            if data is not None:
+                codegen.compiled[declarations[index]] = marshal.loads(data)
+        for code_pass, worker_pass in zip(codegen.code_passes, passes):
+            code_pass.merge(worker_pass)
+        if isinstance(codegen.stats, instrument.CompileStats):
+            codegen.stats.functions.extend(counts)
+
+
+if __name__ == '__main__':
+    pass
@@ -2,6 +2,8 @@
 #
 # Parser for the mini triangle language
 
+import collections
+
 import ast
 import scanner 
 
@@ -65,10 +67,16 @@ class Parser(object):
         Type-denoter   ::=  Identifier    
     """
 
-    def __init__(self, tokens):
-        self.tokens = tokens
-        self.curindex = 0
-        self.curtoken = tokens[0]
+    def __init__(self, tokens, line_map=None):
+        # tokens may be a list or a lazy iterator such as
+        # Scanner.iter_tokens(). Only the current token and the lookahead
+        # buffer are held, so tokens are consumed as they are produced.
+        # line_map is a scanner.LineMap of the source, used to record the
+        # line of each command.
+        self.tokens = iter(tokens)
+        self.lookahead = collections.deque()
+        self.curtoken = next(self.tokens)
+        self.line_map = line_map
         
     def parse(self):
         """ Program ::=  Command """
@@ -84,6 +92,7 @@ class Parser(object):
                        |   begin gen-Command end
         """
         token = self.token_current()
+        line = self.token_line(token)
         if token.type == scanner.TK_IF:
             self.token_accept_any()
             expr = self.parse_expr()
@@ -91,19 +100,19 @@ class Parser(object):
             c1 = self.parse_singlecommand()
             self.token_accept(scanner.TK_ELSE)
             c2 = self.parse_singlecommand()
-            c1 = ast.IfCommand(expr, c1, c2)
+            c1 = ast.IfCommand(expr, c1, c2, line)
         elif token.type == scanner.TK_WHILE:
             self.token_accept_any()
             expr = self.parse_expr()
             self.token_accept(scanner.TK_DO)
             c1 = self.parse_singlecommand()
-            c1 = ast.WhileCommand(expr, c1)
+            c1 = ast.WhileCommand(expr, c1, line)
         elif token.type == scanner.TK_LET:
             self.token_accept_any()
             decl = self.parse_declaration()
             self.token_accept(scanner.TK_IN)
             c1 = self.parse_singlecommand()
-            c1 = ast.LetCommand(decl, c1)
+            c1 = ast.LetCommand(decl, c1, line)
         elif token.type == scanner.TK_BEGIN:
             self.token_accept_any()            
             token = self.token_current()
@@ -115,26 +124,23 @@ class Parser(object):
 
     def parse_command(self):
         """ Command     ::=  single-Command (single-Command)* """
-        token = self.token_current()
+        commands = []
         block_types = [scanner.TK_IF, scanner.TK_WHILE, scanner.TK_LET, scanner.TK_BEGIN]
+        token = self.token_current()
 
-        if token.type in block_types:
+        # Loop rather than recurse, so long sequences use constant stack.
+        while 1:
+            if token.type in block_types:
+                commands.append(self.parse_blockcommand())
+            else:
+                commands.append(self.parse_seccommand())
+                self.token_accept(scanner.TK_SEMICOLON)
 
-            c1 = self.parse_blockcommand()
-            token = self.token_current()
-            if token.type != scanner.TK_EOT and token.type != scanner.TK_END:
-                c2 = self.parse_command()
-                c1 = ast.SequentialCommand(c1, c2)
-        else:
-            c1 = self.parse_seccommand()
-            self.token_accept(scanner.TK_SEMICOLON)
             token = self.token_current()
+            if token.type == scanner.TK_EOT or token.type == scanner.TK_END:
+                break
 
-            if token.type != scanner.TK_EOT and token.type != scanner.TK_END:
-                c2 = self.parse_command()
-                c1 = ast.SequentialCommand(c1, c2)
-     
-        return c1
+        return ast.CommandList(commands)
 
     def parse_singlecommand(self):
         """
@@ -158,6 +164,7 @@ class Parser(object):
                      |   return Expression
         """
         token = self.token_current()
+        line = self.token_line(token)
         
         token_lookahead = self.token_lookahead()         
         if token_lookahead.type == scanner.TK_BECOMES:
@@ -166,7 +173,7 @@ class Parser(object):
             self.token_accept(scanner.TK_BECOMES) # parse becomes
             expr = self.parse_expr()
      
-            c1 = ast.AssignCommand(ident, expr)
+            c1 = ast.AssignCommand(ident, expr, line)
         elif token_lookahead.type == scanner.TK_LPAREN:
             """ Identifier '(' Param ')' """
             ident = token.val   # save ident name
@@ -179,12 +186,12 @@ class Parser(object):
      
            # self.token_accept(scanner.TK_SEMICOLON)
 
-            c1 = ast.CallCommand(ident, expr)
+            c1 = ast.CallCommand(ident, expr, line)
 
         elif token.type == scanner.TK_RETURN:
             self.token_accept_any()
             expr = self.parse_expr()
-            c1 = ast.ReturnCommand(expr)
+            c1 = ast.ReturnCommand(expr, line)
         else:
             raise ParserError(self.curtoken.pos, self.curtoken.val, self.curtoken.type)
       
@@ -193,21 +200,20 @@ class Parser(object):
     def parse_param_expr(self):
         token = self.token_current()
         e1 = self.parse_expr()
-        p1 = ast.Parameter(e1, None)
+        params = [ast.Parameter(e1, None)]
         token = self.token_current()
         while token.type == scanner.TK_COMMA:
             self.token_accept_any()
             e2 = self.parse_expr()
-            p2 = ast.Parameter(e2, None)
-            p1 = ast.SequentialParameter(p1, p2)
+            params.append(ast.Parameter(e2, None))
             token = self.token_current()
-        return p1
+        return ast.ParameterList(params)
 
     def parse_expr(self):        
         """ Expression ::=  primary-Expression (Operator primary-Expression)* """
         token = self.token_current()        
         token_lookahead = self.token_lookahead()         
-        if token_lookahead.type == scanner.TK_LPAREN:
+        if token.type == scanner.TK_IDENTIFIER and token_lookahead.type == scanner.TK_LPAREN:
             """ Identifier '(' Param ')' """
             ident = token.val   # save ident name
             self.token_accept(scanner.TK_IDENTIFIER) # scan the token
@@ -215,7 +221,7 @@ class Parser(object):
             expr = self.parse_param_expr()
             self.token_accept(scanner.TK_RPAREN)
     
-            e1 = ast.CallCommand(ident, expr)
+            e1 = ast.CallCommand(ident, expr, self.token_line(token))
         else:
             e1 = self.parse_secexpr()
             token = self.token_current()
@@ -275,21 +281,20 @@ class Parser(object):
         Declaration ::=  sec-Declaration ';' | func-declaration (sec-Declaration ';' | func-declaration) * 
 
         """
+        declarations = []
         token = self.token_current()
-        
-        if token.type in [scanner.TK_VAR, scanner.TK_CONST]:
-            c1 = self.parse_secdeclaration()
-            self.token_accept(scanner.TK_SEMICOLON)
-            if token.type != scanner.TK_EOT and token.type != scanner.TK_IN:
-                c2 = self.parse_declaration()
-                c1 = ast.SequentialDeclaration(c1, c2)
-            return c1
-        elif token.type == scanner.TK_FUNC:
-            c1 = self.parse_funcdeclaration()
-            if token.type != scanner.TK_EOT and token.type != scanner.TK_IN:
-                c2 = self.parse_declaration()
-                c1 = ast.SequentialDeclaration(c1, c2)
-            return c1
+
+        while 1:
+            if token.type in [scanner.TK_VAR, scanner.TK_CONST]:
+                declarations.append(self.parse_secdeclaration())
+                self.token_accept(scanner.TK_SEMICOLON)
+            elif token.type == scanner.TK_FUNC:
+                declarations.append(self.parse_funcdeclaration())
+            else:
+                break
+            token = self.token_current()
+
+        return ast.DeclarationList(declarations)
 
     def parse_secdeclaration(self):
         """
@@ -316,6 +321,7 @@ class Parser(object):
             raise ParserError(self.curtoken.pos, self.curtoken.val, self.curtoken.type)
     
     def parse_funcdeclaration(self):
+        line = self.token_line(self.token_current())
         self.token_accept_any() # accept the func keyword
         tk_ident = self.token_current()
         self.token_accept(scanner.TK_IDENTIFIER)
@@ -325,7 +331,7 @@ class Parser(object):
         self.token_accept(scanner.TK_COLON)
         func_type = self.parse_typedenoter()
         command = self.parse_singlecommand()
-        decl = ast.FunctionDeclaration(tk_ident.val, param, func_type, command)
+        decl = ast.FunctionDeclaration(tk_ident.val, param, func_type, command, line)
         return decl
 
     def parse_param(self):
@@ -333,7 +339,7 @@ class Parser(object):
         self.token_accept(scanner.TK_IDENTIFIER)
         self.token_accept(scanner.TK_COLON)
         arg_type = self.parse_typedenoter()
-        p1 = ast.Parameter(tk_argident, arg_type)
+        params = [ast.Parameter(tk_argident, arg_type)]
         token = self.token_current()
         
         while token.type == scanner.TK_COMMA:
@@ -344,11 +350,10 @@ class Parser(object):
 
             self.token_accept(scanner.TK_COLON)
             arg_type = self.parse_typedenoter()
-            p2 = ast.Parameter(tk_argident, arg_type)
-            p1 = ast.SequentialParameter(p1, p2)
+            params.append(ast.Parameter(tk_argident, arg_type))
             token = self.token_current()
 
-        return p1
+        return ast.ParameterList(params)
 
     def parse_typedenoter(self):
         """ Type-denoter       ::=  Identifier """
@@ -368,18 +373,31 @@ class Parser(object):
         return self.curtoken
     
     def token_lookahead(self):
-        return self.tokens[self.curindex + 1]
+        if not self.lookahead:
+            if self.curtoken.type == scanner.TK_EOT:
+                # Nothing follows TK_EOT, keep looking at it.
+                return self.curtoken
+            self.lookahead.append(next(self.tokens))
+        return self.lookahead[0]
         
     def token_accept_any(self):
-        # Do not increment curindex if curtoken is TK_EOT.
+        # Do not advance if curtoken is TK_EOT.
         if self.curtoken.type != scanner.TK_EOT:
-            self.curindex += 1
-            self.curtoken = self.tokens[self.curindex]
+            if self.lookahead:
+                self.curtoken = self.lookahead.popleft()
+            else:
+                self.curtoken = next(self.tokens)
 
     def token_accept(self, type):
         if self.curtoken.type != type:
             raise ParserError(self.curtoken.pos, self.curtoken.val, self.curtoken.type)
         self.token_accept_any()
+
+    def token_line(self, token):
+        """ source line of token, None without a line map """
+        if self.line_map is None:
+            return None
+        return self.line_map.line(token.pos)
     
 if __name__ == '__main__':
     pass
\ No newline at end of file
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#
+# Peephole optimizer for the (opcode, arg) lists built by CodeGen
+
+from byteplay import *
+
+
+UNCONDITIONAL_JUMPS = [JUMP_FORWARD, JUMP_ABSOLUTE]
+CONDITIONAL_JUMPS = [POP_JUMP_IF_FALSE, POP_JUMP_IF_TRUE]
+JUMPS = UNCONDITIONAL_JUMPS + CONDITIONAL_JUMPS
+
+
+def is_label(op):
+    return isinstance(op, Label)
+
+
+def is_pseudo(op):
+    """ labels and SetLineno entries aren't instructions """
+    return op is SetLineno or isinstance(op, Label)
+
+
+def label_positions(code):
+    """ map each label in code to its index """
+    positions = {}
+    for i, (op, arg) in enumerate(code):
+        if is_label(op):
+            positions[op] = i
+    return positions
+
+
+def next_instruction(code, i):
+    """ index of the first instruction at or after i, or len(code) """
+    while i < len(code) and is_pseudo(code[i][0]):
+        i += 1
+    return i
+
+
+def rule_store_load(code):
+    """ STORE_FAST x; LOAD_FAST x  ->  DUP_TOP; STORE_FAST x
+    SetLineno entries between the two stay after the STORE_FAST.
+    """
+    out = []
+    hits = 0
+    i = 0
+    while i < len(code):
+        op, arg = code[i]
+        j = i + 1
+        while j < len(code) and code[j][0] is SetLineno:
+            j += 1
+        if op == STORE_FAST and j < len(code) and code[j] == (LOAD_FAST, arg):
+            out.append((DUP_TOP, None))
+            out.append((STORE_FAST, arg))
+            out.extend(code[i + 1:j])
+            hits += 1
+            i = j + 1
+        else:
+            out.append((op, arg))
+            i += 1
+    return out, hits
+
+
+def rule_jump_to_next(code):
+    """ drop a jump whose target label directly follows it. a conditional
+    jump still has to pop its condition.
+    """
+    out = []
+    hits = 0
+    for i, (op, arg) in enumerate(code):
+        if op in JUMPS:
+            j = i + 1
+            following = set()
+            while j < len(code) and is_pseudo(code[j][0]):
+                following.add(code[j][0])
+                j += 1
+            if arg in following:
+                hits += 1
+                if op in CONDITIONAL_JUMPS:
+                    out.append((POP_TOP, None))
+                continue
+        out.append((op, arg))
+    return out, hits
+
+
+def rule_jump_to_jump(code):
+    """ retarget a jump to an unconditional jump at the final destination.
+    JUMP_FORWARD can't go backwards, so it becomes JUMP_ABSOLUTE if needed.
+    """
+    positions = label_positions(code)
+    out = []
+    hits = 0
+    for i, (op, arg) in enumerate(code):
+        if op in JUMPS:
+            target = arg
+            seen = set([target])
+            while 1:
+                j = next_instruction(code, positions[target])
+                if j == len(code) or code[j][0] not in UNCONDITIONAL_JUMPS:
+                    break
+                target = code[j][1]
+                if target in seen:
+                    break
+                seen.add(target)
+            if target is not arg:
+                hits += 1
+                arg = target
+                if op == JUMP_FORWARD and positions[target] < i:
+                    op = JUMP_ABSOLUTE
+        out.append((op, arg))
+    return out, hits
+
+
+def rule_dead_init(code):
+    """ drop LOAD_CONST None; STORE_FAST x when x is stored again before it
+    can be read: the next reference to x is a STORE_FAST in the same basic
+    block, so the None is never observed.
+    """
+    # Walk backwards, tracking the next reference to each variable within
+    # the current basic block.
+    dead = set()
+    next_ref = {}
+    for i in range(len(code) - 1, -1, -1):
+        op, arg = code[i]
+        if is_label(op) or op in JUMPS or op == RETURN_VALUE:
+            next_ref = {}
+        elif op == STORE_FAST or op == LOAD_FAST:
+            if (op == STORE_FAST and i > 0 and code[i - 1] == (LOAD_CONST, None)
+                    and next_ref.get(arg) == STORE_FAST):
+                dead.add(i - 1)
+            next_ref[arg] = op
+
+    out = []
+    i = 0
+    while i < len(code):
+        if i in dead:
+            i += 2
+        else:
+            out.append(code[i])
+            i += 1
+    return out, len(dead)
+
+
+# All rules in the order they are applied, by name.
+RULES = [('dead_init',    rule_dead_init),
+         ('store_load',   rule_store_load),
+         ('jump_to_jump', rule_jump_to_jump),
+         ('jump_to_next', rule_jump_to_next)]
+
+RULE_NAMES = [name for name, rule in RULES]
+
+
+class Peephole(object):
+    """ Apply peephole rules to a code list until none of them fire.
+
+        rules: names of the rules to enable, default all of RULE_NAMES.
+        hits: rule name -> number of times it fired, over every code list
+              this object has optimized.
+    """
+
+    MAX_ROUNDS = 10
+
+    def __init__(self, rules=None):
+        if rules is None:
+            rules = RULE_NAMES
+        for name in rules:
+            if name not in RULE_NAMES:
+                raise ValueError('unknown peephole rule %s' % name)
+        self.rules = [(name, rule) for name, rule in RULES if name in rules]
+        self.hits = dict((name, 0) for name, rule in self.rules)
+
+    def optimize(self, code, name=None):
+        """ return an optimized copy of code, name is the function's name """
+        for round in range(self.MAX_ROUNDS):
+            changed = False
+            for rule_name, rule in self.rules:
+                code, hits = rule(code)
+                if hits:
+                    self.hits[rule_name] += hits
+                    changed = True
+            if not changed:
+                break
+        return code
+
+    def merge(self, other):
+        """ add the hits of other, with the same rules, to this one's """
+        for name in self.hits:
+            self.hits[name] += other.hits[name]
+
+    def report(self):
+        """ return the hit counts as printable lines """
+        return ['%-14s %d' % (name, self.hits[name]) for name, rule in self.rules]
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+#
+# Per source line profiler for compiled mini triangle programs.
+#
+#   $ python profiler.py [--sort line|time|instructions] prog.mt [input ...]
+#
+# Runs the program once under sys.settrace to time each source line, and
+# once in a counting interpreter to count the bytecode instructions each
+# line executes. getint reads the inputs given on the command line, then
+# stdin; both runs see the same values.
+
+import collections
+import cStringIO
+import dis
+import opcode
+import optparse
+import sys
+import time
+import types
+
+import codegen
+import runtime
+
+
+def decode(code):
+    """ decode a python 2 code object into a {offset: (opname, arg, next)}
+    map, where next is the offset of the following instruction
+    """
+    co_code = code.co_code
+    instrs = {}
+    i = 0
+    extended = 0
+    while i < len(co_code):
+        start = i
+        op = ord(co_code[i])
+        arg = None
+        i += 1
+        if op >= opcode.HAVE_ARGUMENT:
+            arg = ord(co_code[i]) | ord(co_code[i + 1]) << 8 | extended
+            extended = 0
+            i += 2
+            if op == opcode.EXTENDED_ARG:
+                extended = arg << 16
+                continue
+        instrs[start] = (opcode.opname[op], arg, i)
+    return instrs
+
+
+def run_counted(code, inputs, counts=None):
+    """ interpret the generated code object, reading getint values from
+    inputs. return (printed output, bytecode instructions executed).
+    counts, if given, is a defaultdict(int) incremented for the (code
+    object, offset) of every instruction executed.
+
+    Only the opcodes CodeGen emits are supported. Python 2 can't trace
+    single opcodes, so this is how dynamic instruction counts are taken.
+    """
+    output = []
+    # what runtime.buffered_io writes goes to sys.stdout
+    stdout = sys.stdout
+    sys.stdout = cStringIO.StringIO()
+    try:
+        result, count = execute(code, inputs, (), output, {}, counts)
+    finally:
+        output.append(sys.stdout.getvalue())
+        sys.stdout = stdout
+    return ''.join(output), count
+
+
+def execute(code, inputs, args, output, globals, counts=None):
+    """ run code with args for run_counted, return (result, count).
+    globals maps the names of the functions defined so far to their code.
+    embedded runtime functions run as real python functions, their own
+    instructions aren't counted.
+    """
+    instrs = decode(code)
+    local = list(args) + [None] * (code.co_nlocals - len(args))
+    stack = []
+    count = 0
+    pc = 0
+    binary = {'BINARY_ADD': lambda a, b: a + b,
+              'BINARY_SUBTRACT': lambda a, b: a - b,
+              'BINARY_MULTIPLY': lambda a, b: a * b,
+              'BINARY_DIVIDE': lambda a, b: a / b,
+              'BINARY_MODULO': lambda a, b: a % b,
+              'BINARY_LSHIFT': lambda a, b: a << b,
+              'BINARY_RSHIFT': lambda a, b: a >> b,
+              'BINARY_AND': lambda a, b: a & b}
+    compare = {'<': lambda a, b: a < b, '>': lambda a, b: a > b,
+               '==': lambda a, b: a == b, 'is': lambda a, b: a is b}
+    while 1:
+        name, arg, nxt = instrs[pc]
+        count += 1
+        if counts is not None:
+            counts[code, pc] += 1
+        pc = nxt
+        if name == 'LOAD_CONST':
+            stack.append(code.co_consts[arg])
+        elif name == 'LOAD_FAST':
+            stack.append(local[arg])
+        elif name == 'STORE_FAST':
+            local[arg] = stack.pop()
+        elif name == 'LOAD_GLOBAL':
+            name = code.co_names[arg]
+            stack.append(globals.get(name, name))
+        elif name == 'STORE_GLOBAL':
+            globals[code.co_names[arg]] = stack.pop()
+        elif name in binary:
+            b = stack.pop()
+            stack.append(binary[name](stack.pop(), b))
+        elif name == 'COMPARE_OP':
+            b = stack.pop()
+            stack.append(compare[opcode.cmp_op[arg]](stack.pop(), b))
+        elif name == 'UNARY_NEGATIVE':
+            stack.append(-stack.pop())
+        elif name == 'LOAD_ATTR':
+            stack.append(getattr(stack.pop(), code.co_names[arg]))
+        elif name == 'BUILD_TUPLE':
+            items = tuple(stack[len(stack) - arg:])
+            del stack[len(stack) - arg:]
+            stack.append(items)
+        elif name == 'UNPACK_SEQUENCE':
+            items = list(stack.pop())
+            assert len(items) == arg
+            stack.extend(reversed(items))
+        elif name == 'ROT_TWO':
+            stack[-2:] = [stack[-1], stack[-2]]
+        elif name == 'DUP_TOP':
+            stack.append(stack[-1])
+        elif name == 'POP_TOP':
+            stack.pop()
+        elif name == 'POP_JUMP_IF_FALSE':
+            if not stack.pop():
+                pc = arg
+        elif name == 'POP_JUMP_IF_TRUE':
+            if stack.pop():
+                pc = arg
+        elif name == 'JUMP_ABSOLUTE':
+            pc = arg
+        elif name == 'JUMP_FORWARD':
+            pc = nxt + arg
+        elif name == 'PRINT_ITEM':
+            output.append(str(stack.pop()))
+        elif name == 'PRINT_NEWLINE':
+            output.append('\n')
+        elif name == 'MAKE_FUNCTION':
+            # the code object on the stack stands for the function
+            if runtime.is_runtime(stack[-1]):
+                stack.append(types.FunctionType(
+                    stack.pop(), {'__builtins__': __builtins__,
+                                  'input': lambda: inputs.pop(0)}))
+        elif name == 'CALL_FUNCTION':
+            call_args = stack[len(stack) - arg:]
+            del stack[len(stack) - arg:]
+            func = stack.pop()
+            if func == 'input':
+                stack.append(inputs.pop(0))
+            elif type(func) is not types.CodeType:
+                # a runtime function, or a method of what one returned
+                stack.append(func(*call_args))
+            else:
+                result, n = execute(func, inputs, call_args, output, globals,
+                                    counts)
+                stack.append(result)
+                count += n
+        elif name == 'RETURN_VALUE':
+            return stack.pop(), count
+        else:
+            raise ValueError('run_counted: unsupported opcode %s' % name)
+
+
+def line_starts(code):
+    """ map every instruction offset in code to its source line """
+    starts = dict(dis.findlinestarts(code))
+    lines = {}
+    line = code.co_firstlineno
+    for offset in sorted(decode(code)):
+        line = starts.get(offset, line)
+        lines[offset] = line
+    return lines
+
+
+class Inputs(object):
+    """ getint values: the given ones first, then read from stdin. every
+    value handed out is recorded, so a second run can replay them.
+    """
+
+    def __init__(self, values):
+        self.values = list(values)
+        self.used = []
+
+    def __call__(self):
+        if self.values:
+            value = self.values.pop(0)
+        else:
+            value = int(raw_input())
+        self.used.append(value)
+        return value
+
+
+class LineTimer(object):
+    """ sys.settrace function charging wall time and hits to the current
+        line of the frames running code from filename
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.hits = collections.defaultdict(int)
+        self.seconds = collections.defaultdict(float)
+        self.line = None
+        self.callers = []
+        self.last = time.time()
+
+    def __call__(self, frame, event, arg):
+        if frame.f_code.co_filename != self.filename:
+            return None
+        now = time.time()
+        if self.line is not None:
+            self.seconds[self.line] += now - self.last
+        if event == 'call':
+            self.callers.append(self.line)
+            self.line = None
+        elif event == 'line':
+            self.line = frame.f_lineno
+            self.hits[self.line] += 1
+        elif event == 'return':
+            self.line = self.callers.pop()
+        self.last = time.time()
+        return self
+
+
+def profile(code, inputs=()):
+    """ run code twice, timed and counted. return the program's output and
+    a {line: (hits, seconds, instructions)} map
+    """
+    feed = Inputs(inputs)
+    timer = LineTimer(code.co_filename)
+    stdout = sys.stdout
+    sys.stdout = cStringIO.StringIO()
+    sys.settrace(timer)
+    try:
+        exec code in {'input': feed}
+    finally:
+        sys.settrace(None)
+        output = sys.stdout.getvalue()
+        sys.stdout = stdout
+
+    counts = collections.defaultdict(int)
+    run_counted(code, list(feed.used), counts)
+    instructions = collections.defaultdict(int)
+    tables = {}
+    for (func, offset), n in counts.items():
+        if func not in tables:
+            tables[func] = line_starts(func)
+        instructions[tables[func][offset]] += n
+
+    lines = {}
+    for line in set(timer.hits) | set(instructions):
+        lines[line] = (timer.hits.get(line, 0), timer.seconds.get(line, 0.0),
+                       instructions.get(line, 0))
+    return output, lines
+
+
+def report(lines, source, sort='line'):
+    """ the profile as printable lines, one per source line that ran """
+    total_time = sum(seconds for hits, seconds, n in lines.values()) or 1.0
+    total_instrs = sum(n for hits, seconds, n in lines.values()) or 1
+    keys = {'line':         lambda line: line,
+            'time':         lambda line: -lines[line][1],
+            'instructions': lambda line: -lines[line][2]}
+    text = source.splitlines()
+    out = ['%5s %9s %10s %6s %12s %6s  %s' % ('line', 'hits', 'time ms', '%',
+                                             'instrs', '%', 'source')]
+    for line in sorted(lines, key=keys[sort]):
+        hits, seconds, n = lines[line]
+        src = ''
+        if 0 < line <= len(text):
+            src = text[line - 1].strip()
+        out.append('%5d %9d %10.3f %6.1f %12d %6.1f  %s' % (
+            line, hits, seconds * 1000, seconds / total_time * 100,
+            n, n * 100.0 / total_instrs, src))
+    return out
+
+
+if __name__ == '__main__':
+    opts = optparse.OptionParser(
+        usage='Usage: profiler.py [options] <source.mt> [input ...]')
+    opts.add_option('--sort', default='line',
+                    choices=['line', 'time', 'instructions'],
+                    help='order of the report: line, time or instructions')
+    options, args = opts.parse_args()
+    if not args:
+        opts.error('no source file')
+    try:
+        inputs = [int(arg) for arg in args[1:]]
+    except ValueError:
+        opts.error('inputs must be integers')
+
+    with open(args[0], 'r') as f:
+        source = f.read()
+    code = codegen.compile_source(source, filename=args[0])
+    output, lines = profile(code, inputs)
+    sys.stdout.write(output)
+    print '\n'.join(report(lines, source, options.sort))
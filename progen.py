@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#
+# Generator of valid mini triangle programs of a given size and shape, for
+# benchmarks and stress tests.
+#
+#   $ python progen.py <shape> <lines> > program.mt
+
+import sys
+
+
+def gen_program(lines, declarations=0):
+    """ build a valid mini triangle program of roughly `lines` lines,
+    plus `declarations` extra var declarations
+    """
+    prog = ['! generated benchmark program',
+            'let',
+            '    var x: Integer;',
+            '    var y: Integer;']
+    for i in range(declarations):
+        prog.append('    var v%d: Integer;' % i)
+    prog.extend(['in',
+                 '  begin'])
+    for i in range(lines):
+        prog.append('    x := (x + %d) * y - 3; ! statement %d' % (i, i))
+    prog.append('  end')
+    return '\n'.join(prog) + '\n'
+
+
+def gen_nested(lines, depth=100):
+    """ blocks of while, if and let commands nested `depth` deep, repeated
+    until the program has roughly `lines` lines
+    """
+    prog = ['! generated nested program',
+            'let',
+            '    var x: Integer;',
+            '    var y: Integer;',
+            'in',
+            '  begin',
+            '    x := 1;',
+            '    y := 2;']
+    block = 0
+    while len(prog) < lines:
+        closers = []
+        for level in range(depth):
+            indent = '    ' + '  ' * level
+            if level % 10 == 9:
+                prog.append('%slet var v%d: Integer; in' % (indent, level))
+            elif level % 2:
+                prog.append('%sif x > %d then' % (indent, level))
+                closers.append('%selse y := y - %d;' % (indent, block))
+            else:
+                prog.append('%swhile x < %d do' % (indent, level))
+        prog.append('    %sx := x + %d;' % ('  ' * depth, block))
+        prog.extend(reversed(closers))
+        block += 1
+    prog.append('  end')
+    return '\n'.join(prog) + '\n'
+
+
+def gen_functions(lines):
+    """ one small function per six lines, each called once from the body """
+    count = max(1, lines // 6)
+    prog = ['! generated functions program',
+            'let',
+            '    var x: Integer;',
+            '    var y: Integer;']
+    for i in range(count):
+        prog.extend(['    func f%d(a: Integer, b: Integer): Integer' % i,
+                     '      begin',
+                     '        a := a * %d + b;' % i,
+                     '        return a - 1;',
+                     '      end'])
+    prog.extend(['in',
+                 '  begin',
+                 '    x := 1;',
+                 '    y := 2;'])
+    for i in range(count):
+        prog.append('    x := f%d(x, y);' % i)
+    prog.append('  end')
+    return '\n'.join(prog) + '\n'
+
+
+def gen_wide(lines, width=50):
+    """ one assignment per line of an expression with `width` operands """
+    operators = ['+', '*', '-', '/', '+', '\\']
+    prog = ['! generated wide expression program',
+            'let',
+            '    var x: Integer;',
+            '    var y: Integer;',
+            'in',
+            '  begin',
+            '    x := 1;',
+            '    y := 2;']
+    for i in range(lines):
+        terms = ['x']
+        for j in range(1, width):
+            operand = 'y' if j % 2 else str(i + j)
+            terms.append('%s %s' % (operators[j % len(operators)], operand))
+        prog.append('    x := %s;' % ' '.join(terms))
+    prog.append('  end')
+    return '\n'.join(prog) + '\n'
+
+
+def gen_calls(lines, iterations=100):
+    """ a loop running `iterations` times, its body roughly `lines` calls
+    of a few small helper functions
+    """
+    prog = ['! generated call heavy program',
+            'let',
+            '    var i: Integer;',
+            '    var x: Integer;',
+            '    func sq(a: Integer): Integer',
+            '        return a * a;',
+            '    func add(a: Integer, b: Integer): Integer',
+            '        return a + b;',
+            '    func clamp(a: Integer, m: Integer): Integer',
+            '        if a > m then return a \\ m; else return a;',
+            '    func mix(a: Integer, b: Integer): Integer',
+            '        begin',
+            '            a := a * 3 + b;',
+            '            return a \\ 1000;',
+            '        end',
+            'in',
+            '  begin',
+            '    i := 0;',
+            '    x := 1;',
+            '    while i < %d do' % iterations,
+            '      begin']
+    calls = ['x := add(x, i);',
+             'x := clamp(x, 1000);',
+             'x := sq(x);',
+             'x := mix(x, i);']
+    for j in range(max(1, lines)):
+        prog.append('        ' + calls[j % len(calls)])
+    prog.extend(['        i := i + 1;',
+                 '      end',
+                 '    putint(x);',
+                 '  end'])
+    return '\n'.join(prog) + '\n'
+
+
+def gen_loops(lines, iterations=100):
+    """ two nested loops, `iterations` and `iterations` / 10 times round,
+    the inner body roughly `lines` assignments with loop invariant parts
+    """
+    prog = ['! generated loop heavy program',
+            'let',
+            '    var i: Integer;',
+            '    var j: Integer;',
+            '    var n: Integer;',
+            '    var m: Integer;',
+            '    var x: Integer;',
+            'in',
+            '  begin',
+            '    n := %d;' % iterations,
+            '    m := 7;',
+            '    x := 0;',
+            '    i := 0;',
+            '    while i < n do',
+            '      begin',
+            '        j := 0;',
+            '        while j < (n / 10) do',
+            '          begin']
+    statements = ['x := (x + (n * m - 1) * (m + 3) + j) \\ 10007;',
+                  'x := (x + i * (m + 3) - (n / 4) * m) \\ 10007;',
+                  'x := (x * 3 + (n \\ 9) * (m - 2) + i * n) \\ 10007;']
+    for k in range(max(1, lines)):
+        prog.append('            ' + statements[k % len(statements)])
+    prog.extend(['            j := j + 1;',
+                 '          end',
+                 '        i := i + 1;',
+                 '      end',
+                 '    putint(x);',
+                 '  end'])
+    return '\n'.join(prog) + '\n'
+
+
+# shape name -> generator taking the number of lines
+SHAPES = {'statements': gen_program,
+          'nested':     gen_nested,
+          'functions':  gen_functions,
+          'wide':       gen_wide,
+          'calls':      gen_calls,
+          'loops':      gen_loops}
+
+SHAPE_NAMES = sorted(SHAPES)
+
+
+def generate(shape, lines):
+    """ program of the named shape with roughly `lines` lines """
+    if shape not in SHAPES:
+        raise ValueError('unknown program shape %s' % shape)
+    return SHAPES[shape](lines)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] not in SHAPES:
+        print 'Usage: progen.py <%s> <lines>' % '|'.join(SHAPE_NAMES)
+        sys.exit(1)
+    sys.stdout.write(generate(sys.argv[1], int(sys.argv[2])))
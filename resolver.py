@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+#
+# Semantic analysis for the mini triangle language: resolves every name in
+# the ast.Program from Parser.parse() to the local slot or function it
+# refers to, so CodeGen never has to look a name up.
+
+import ast
+
+# putint and getint are compiled inline, never as calls
+BUILTINS = ['putint', 'getint']
+
+
+class ResolveError(Exception):
+    """ Resolver error exception.
+
+        identifier: the name that couldn't be resolved
+        line: source line of the command using it, None if not known
+    """
+
+    def __init__(self, identifier, line, message='undeclared identifier'):
+        self.identifier = identifier
+        self.line = line
+        self.message = message
+
+    def __str__(self):
+        return '(%s: %s at line %s)' % (self.message, self.identifier, self.line)
+
+
+class FunctionScope(object):
+    """ The local slots of one code object.
+
+        varnames: name of each slot, the parameters first. A slot is freed
+                  when the let declaring it ends and reused by the next
+                  declaration, so disjoint scopes share slots.
+    """
+
+    def __init__(self, params):
+        self.varnames = []
+        self.names = set()
+        self.free = []
+        for param in params:
+            self.new_slot(param)
+
+    def new_slot(self, ident):
+        name = ident
+        if name in self.names:
+            # a slot name only has to be unique within the code object
+            name = '%s.%d' % (ident, len(self.varnames))
+        self.names.add(name)
+        self.varnames.append(name)
+        return len(self.varnames) - 1
+
+    def allocate(self, ident):
+        """ a free slot for ident """
+        if self.free:
+            return self.free.pop()
+        return self.new_slot(ident)
+
+    def release(self, slots):
+        self.free.extend(reversed(slots))
+
+
+class Block(object):
+    """ One lexical scope: a let, or the top of a function or the program.
+
+        names: identifier -> slot number, or the FunctionDeclaration
+        slots: slots declared here, released when the block ends
+    """
+
+    def __init__(self, function, is_function):
+        self.function = function
+        self.is_function = is_function
+        self.names = {}
+        self.slots = []
+
+
+class Resolver(object):
+    """ Annotate the tree with resolved names.
+
+        Each Vname and var/const declaration gets the slot number of its
+        variable, each call to a user function gets the global name the
+        function is stored under (target), and the Program and every
+        FunctionDeclaration get the names of their slots (varnames).
+
+        A function body sees its parameters, its own declarations and the
+        functions declared around it, including itself and the ones
+        declared after it in the same let, but not the variables of
+        enclosing code. Uses an explicit work stack like CodeGen.walk, so
+        deep trees can't overflow the python stack.
+    """
+
+    def __init__(self):
+        self.blocks = []
+        self.global_names = set()
+        self.line = None
+        self.handlers = {
+            ast.Program:             self.resolve_program,
+            ast.LetCommand:          self.resolve_let_command,
+            ast.CommandList:         self.resolve_command_list,
+            ast.AssignCommand:       self.resolve_assign_command,
+            ast.CallCommand:         self.resolve_call_command,
+            ast.IfCommand:           self.resolve_if_command,
+            ast.WhileCommand:        self.resolve_while_command,
+            ast.ReturnCommand:       self.resolve_return_command,
+            ast.DeclarationList:     self.resolve_declaration_list,
+            ast.VarDeclaration:      self.resolve_var_declaration,
+            ast.ConstDeclaration:    self.resolve_const_declaration,
+            ast.FunctionDeclaration: self.resolve_func_declaration,
+            ast.Parameter:           self.resolve_param,
+            ast.ParameterList:       self.resolve_param,
+            ast.IntegerExpression:   self.resolve_nothing,
+            ast.VnameExpression:     self.resolve_vname_expression,
+            ast.UnaryExpression:     self.resolve_unary_expression,
+            ast.BinaryExpression:    self.resolve_binary_expression,
+            ast.Vname:               self.resolve_vname,
+        }
+
+    def resolve(self, tree):
+        work = [tree]
+        pop = work.pop
+        extend = work.extend
+        handlers = self.handlers
+        while work:
+            item = pop()
+            handler = handlers.get(type(item))
+            if handler is not None:
+                items = handler(item)
+                items.reverse()
+                extend(items)
+            elif isinstance(item, ast.AST):
+                raise ResolveError(type(item).__name__, self.line,
+                                   'unexpected node')
+            else:
+                item()
+        return tree
+
+    def at_line(self, tree, items):
+        """ note the line of command tree for error messages """
+        if tree.line is not None:
+            self.line = tree.line
+        return items
+
+    def push_block(self, is_function, params=()):
+        if is_function:
+            function = FunctionScope(params)
+        else:
+            function = self.blocks[-1].function
+        block = Block(function, is_function)
+        for slot, param in enumerate(params):
+            block.names[param] = slot
+        self.blocks.append(block)
+        return block
+
+    def pop_block(self):
+        block = self.blocks.pop()
+        if not block.is_function:
+            block.function.release(block.slots)
+
+    def declare(self, ident):
+        """ bind ident to a new slot in the current block """
+        block = self.blocks[-1]
+        slot = block.function.allocate(ident)
+        block.names[ident] = slot
+        block.slots.append(slot)
+        return slot
+
+    def lookup(self, ident):
+        """ the slot or FunctionDeclaration ident refers to """
+        crossed = False
+        for block in reversed(self.blocks):
+            binding = block.names.get(ident)
+            if binding is not None:
+                if crossed and not isinstance(binding, ast.FunctionDeclaration):
+                    raise ResolveError(ident, self.line, 'variable of an '
+                                       'enclosing scope used in function')
+                return binding
+            if block.is_function:
+                crossed = True
+        raise ResolveError(ident, self.line)
+
+    def global_name(self, ident):
+        """ a global name for function ident, unique in the program. it
+        has a dot, which no identifier has, so it can't replace a builtin
+        that generated code or the embedded runtime reads from the globals.
+        """
+        n = 1
+        name = '%s.%d' % (ident, n)
+        while name in self.global_names:
+            n += 1
+            name = '%s.%d' % (ident, n)
+        self.global_names.add(name)
+        return name
+
+    def resolve_program(self, tree):
+        block = self.push_block(True)
+        def finish():
+            tree.varnames = block.function.varnames
+            self.pop_block()
+        return [tree.command, finish]
+
+    def resolve_let_command(self, tree):
+        self.push_block(False)
+        return self.at_line(tree, [tree.declaration, tree.command, self.pop_block])
+
+    def resolve_command_list(self, tree):
+        return list(tree.commands)
+
+    def resolve_assign_command(self, tree):
+        return self.at_line(tree, [tree.variable, tree.expression])
+
+    def resolve_call_command(self, tree):
+        self.at_line(tree, None)
+        if tree.identifier not in BUILTINS:
+            binding = self.lookup(tree.identifier)
+            if not isinstance(binding, ast.FunctionDeclaration):
+                raise ResolveError(tree.identifier, self.line,
+                                   'call of a variable')
+            tree.target = binding.global_name
+        return [tree.expression]
+
+    def resolve_if_command(self, tree):
+        return self.at_line(tree, [tree.expression, tree.command1, tree.command2])
+
+    def resolve_while_command(self, tree):
+        return self.at_line(tree, [tree.expression, tree.command])
+
+    def resolve_return_command(self, tree):
+        return self.at_line(tree, [tree.expression])
+
+    def resolve_declaration_list(self, tree):
+        # every function of the list is bound before any body is resolved,
+        # so functions declared together can call each other
+        for decl in tree.declarations:
+            if type(decl) is ast.FunctionDeclaration:
+                decl.global_name = self.global_name(decl.name)
+                self.blocks[-1].names[decl.name] = decl
+        return list(tree.declarations)
+
+    def resolve_var_declaration(self, tree):
+        tree.slot = self.declare(tree.identifier)
+        return []
+
+    def resolve_const_declaration(self, tree):
+        # the value is computed in the scope outside the new name
+        def bind():
+            tree.slot = self.declare(tree.identifier)
+        return [tree.expression, bind]
+
+    def resolve_func_declaration(self, tree):
+        self.at_line(tree, None)
+        # bound again, a var or const of the same name declared earlier in
+        # the list hides it until here
+        self.blocks[-1].names[tree.name] = tree
+        if type(tree.param) is ast.ParameterList:
+            params = [param.argname for param in tree.param.params]
+        else:
+            params = [tree.param.argname]
+        block = self.push_block(True, params)
+        def finish():
+            tree.varnames = block.function.varnames
+            self.pop_block()
+        return [tree.command, finish]
+
+    def resolve_param(self, tree):
+        if type(tree) is ast.Parameter:
+            return [tree.argname]
+        return [param.argname for param in tree.params]
+
+    def resolve_nothing(self, tree):
+        return []
+
+    def resolve_vname_expression(self, tree):
+        return self.resolve_vname(tree.variable)
+
+    def resolve_unary_expression(self, tree):
+        return [tree.expression]
+
+    def resolve_binary_expression(self, tree):
+        return [tree.expr1, tree.expr2]
+
+    def resolve_vname(self, tree):
+        binding = self.lookup(tree.identifier)
+        if isinstance(binding, ast.FunctionDeclaration):
+            raise ResolveError(tree.identifier, self.line,
+                               'function used as a variable')
+        tree.slot = binding
+        return []
+
+
+def resolve(tree):
+    """ run the Resolver over tree """
+    return Resolver().resolve(tree)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#
+# Runtime support for compiled mini triangle programs. A pyc file has to run
+# on its own, so generated code can't import this module. Instead CodeGen
+# embeds the code object of each function it needs as a constant and binds
+# it to a global when the program starts. These functions may only use
+# their arguments, builtins and what they import themselves.
+
+import types
+
+# co_filename of the embedded code objects, so the pyc doesn't depend on
+# where the compiler is installed
+FILENAME = 'runtime.py'
+
+
+def memo_table(name, size, policy, typed, report):
+    """ a memo table of at most size results of function name, evicting
+    the least recently used (policy 'lru') or the oldest ('fifo') result
+    when it is full.
+
+    table.lookup(args) returns the result stored for the argument tuple,
+    or table itself when there is none. table.store(value, args) stores
+    and returns value. With typed, arguments of different types are
+    different keys, so f(True) doesn't give the result of f(1). With
+    report, the hit and miss counts are printed to stderr at exit.
+    """
+    import collections
+    import sys
+
+    class MemoTable(object):
+
+        def __init__(self):
+            self.values = collections.OrderedDict()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+        def lookup(self, args):
+            if typed:
+                args += tuple(map(type, args))
+            values = self.values
+            if args in values:
+                self.hits += 1
+                if policy == 'lru':
+                    value = values.pop(args)
+                    values[args] = value
+                    return value
+                return values[args]
+            self.misses += 1
+            return self
+
+        def store(self, value, args):
+            if typed:
+                args += tuple(map(type, args))
+            values = self.values
+            values[args] = value
+            if len(values) > size:
+                values.popitem(False)
+                self.evictions += 1
+            return value
+
+        def report(self):
+            sys.stderr.write('memo %-14s %d hits, %d misses, %d evictions\n'
+                             % (name, self.hits, self.misses, self.evictions))
+
+    table = MemoTable()
+    if report:
+        import atexit
+        atexit.register(table.report)
+    return table
+
+
+def buffered_io():
+    """ (getint, write, flush) for a program doing its I/O in bulk.
+
+    getint reads stdin in large chunks and parses whitespace separated
+    ints from the buffer. If the program has an input global, as when the
+    profiler or bench feed it values, getint is that function instead.
+    write writes a string to stdout through a large buffer, which flush
+    empties. When stdout is the real one, it is also flushed at exit. A
+    stream put in sys.stdout by the caller, as bench and the profiler do,
+    is left to the caller. A terminal gets output line by line, and
+    before each read, like print gives it.
+    """
+    import __builtin__
+    import atexit
+    import os
+    import sys
+
+    stdout = sys.stdout
+    if stdout is sys.__stdout__:
+        stdout.flush()
+        fd = stdout.fileno()
+        stdout = os.fdopen(os.dup(fd), 'w', 1 if os.isatty(fd) else 1 << 16)
+        # only for this file, a handler for a stream the caller swapped in
+        # would keep it alive until exit, for every run
+        atexit.register(stdout.flush)
+
+    # a global lookup, the program's input if it has one
+    if input is not __builtin__.input:
+        return input, stdout.write, stdout.flush
+
+    fd = sys.stdin.fileno()
+    interactive = os.isatty(fd)
+    # ints not handed out yet, last first, and the start of a number cut
+    # off at the end of the last chunk
+    tokens = []
+    partial = ['']
+
+    def getint():
+        while not tokens:
+            if interactive:
+                stdout.flush()
+            data = os.read(fd, 1 << 16)
+            if not data:
+                if not partial[0]:
+                    raise EOFError('EOF when reading a line')
+                tokens.append(partial[0])
+                partial[0] = ''
+                break
+            data = partial[0] + data
+            parts = data.split()
+            partial[0] = ''
+            if parts and not data[-1].isspace():
+                partial[0] = parts.pop()
+            parts.reverse()
+            tokens.extend(parts)
+        return int(tokens.pop())
+
+    return getint, stdout.write, stdout.flush
+
+
+def relabel(code):
+    """ copy of code object code and the code objects in its constants,
+    with FILENAME as their file name
+    """
+    consts = tuple(relabel(const) if type(const) is types.CodeType else const
+                   for const in code.co_consts)
+    return types.CodeType(code.co_argcount, code.co_nlocals, code.co_stacksize,
+                          code.co_flags, code.co_code, consts, code.co_names,
+                          code.co_varnames, FILENAME, code.co_name,
+                          code.co_firstlineno, code.co_lnotab,
+                          code.co_freevars, code.co_cellvars)
+
+
+def embedded(func):
+    """ the code object of runtime function func, to embed in a program """
+    return relabel(func.func_code)
+
+
+def is_runtime(code):
+    """ True if code object code is an embedded runtime function """
+    return type(code) is types.CodeType and code.co_filename == FILENAME
+
+
+if __name__ == '__main__':
+    pass
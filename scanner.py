@@ -2,7 +2,11 @@
 #
 # Scanner for Mini Triangle
 
+import bisect
 import cStringIO as StringIO
+from array import array
+import os
+import re
 import string
 
 # Token Constants
@@ -64,6 +68,23 @@ KEYWORDS = {'begin': TK_BEGIN, 'const' :TK_CONST, 'do':TK_DO, 'else':TK_ELSE,
             'end'  : TK_END, 'if' :TK_IF, 'in':TK_IN, 'let':TK_LET, 'then':TK_THEN, 
             'var': TK_VAR, 'while': TK_WHILE, 'func' : TK_FUNC, 'return': TK_RETURN}
 
+# Single and double character tokens, mapped to their (type, val) pair.
+PUNCTUATION = {';': (TK_SEMICOLON, 0), ',': (TK_COMMA, 0), ':': (TK_COLON, 0),
+               ':=': (TK_BECOMES, 0), '~': (TK_IS, 0), '(': (TK_LPAREN, 0),
+               ')': (TK_RPAREN, 0)}
+for oper in OPERATORS:
+    PUNCTUATION[oper] = (TK_OPERATOR, oper)
+del oper
+
+# Master pattern used by Scanner. Skips any run of separators, then captures
+# at most one token in group 1 (int), 2 (identifier) or 3 (punctuation).
+TOKEN_RE = re.compile(r'''
+    (?: [ \t\n\r\f\v]+ | ![^\n]* )*
+    (?: ([0-9]+)
+      | ([A-Za-z][A-Za-z0-9]*)
+      | (:=|[-;,:~()+*/<>=\\])
+    )?''', re.VERBOSE)
+
 class Token(object):
     """ A simple Token structure.
         
@@ -81,6 +102,90 @@ class Token(object):
         return self.__str__()
 
 
+class CompactToken(object):
+    """ Token view handed out by TokenStore. Same interface as Token,
+        without a per-instance __dict__.
+    """
+    __slots__ = ('type', 'val', 'pos')
+
+    def __init__(self, type, val, pos):
+        self.type = type
+        self.val = val
+        self.pos = pos
+
+    def __str__(self):
+        return '(%s(%s) at %s)' % (TOKENS[self.type], self.val, self.pos)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class TokenStore(object):
+    """ Compact, array backed list of tokens.
+
+        Token types and positions live in parallel array('i') columns.
+        Values are interned in a side table, and the third column holds the
+        index of each token's value in that table. Indexing or iterating
+        yields CompactToken views, so a TokenStore can be passed to the
+        Parser in place of a list of Tokens.
+    """
+
+    def __init__(self):
+        self.types = array('i')
+        self.positions = array('i')
+        self.valindex = array('i')
+        self.values = [0]
+        self.interned = {0: 0}
+
+    def append(self, type, val, pos):
+        index = self.interned.get(val)
+        if index is None:
+            index = self.interned[val] = len(self.values)
+            self.values.append(val)
+        self.types.append(type)
+        self.positions.append(pos)
+        self.valindex.append(index)
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, i):
+        return CompactToken(self.types[i], self.values[self.valindex[i]],
+                            self.positions[i])
+
+    def __iter__(self):
+        values = self.values
+        for type, index, pos in zip(self.types, self.valindex, self.positions):
+            yield CompactToken(type, values[index], pos)
+
+
+class LineMap(object):
+    """ Map positions in the input text to 1 based line numbers.
+
+        starts holds the position each line starts at. Text can be added a
+        chunk at a time with feed(), so a StreamScanner can fill the map as
+        it reads. Like Scanner it takes an mmap as well as a string.
+    """
+
+    def __init__(self, text=''):
+        self.starts = array('i', [0])
+        self.end = 0
+        self.feed(text)
+
+    def feed(self, chunk):
+        """ add the next chunk of the input text """
+        starts = self.starts
+        i = chunk.find('\n')
+        while i >= 0:
+            starts.append(self.end + i + 1)
+            i = chunk.find('\n', i + 1)
+        self.end += len(chunk)
+
+    def line(self, pos):
+        """ line number of position pos """
+        return bisect.bisect_right(self.starts, pos)
+
+
 class ScannerError(Exception):
     """ Scanner error exception.
 
@@ -93,8 +198,168 @@ class ScannerError(Exception):
     def __str__(self):
         return 'ScannerError at pos = %d, char = %s' % (self.pos, self.char)
 
+def next_token(input, pos, base=0):
+    """Scan the token at or after position pos of input with TOKEN_RE.
+
+    Return (type, val, start, end), where start is the position of the
+    token and end the position the next one is searched from. At the end
+    of input the type is TK_EOT. Raise ScannerError, at its position in
+    input plus base, for a character no token starts with. Every scanner
+    but CharScanner gets its tokens from here.
+    """
+
+    m = TOKEN_RE.match(input, pos)
+    kind = m.lastindex
+    end = m.end()
+    if kind is None:
+        if end < len(input):
+            raise ScannerError(base + end, input[end])
+        return TK_EOT, 0, end, end
+
+    start = m.start(kind)
+    text = input[start:end]
+    if kind == 1:
+        return TK_INTLITERAL, int(text), start, end
+    elif kind == 2:
+        if text in KEYWORDS:
+            return KEYWORDS[text], 0, start, end
+        return TK_IDENTIFIER, text, start, end
+    type, val = PUNCTUATION[text]
+    return type, val, start, end
+
 class Scanner(object):
     """Implement a scanner for the following token grammar
+
+    Token     ::=  Letter (Letter | Digit)* | Digit Digit* |
+                   '+' | '-' | '*' | '/' | '<' | '>' | '=' | '\'
+                   ':' ('=') | <empty>) | ';' | '~' | '(' | ')' | <eot>
+
+    Separator ::=  '!' Graphic* <eol> | <space> | <eol>
+
+    The whole input is scanned in place with TOKEN_RE, so each token costs
+    one regex match and a slice instead of a read per character. input can
+    be a string or any read only buffer, an mmap of the source file or a
+    buffer() slice, and only the text of int literals and identifiers is
+    copied out of it. Python 2's re can't match a memoryview, so one is
+    copied into a string.
+    """
+
+    def __init__(self, input):
+        if isinstance(input, memoryview):
+            input = input.tobytes()
+        self.input = input
+        self.pos = 0       # Position in the input text
+
+    def scan(self):
+        """Main entry point to scanner object.
+
+        Return a list of Tokens.
+        """
+
+        self.tokens = [Token(type, val, pos)
+                       for type, val, pos in self.iter_triples()]
+        return self.tokens
+
+    def scan_compact(self):
+        """Scan the input into a TokenStore without creating Tokens."""
+
+        store = TokenStore()
+        append = store.append
+        for type, val, pos in self.iter_triples():
+            append(type, val, pos)
+        return store
+
+    def iter_triples(self):
+        """Yield (type, val, pos) for each token, ending with TK_EOT."""
+
+        input = self.input
+        pos = self.pos
+
+        while 1:
+            type, val, start, pos = next_token(input, pos)
+            self.pos = pos
+            yield type, val, start
+            if type == TK_EOT:
+                break
+
+    def iter_tokens(self):
+        """Yield Tokens one at a time, ending with the TK_EOT token."""
+
+        while 1:
+            token = self.scan_token()
+            yield token
+            if token.type == TK_EOT:
+                break
+
+    def scan_token(self):
+        """Scan a single token from input text."""
+
+        type, val, pos, self.pos = next_token(self.input, self.pos)
+        return Token(type, val, pos)
+
+
+class StreamScanner(object):
+    """Scan tokens from a file object as its contents arrive.
+
+    Only a window of the input is kept in memory, so the tokens can be fed
+    straight to the Parser while the rest of the source is still being read,
+    e.g. from a pipe. Produces the same tokens as Scanner. line_map covers
+    the input read so far.
+    """
+
+    def __init__(self, inputfile, chunk_size=65536):
+        self.inputfile = inputfile
+        self.chunk_size = chunk_size
+        self.line_map = LineMap()
+
+    def scan(self):
+        """Return a list of Tokens."""
+
+        self.tokens = list(self.iter_tokens())
+        return self.tokens
+
+    def read_chunk(self):
+        """Return the next chunk of input, or '' at the end of the input.
+
+        Reads from the file descriptor directly when there is one, so the
+        data already written into a pipe is returned without waiting for a
+        full chunk.
+        """
+
+        try:
+            fd = self.inputfile.fileno()
+        except (AttributeError, IOError):
+            return self.inputfile.read(self.chunk_size)
+        return os.read(fd, self.chunk_size)
+
+    def iter_tokens(self):
+        """Yield Tokens one at a time, ending with the TK_EOT token."""
+
+        buf = ''
+        base = 0     # Position in the input text of buf[0]
+        pos = 0      # Position in buf
+        eot = False
+
+        while 1:
+            type, val, start, end = next_token(buf, pos, base)
+            if end == len(buf) and not eot:
+                # The token or separator may continue in the next chunk.
+                chunk = self.read_chunk()
+                self.line_map.feed(chunk)
+                eot = chunk == ''
+                buf = buf[pos:] + chunk
+                base += pos
+                pos = 0
+                continue
+
+            pos = end
+            yield Token(type, val, base + start)
+            if type == TK_EOT:
+                return
+
+
+class CharScanner(object):
+    """Character at a time scanner for the following token grammar
     
     EBNF -> Recursive descent parser
     1) left factorize
@@ -107,6 +372,9 @@ class Scanner(object):
 
                 :=
     Separator ::=  '!' Graphic* <eol> | <space> | <eol> 
+
+    This is the original scanning engine. It is kept as the reference
+    implementation for Scanner and for benchmarking against it.
     """
 
     def __init__(self, input):
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# Compact serialization of mini triangle tokens and ast trees, for caching
+# the output of the scanner and the parser. Both are turned into strings,
+# lists and ints that marshal writes and reads natively.
+
+from array import array
+import gc
+import marshal
+
+import ast
+import scanner
+
+# Bump when the encoding changes.
+FORMAT_VERSION = 1
+
+# every node class, by the name a serialized tree refers to it with
+NODE_KINDS = dict((kind.__name__, kind) for kind in [
+    ast.Program, ast.AssignCommand, ast.CallCommand, ast.CommandList,
+    ast.IfCommand, ast.WhileCommand, ast.LetCommand, ast.ReturnCommand,
+    ast.IntegerExpression, ast.VnameExpression, ast.UnaryExpression,
+    ast.BinaryExpression, ast.Vname, ast.ConstDeclaration,
+    ast.VarDeclaration, ast.FunctionDeclaration, ast.Parameter,
+    ast.ParameterList, ast.DeclarationList, ast.TypeDenoter])
+
+# what loading malformed data can raise, from marshal or from decoding
+DECODE_ERRORS = (EOFError, ValueError, TypeError, KeyError, IndexError,
+                 StopIteration)
+
+# op code of a list built from the items on the stack. the others index
+# the table of node builders.
+OP_LIST = 255
+
+
+def constructor_args(kind):
+    """ the slots the constructor of node class kind takes, in order. the
+    other slots, the ones resolver fills in, start as None.
+    """
+    code = kind.__init__.im_func.func_code
+    return code.co_varnames[1:code.co_argcount]
+
+NODE_ARGS = dict((kind, constructor_args(kind)) for kind in NODE_KINDS.values())
+
+
+def make_builder(kind, pattern, pop, next_value):
+    """ a function building a node of class kind from the stack and the
+    value list. pattern has an 'S' for each constructor argument that is a
+    subtree, on the stack, and a 'V' for each value, from the value list.
+    """
+    # the subtrees are popped last first, the values read in order
+    names = ['a%d' % i for i in range(len(pattern))]
+    lines = ['def build():']
+    for i in reversed(range(len(pattern))):
+        if pattern[i] == 'S':
+            lines.append('    a%d = pop()' % i)
+        else:
+            names[i] = 'next_value()'
+    lines.append('    return kind(%s)' % ', '.join(names))
+    scope = {'kind': kind, 'pop': pop, 'next_value': next_value}
+    exec '\n'.join(lines) in scope
+    return scope['build']
+
+
+def dump_tokens(tokens):
+    """ serialize a list of Tokens or a TokenStore to a string """
+    if not isinstance(tokens, scanner.TokenStore):
+        store = scanner.TokenStore()
+        for token in tokens:
+            store.append(token.type, token.val, token.pos)
+        tokens = store
+    return marshal.dumps((FORMAT_VERSION, tokens.types.tostring(),
+                          tokens.positions.tostring(),
+                          tokens.valindex.tostring(), tokens.values))
+
+
+def load_tokens(data):
+    """ the TokenStore serialized in string data """
+    version, types, positions, valindex, values = marshal.loads(data)
+    if version != FORMAT_VERSION:
+        raise ValueError('token format %r, expected %d' % (version, FORMAT_VERSION))
+    store = scanner.TokenStore()
+    store.types = array('i', types)
+    store.positions = array('i', positions)
+    store.valindex = array('i', valindex)
+    store.values = values
+    store.interned = dict((value, index) for index, value in enumerate(values))
+    return store
+
+
+def dump_tree(tree):
+    """ serialize the ast tree to a string.
+
+    The tree is written in post order, as a string of op codes, one byte
+    per node or list, and a list of the values (identifiers, ints, None,
+    list lengths) in the order the ops read them. Only the slots the
+    constructors take are written. Each node op stands for a node class
+    and which of its arguments are subtrees, listed in a table at the
+    start, so loading a node is one call of a builder made for it. Uses
+    an explicit stack, so deep trees are fine.
+    """
+    ops = array('B')
+    values = []
+    table = []
+    codes = {}
+    # a tuple on the stack is an op to write, with its values, after the
+    # subtrees it follows
+    work = [tree]
+    pop = work.pop
+    while work:
+        item = pop()
+        kind = type(item)
+        if kind is tuple:
+            ops.append(item[0])
+            values.extend(item[1])
+        elif kind is list:
+            work.append((OP_LIST, [len(item)]))
+            work.extend(reversed(item))
+        else:
+            pattern = []
+            subtrees = []
+            node_values = []
+            for name in NODE_ARGS[kind]:
+                arg = getattr(item, name)
+                if isinstance(arg, (ast.AST, list)):
+                    pattern.append('S')
+                    subtrees.append(arg)
+                else:
+                    pattern.append('V')
+                    node_values.append(arg)
+            pattern = ''.join(pattern)
+            code = codes.get((kind, pattern))
+            if code is None:
+                code = codes[kind, pattern] = len(table)
+                table.append((kind.__name__, pattern))
+            work.append((code, node_values))
+            subtrees.reverse()
+            work.extend(subtrees)
+    return marshal.dumps((FORMAT_VERSION, table, ops.tostring(), values))
+
+
+def load_tree(data):
+    """ the ast tree serialized in string data """
+    version, table, ops, values = marshal.loads(data)
+    if version != FORMAT_VERSION:
+        raise ValueError('tree format %r, expected %d' % (version, FORMAT_VERSION))
+    stack = []
+    push = stack.append
+    next_value = iter(values).next
+    builders = [make_builder(NODE_KINDS[name], pattern, stack.pop, next_value)
+                for name, pattern in table]
+    # the nodes can't form cycles, and collecting while millions of them
+    # are made takes most of the time
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for op in bytearray(ops):
+            if op == OP_LIST:
+                n = next_value()
+                if n:
+                    items = stack[-n:]
+                    del stack[-n:]
+                else:
+                    items = []
+                push(items)
+            else:
+                push(builders[op]())
+    finally:
+        if enabled:
+            gc.enable()
+    return stack.pop()
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+#
+# Long running mini triangle compile server on a unix socket. Keeps the
+# compiler imported, so clients don't pay for interpreter startup and the
+# byteplay import on every compile.
+#
+# Protocol, one compile per connection:
+#   request:  4 byte big endian length, source text
+#   response: status byte, 4 byte big endian length, payload
+# status 'O' means the payload is the marshalled code object, 'E' that it
+# is an error message.
+
+import errno
+import marshal
+import optparse
+import os
+import socket
+import SocketServer
+import stat
+import struct
+import sys
+
+import codegen
+import parser
+import peephole
+import resolver
+import scanner
+
+DEFAULT_SOCKET = os.environ.get('MT_COMPILE_SOCKET',
+                                '/tmp/minitriangle-%d.sock' % os.getuid())
+
+HEADER = struct.Struct('>L')
+RESPONSE_HEADER = struct.Struct('>cL')
+
+
+class ProtocolError(Exception):
+    """ Malformed or truncated message """
+
+
+class CompileError(Exception):
+    """ Source the server could not compile """
+
+
+class SocketInUseError(Exception):
+    """ The socket path is taken by something the server must not remove """
+
+
+def remove_stale_socket(path):
+    """ remove the socket at path left behind by a server that is gone.
+    raises SocketInUseError if path is anything else: another file, or
+    the socket of a server still listening.
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise SocketInUseError('%s: %s' % (path, e.strerror))
+    if not stat.S_ISSOCK(mode):
+        raise SocketInUseError('%s exists and is not a socket' % path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        if e.errno != errno.ECONNREFUSED:
+            raise SocketInUseError('%s: %s' % (path, e.strerror))
+    else:
+        raise SocketInUseError('a server is already listening on %s' % path)
+    finally:
+        sock.close()
+    os.remove(path)
+
+
+def recv_exactly(sock, size):
+    """ read exactly size bytes from sock """
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise ProtocolError('connection closed with %d bytes left' % size)
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+class CompileHandler(SocketServer.BaseRequestHandler):
+    """ Compile the source of one request and send back the result """
+
+    def handle(self):
+        try:
+            size, = HEADER.unpack(recv_exactly(self.request, HEADER.size))
+            source = recv_exactly(self.request, size)
+        except ProtocolError:
+            return
+        try:
+            code = codegen.compile_source(source, self.server.options)
+        except (scanner.ScannerError, parser.ParserError,
+                resolver.ResolveError, codegen.CodeGenError) as e:
+            status, payload = 'E', str(e)
+        except Exception as e:
+            status, payload = 'E', '%s: %s' % (type(e).__name__, e)
+        else:
+            status, payload = 'O', marshal.dumps(code)
+        self.request.sendall(RESPONSE_HEADER.pack(status, len(payload)) +
+                             payload)
+
+
+class CompileServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """ Serve compile requests on a unix socket, a thread per connection.
+
+        options: compiler options every request is compiled with, as
+                 returned by codegen.option_parser().
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, options):
+        # raises SocketInUseError rather than take over a path in use
+        remove_stale_socket(path)
+        SocketServer.UnixStreamServer.__init__(self, path, CompileHandler)
+        self.options = options
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+def compile_remote(source, path=DEFAULT_SOCKET):
+    """ compile source on the server listening at path. returns the code
+    object, raises CompileError with the server's message when the source
+    doesn't compile.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(HEADER.pack(len(source)) + source)
+        status, size = RESPONSE_HEADER.unpack(
+            recv_exactly(sock, RESPONSE_HEADER.size))
+        payload = recv_exactly(sock, size)
+    finally:
+        sock.close()
+    if status != 'O':
+        raise CompileError(payload)
+    return marshal.loads(payload)
+
+
+def check_args():
+    """ parse the server's command line. returns the socket path and the
+    compiler options
+    """
+    opts = optparse.OptionParser(usage='Usage: server.py [options]')
+    opts.add_option('--socket', default=DEFAULT_SOCKET,
+                    help='unix socket to listen on (default %default)')
+    opts.add_option('-O', dest='opt_level', type='int', default=1,
+                    help='0 disables all optimizations (default 1)')
+    opts.add_option('--peephole', default=','.join(peephole.RULE_NAMES),
+                    help='comma separated peephole rules to enable, '
+                         'from: %s' % ', '.join(peephole.RULE_NAMES))
+    options, args = opts.parse_args()
+    for rule in options.peephole.split(','):
+        if rule and rule not in peephole.RULE_NAMES:
+            opts.error('unknown peephole rule %s' % rule)
+    if args:
+        opts.error('unexpected arguments')
+
+    compile_options = codegen.option_parser().get_default_values()
+    compile_options.opt_level = options.opt_level
+    compile_options.peephole = options.peephole
+    return options.socket, compile_options
+
+
+if __name__ == '__main__':
+    path, options = check_args()
+    try:
+        server = CompileServer(path, options)
+    except SocketInUseError as e:
+        sys.stderr.write('server.py: %s\n' % e)
+        sys.exit(1)
+    print 'compile server listening on %s' % path
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
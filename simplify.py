@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#
+# Algebraic simplification and strength reduction of mini triangle
+# expressions, driven by a table of rewrite rules.
+
+import ast
+import optimizer
+
+
+def power_of_two(value):
+    """ k if value is 2**k, else None """
+    if value is None or value < 1 or value & (value - 1):
+        return None
+    return value.bit_length() - 1
+
+
+def binary(expr1, oper, expr2):
+    return ast.BinaryExpression(expr1, oper, expr2)
+
+
+# The rules. Each takes the Simplifier and a BinaryExpression whose
+# operands are already simplified, and returns the expression replacing it,
+# or None when it doesn't apply. Python ints are unbounded and / and \
+# floor, so x / 2**k is x >> k and x \ 2**k is x & (2**k - 1) for negative
+# x too, and bools give the same ints as 1 and 0 through either form.
+
+def rule_commute(simplifier, tree):
+    """ c + x => x + c, c * x => x * c: literals go right """
+    if (tree.oper in ('+', '*') and
+            optimizer.literal(tree.expr1) is not None and
+            optimizer.literal(tree.expr2) is None):
+        return binary(tree.expr2, tree.oper, tree.expr1)
+
+
+def rule_reassociate(simplifier, tree):
+    """ (x + c1) + c2 => x + (c1 + c2), the same for * """
+    inner = tree.expr1
+    if (tree.oper in ('+', '*') and
+            optimizer.literal(tree.expr2) is not None and
+            type(inner) is ast.BinaryExpression and inner.oper == tree.oper and
+            optimizer.literal(inner.expr2) is not None):
+        value = optimizer.fold_binary(tree.oper, inner.expr2.value, tree.expr2.value)
+        return binary(inner.expr1, tree.oper, ast.IntegerExpression(value))
+
+
+def rule_add_zero(simplifier, tree):
+    """ x + 0 => x, x - 0 => x """
+    if (tree.oper in ('+', '-') and optimizer.literal(tree.expr2) == 0 and
+            simplifier.is_int(tree.expr1)):
+        return tree.expr1
+
+
+def rule_mul_one(simplifier, tree):
+    """ x * 1 => x, x / 1 => x """
+    if (tree.oper in ('*', '/') and optimizer.literal(tree.expr2) == 1 and
+            simplifier.is_int(tree.expr1)):
+        return tree.expr1
+
+
+def rule_mul_zero(simplifier, tree):
+    """ x * 0 => 0 """
+    if (tree.oper == '*' and optimizer.literal(tree.expr2) == 0 and
+            simplifier.key(tree.expr1) is not None):
+        return ast.IntegerExpression(0)
+
+
+def rule_sub_self(simplifier, tree):
+    """ x - x => 0 """
+    if tree.oper == '-':
+        key = simplifier.key(tree.expr1)
+        if key is not None and key == simplifier.key(tree.expr2):
+            return ast.IntegerExpression(0)
+
+
+def rule_mul_pow2(simplifier, tree):
+    """ x * 2**k => x << k """
+    shift = power_of_two(optimizer.literal(tree.expr2))
+    if tree.oper == '*' and shift:
+        return binary(tree.expr1, '<<', ast.IntegerExpression(shift))
+
+
+def rule_div_pow2(simplifier, tree):
+    """ x / 2**k => x >> k """
+    shift = power_of_two(optimizer.literal(tree.expr2))
+    if tree.oper == '/' and shift:
+        return binary(tree.expr1, '>>', ast.IntegerExpression(shift))
+
+
+def rule_mod_pow2(simplifier, tree):
+    """ x \\ 2**k => x & (2**k - 1) """
+    value = optimizer.literal(tree.expr2)
+    if tree.oper == '\\' and power_of_two(value) is not None:
+        return binary(tree.expr1, '&', ast.IntegerExpression(value - 1))
+
+
+# The rule table, one list of rules per pass over the tree, each list in
+# the order its rules are tried. Strength reduction comes in a second pass,
+# so it sees x * 6 rather than (x << 1) * 3.
+RULES = [[('commute', rule_commute),
+          ('reassociate', rule_reassociate),
+          ('add_zero', rule_add_zero),
+          ('mul_one', rule_mul_one),
+          ('mul_zero', rule_mul_zero),
+          ('sub_self', rule_sub_self)],
+         [('mul_pow2', rule_mul_pow2),
+          ('div_pow2', rule_div_pow2),
+          ('mod_pow2', rule_mod_pow2)]]
+
+RULE_NAMES = [name for rules in RULES for name, rule in rules]
+
+
+class Simplifier(optimizer.Rewriter):
+    """ Rewrite binary expressions with the RULES table.
+
+        Each list of rules in the table is a pass over the tree, rewriting
+        expressions bottom up. At each node the pass's rules are tried in
+        order, and after one fires they are tried again on its result,
+        until none applies. Rules that drop an operation (x + 0 =>
+        x) must keep an int an int, so they only apply when the operand is
+        known to be one: arithmetic, an int literal, or any variable when
+        the program never stores a comparison result.
+
+        Rules that drop an operand (x * 0 => 0) or compare two (x - x =>
+        0) use key(), which is None when the operand calls a function or
+        divides by a variable, so it can't be dropped.
+
+        rules: names of the rules to use, default all
+        hits: rule name -> times it fired
+    """
+
+    def __init__(self, rules=None):
+        if rules is None:
+            rules = RULE_NAMES
+        self.passes = [[(name, rule) for name, rule in table if name in rules]
+                       for table in RULES]
+        self.hits = dict((name, 0) for name in RULE_NAMES if name in rules)
+        self.ints_only = False
+        self.rules = []
+        # expression node -> its key, and key tuple -> number
+        self.keys = {}
+        self.numbers = {}
+
+    def simplify(self, tree):
+        self.ints_only = not optimizer.stores_bools(tree)
+        for rules in self.passes:
+            if rules:
+                self.rules = rules
+                tree = self.rewrite(tree)
+                self.keys.clear()
+        self.numbers.clear()
+        return tree
+
+    def key(self, tree):
+        """ a number equal for expressions of the same structure, None if
+        expression tree calls a function or divides by a variable. the
+        keys of operands are kept, and leave() finds them bottom up, so
+        each node is looked at once.
+        """
+        if tree in self.keys:
+            return self.keys[tree]
+        kind = type(tree)
+        key = None
+        if kind is ast.IntegerExpression:
+            # 1 and True print differently
+            key = ('int', type(tree.value) is bool, tree.value)
+        elif kind is ast.VnameExpression:
+            key = ('var', tree.variable.identifier)
+        elif kind is ast.UnaryExpression:
+            operand = self.key(tree.expression)
+            if operand is not None:
+                key = (tree.operator, operand)
+        elif kind is ast.BinaryExpression:
+            operand1 = self.key(tree.expr1)
+            operand2 = self.key(tree.expr2)
+            if (operand1 is not None and operand2 is not None and
+                    (tree.oper not in ('/', '\\') or
+                     (type(tree.expr2) is ast.IntegerExpression and tree.expr2.value))):
+                key = (tree.oper, operand1, operand2)
+        if key is not None:
+            key = self.numbers.setdefault(key, len(self.numbers))
+        self.keys[tree] = key
+        return key
+
+    def is_int(self, tree):
+        """ True if expression tree always has an int value """
+        return optimizer.is_int(tree, self.ints_only)
+
+    def leave(self, node):
+        if type(node) is not ast.BinaryExpression:
+            if isinstance(node, ast.Expression):
+                self.key(node)
+            return node
+        fired = True
+        while fired and type(node) is ast.BinaryExpression:
+            fired = False
+            for name, rule in self.rules:
+                result = rule(self, node)
+                if result is not None:
+                    self.hits[name] += 1
+                    node = result
+                    fired = True
+                    break
+        self.key(node)
+        return node
+
+    def report(self):
+        """ return the hit counts as printable lines """
+        return ['%-14s %d' % (name, self.hits[name])
+                for name in RULE_NAMES if name in self.hits]
+
+
+def simplify_expressions(tree):
+    """ run the Simplifier pass over tree """
+    return Simplifier().simplify(tree)
+
+
+if __name__ == '__main__':
+    pass
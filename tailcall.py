@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+#
+# Tail call pass for the mini triangle language. Turns functions that only
+# call themselves in tail position into loops, so deep recursions run in
+# constant stack instead of a python frame per call.
+
+import ast
+import inliner
+import optimizer
+
+# operators an accumulator can collect results with, and their identity
+ACCUMULATORS = {'+': 0, '*': 1}
+
+
+def self_calls(tree, name):
+    """ number of calls of function name in tree """
+    return sum(1 for node in ast.iter_nodes(tree)
+               if type(node) is ast.CallCommand and node.identifier == name)
+
+
+class TailCalls(optimizer.Rewriter):
+    """ Compile self recursion in tail position as a loop.
+
+        A function qualifies when every call of itself is either
+          return f(args)
+        or, at the end of a command list, the accumulator form
+          v := f(args); return v op e     (or e op v)
+        with op + or * the same everywhere, and e not using v or calling
+        a function. Its body becomes a loop that rebinds the parameters
+        and goes round again instead of calling:
+
+            let var f.acc: Integer
+            in begin
+                f.acc := 1;
+                while 1 do <body>
+            end
+
+        where return f(args) becomes the parameter assignments, the
+        accumulator form becomes f.acc := f.acc op e followed by the
+        parameter assignments, and every other return e becomes
+        return f.acc op e. + and * on python ints are associative and
+        commutative, so collecting e on the way down gives the result the
+        calls would have built on the way back up. A bool returned without
+        a call would come back as an int, so the accumulator form is only
+        used when every such return gives an int.
+
+        converted: (function name, tail calls, accumulator op or None) for
+                   each function turned into a loop
+    """
+
+    def __init__(self):
+        self.converted = []
+        self.ints_only = False
+
+    def eliminate(self, tree):
+        self.ints_only = not optimizer.stores_bools(tree)
+        return self.rewrite(tree)
+
+    def leave(self, node):
+        if type(node) is ast.FunctionDeclaration:
+            self.convert_function(node)
+        return node
+
+    def convert_function(self, decl):
+        name = decl.name
+        body = decl.command
+        self.params = inliner.param_names(decl)
+        if not inliner.returns_in_tail(body):
+            return
+        for node in ast.iter_nodes(body):
+            kind = type(node)
+            # the parameter assignments must reach the parameters, and
+            # calls of name must mean this function
+            if kind is ast.FunctionDeclaration and node.name == name:
+                return
+            if ((kind is ast.VarDeclaration or kind is ast.ConstDeclaration)
+                    and node.identifier in self.params):
+                return
+
+        self.name = name
+        self.op = None
+        self.tail_calls = 0
+        self.results = []
+        if not self.check(body) or self.tail_calls == 0:
+            return
+        if self.op is not None and not all(optimizer.is_int(result, self.ints_only)
+                                           for result in self.results):
+            return
+        # every call of itself must have been a tail call
+        if self.tail_calls != self_calls(body, name):
+            return
+
+        self.acc = None
+        if self.op is not None:
+            self.acc = '%s.acc' % name
+        loop = ast.WhileCommand(ast.IntegerExpression(1), self.convert(body))
+        if self.acc is None:
+            decl.command = loop
+        else:
+            init = ast.AssignCommand(ast.Vname(self.acc),
+                                     ast.IntegerExpression(ACCUMULATORS[self.op]))
+            decl.command = ast.LetCommand(
+                ast.DeclarationList([ast.VarDeclaration(self.acc,
+                                                        ast.TypeDenoter('Integer'))]),
+                ast.CommandList([init, loop]))
+        self.converted.append((name, self.tail_calls, self.op))
+
+    def is_self_call(self, tree):
+        return (type(tree) is ast.CallCommand and tree.identifier == self.name
+                and len(tree.expression.params) == len(self.params))
+
+    def accumulated(self, commands):
+        """ (op, e) if commands end in the accumulator form, else None """
+        if len(commands) < 2:
+            return None
+        assign, ret = commands[-2:]
+        if (type(assign) is not ast.AssignCommand or
+                not self.is_self_call(assign.expression) or
+                type(ret) is not ast.ReturnCommand or
+                type(ret.expression) is not ast.BinaryExpression or
+                ret.expression.oper not in ACCUMULATORS):
+            return None
+        ident = assign.variable.identifier
+        expr1, expr2 = ret.expression.expr1, ret.expression.expr2
+        if type(expr1) is ast.VnameExpression and expr1.variable.identifier == ident:
+            other = expr2
+        elif type(expr2) is ast.VnameExpression and expr2.variable.identifier == ident:
+            other = expr1
+        else:
+            return None
+        # e is evaluated before the call now, so it mustn't call anything
+        if (optimizer.uses(other, ident) or optimizer.calls(other) or
+                not optimizer.can_reorder(other)):
+            return None
+        return ret.expression.oper, other
+
+    def check(self, tree):
+        """ count the tail calls of command tree, which returns only in
+        tail position, find the accumulator op and collect the other
+        returned expressions in results. False if the tail positions can't
+        all be converted.
+        """
+        kind = type(tree)
+        if kind is ast.ReturnCommand:
+            if self.is_self_call(tree.expression):
+                self.tail_calls += 1
+            else:
+                self.results.append(tree.expression)
+            return True
+        elif kind is ast.CommandList:
+            found = self.accumulated(tree.commands)
+            if found is None:
+                return self.check(tree.commands[-1])
+            if self.op is not None and self.op != found[0]:
+                return False
+            self.op = found[0]
+            self.tail_calls += 1
+            return True
+        elif kind is ast.IfCommand:
+            return self.check(tree.command1) and self.check(tree.command2)
+        elif kind is ast.LetCommand:
+            return self.check(tree.command)
+        return False
+
+    def convert(self, tree):
+        """ the loop body replacing command tree """
+        kind = type(tree)
+        if kind is ast.ReturnCommand:
+            if self.is_self_call(tree.expression):
+                return self.rebind(tree.expression)
+            return ast.ReturnCommand(self.collect(tree.expression), tree.line)
+        elif kind is ast.CommandList:
+            found = self.accumulated(tree.commands)
+            if found is None:
+                tree.commands[-1] = self.convert(tree.commands[-1])
+            else:
+                op, other = found
+                call = tree.commands[-2].expression
+                tree.commands[-2:] = [
+                    ast.AssignCommand(ast.Vname(self.acc), self.collect(other),
+                                      tree.commands[-2].line),
+                    self.rebind(call)]
+        elif kind is ast.IfCommand:
+            tree.command1 = self.convert(tree.command1)
+            tree.command2 = self.convert(tree.command2)
+        elif kind is ast.LetCommand:
+            tree.command = self.convert(tree.command)
+        return tree
+
+    def collect(self, expression):
+        """ expression combined with the accumulator """
+        if self.acc is None:
+            return expression
+        return ast.BinaryExpression(ast.VnameExpression(ast.Vname(self.acc)),
+                                    self.op, expression)
+
+    def rebind(self, call):
+        """ assign the arguments of call to the parameters. when more than
+        one changes, every argument is computed before any is assigned.
+        """
+        changes = []
+        for param, arg in zip(self.params, [p.argname for p in call.expression.params]):
+            if not (type(arg) is ast.VnameExpression and arg.variable.identifier == param):
+                changes.append((param, arg))
+        if len(changes) <= 1:
+            return ast.CommandList([ast.AssignCommand(ast.Vname(param), arg, call.line)
+                                    for param, arg in changes])
+        temps = ['%s.next.%s' % (self.name, param) for param, arg in changes]
+        declarations = [ast.ConstDeclaration(temp, arg)
+                        for temp, (param, arg) in zip(temps, changes)]
+        assigns = [ast.AssignCommand(ast.Vname(param),
+                                     ast.VnameExpression(ast.Vname(temp)))
+                   for temp, (param, arg) in zip(temps, changes)]
+        return ast.LetCommand(ast.DeclarationList(declarations),
+                              ast.CommandList(assigns), call.line)
+
+    def report(self):
+        """ return the functions turned into loops as printable lines """
+        lines = []
+        for name, count, op in self.converted:
+            line = '%-14s %d tail calls' % (name, count)
+            if op is not None:
+                line += ', accumulates with %s' % op
+            lines.append(line)
+        return lines
+
+
+def eliminate_tail_calls(tree):
+    """ run the TailCalls pass over tree """
+    return TailCalls().eliminate(tree)
+
+
+if __name__ == '__main__':
+    pass